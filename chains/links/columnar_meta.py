@@ -0,0 +1,79 @@
+"""ColumnarMeta, Decode batches of raw packets into NumPy columns (one array per header field)
+   for analytics style runs (flow accounting, top talkers, ...)"""
+from __future__ import print_function
+
+# Local imports
+from chains.links import link
+from chains.utils import file_utils, log_utils, columnar
+
+
+class ColumnarMeta(link.Link):
+    """ColumnarMeta, Decode batches of raw packets into columnar.PacketColumns (IPv4/TCP/UDP
+       header fields as NumPy arrays, read with vectorized operations instead of per packet).
+       This link is always in batch mode, each batch it outputs is a PacketColumns object.
+       Per-item links downstream get the rows as PacketMeta style dictionaries.
+       Usage:
+            cmeta = ColumnarMeta(batch_size=65536)
+            cmeta.link(PacketStreamer(iface_name='big.pcap').use_batches(65536))
+            for columns in cmeta.output_stream:
+                top_ports = np.bincount(columns.dport[columns.proto == 6])
+
+       Args:
+            batch_size (int): the maximum number of packets in a batch (defaults to 65536)
+            batch_ms (int): the maximum milliseconds to spend filling a batch (defaults to None)
+       Note: Requires numpy (pip install numpy)
+    """
+
+    # Only the first columnar.HEADER_LEN bytes of each packet get decoded
+    headers_only = True
+
+    def __init__(self, batch_size=65536, batch_ms=None):
+        """Initialize ColumnarMeta Class"""
+
+        # Call super class init
+        super(ColumnarMeta, self).__init__()
+        if columnar.np is None:
+            log_utils.panic('ColumnarMeta requires numpy (pip install numpy)')
+
+        # Set my output (always batches)
+        self.batch_size = batch_size
+        self.batch_ms = batch_ms
+        self.output_stream = self.batch_output_stream()
+
+    def batch_output_stream(self):
+        """Decode each batch of packets from the input_stream
+           Returns:
+               generator (PacketColumns): a generator that yields a PacketColumns for each batch"""
+        for batch in self.input_stream:
+            if batch:
+                yield columnar.decode_batch(batch)
+
+
+def test():
+    """Test for ColumnarMeta class"""
+    from chains.sources import packet_streamer
+    if columnar.np is None:
+        print('numpy not installed, skipping the ColumnarMeta test')
+        return
+
+    # Per-item source, the link makes the batches
+    data_path = file_utils.relative_dir(__file__, '../../data/http.pcap')
+    streamer = packet_streamer.PacketStreamer(iface_name=data_path)
+    cmeta = ColumnarMeta(batch_size=16)
+    cmeta.link(streamer)
+    batches = list(cmeta.output_stream)
+    assert [len(columns) for columns in batches] == [16, 16, 11]
+    assert [int(num) for columns in batches for num in columns.packet_num] == list(range(43))
+    assert sum(int(columns.eth_len.sum()) for columns in batches) > 0
+
+    # Batched source and a per-item link downstream gets the rows
+    streamer = packet_streamer.PacketStreamer(iface_name=data_path).use_batches(batch_size=32)
+    cmeta = ColumnarMeta()
+    cmeta.link(streamer)
+    downstream = link.Link()
+    downstream.link(cmeta)
+    rows = list(downstream.input_stream)
+    assert len(rows) == 43 and rows[0]['packet']['type'] == 'IP'
+
+if __name__ == '__main__':
+    test()
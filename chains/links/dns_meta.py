@@ -6,7 +6,7 @@ import dpkt
 
 # Local imports
 from chains.links import link
-from chains.utils import file_utils, log_utils, data_utils
+from chains.utils import file_utils, log_utils, data_utils, packet_record
 
 
 class DNSMeta(link.Link):
@@ -48,18 +48,46 @@ class DNSMeta(link.Link):
             # Skip packets without transport info (ARP/ICMP/IGMP/whatever)
             if 'transport' not in packet:
                 continue
-            try:
-                dns_meta = dpkt.dns.DNS(packet['transport']['data'])
-                _raw_info = data_utils.make_dict(dns_meta)
-                packet['dns'] = self._dns_info_mapper(_raw_info)
-                packet['dns']['_raw'] = _raw_info
-            except (dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError):
-                if 'dns' in packet:
-                    del packet['dns']
+            self._dns_meta(packet)
 
             # All done
             yield packet
 
+    def batch_output_stream(self):
+        """Pull out the dns metadata for each packet in each batch from the input_stream"""
+        dns_meta = self._dns_meta
+        for batch in self.input_stream:
+            # Skip packets without transport info (ARP/ICMP/IGMP/whatever)
+            batch = [packet for packet in batch if 'transport' in packet]
+            for packet in batch:
+                dns_meta(packet)
+            if batch:
+                yield batch
+
+    def _dns_meta(self, packet):
+        """Internal method: try to decode the transport data of a single packet as DNS"""
+
+        # Lazy records only decode it if someone looks
+        if isinstance(packet, packet_record.LazyPacketRecord):
+            packet.defer('dns', self._dns_layer)
+            return
+        dns = self._dns_layer(packet)
+        if dns is not packet_record.MISSING:
+            packet['dns'] = dns
+        elif 'dns' in packet:
+            del packet['dns']
+
+    def _dns_layer(self, packet):
+        """Internal method: the DNS metadata for a single packet (MISSING if it isn't DNS)"""
+        try:
+            dns_meta = dpkt.dns.DNS(packet['transport']['data'])
+            _raw_info = data_utils.make_dict(dns_meta)
+            dns = self._dns_info_mapper(_raw_info)
+            dns['_raw'] = _raw_info
+            return dns
+        except (dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError):
+            return packet_record.MISSING
+
     def _dns_info_mapper(self, raw_dns):
         """The method maps the specific fields/flags in a DNS record to human readable form"""
         output = {}
@@ -220,5 +248,17 @@ def test():
         else:
             print('.', end='')
 
+    # Lazy records give the same DNS meta data (only decoding it when it's read)
+    def _dns(lazy):
+        streamer = packet_streamer.PacketStreamer(iface_name=data_path, max_packets=10000)
+        meta = packet_meta.PacketMeta(fast_decode=lazy, lazy=lazy)
+        tmeta = transport_meta.TransportMeta()
+        dns_meta = DNSMeta()
+        meta.link(streamer)
+        tmeta.link(meta)
+        dns_meta.link(tmeta)
+        return [item.get('dns') for item in dns_meta.output_stream]
+    assert _dns(True) == _dns(False)
+
 if __name__ == '__main__':
     test()
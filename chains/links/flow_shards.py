@@ -0,0 +1,284 @@
+"""FlowShards, Hash each raw packet on its flow and fan the packets out to worker processes,
+              each worker runs its own copy of the downstream links. The worker outputs
+              are merged back into a single output_stream.
+"""
+from __future__ import print_function
+import zlib
+import time
+import threading
+import traceback
+import multiprocessing
+from collections import deque
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Local imports
+from chains.links import link
+from chains.utils import file_utils, flow_utils, log_utils
+
+
+class FlowShards(link.Link):
+    """FlowShards, Hash each raw packet on its (direction normalized) flow and fan the packets
+                   out to worker processes, each worker runs its own copy of the downstream links.
+       Usage:
+            def http_links():
+                return [PacketMeta(), ReverseDNS(), TransportMeta(), Flows(), HTTPMeta()]
+
+            shards = FlowShards(http_links, num_workers=4)
+            shards.link(PacketStreamer(iface_name='en0'))
+            for flow in shards.output_stream:
+                ...
+
+       Args:
+           pipeline (callable): returns a list of (unlinked) links for one worker, the first link gets
+                                the raw packets and the last link's output goes back to the parent
+                                (has to be picklable, so a module level function)
+           num_workers (int): the number of worker processes (defaults to the number of cores)
+           order_by (str): merge the worker outputs in order of this field, e.g. 'timestamp' or 'start'
+                           (defaults to None, outputs go out as they arrive)
+           batch_size (int): the number of items sent between processes at a time (defaults to 64)
+           queue_size (int): the maximum number of batches waiting for each worker (defaults to 64)
+       Note: Both directions of a flow always land on the same worker. Ordering assumes each
+             worker's output is in order, a worker that goes quiet holds the merge up.
+    """
+
+    def __init__(self, pipeline, num_workers=None, order_by=None, batch_size=64, queue_size=64):
+        """Initialize FlowShards Class"""
+
+        # Call super class init
+        super(FlowShards, self).__init__()
+
+        self.pipeline = pipeline
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.order_by = order_by
+        self.shard_batch_size = batch_size
+        self.queue_size = queue_size
+
+        # Set my output
+        self.output_stream = self.sharded_output()
+
+    def sharded_output(self):
+        """Send the packets out to the workers and merge what comes back
+           Returns:
+               generator (dictionary): the output of the worker pipelines
+        """
+
+        # Spin up the workers, each one has its own input queue but they share the output queue
+        in_queues = [multiprocessing.Queue(self.queue_size) for _ in range(self.num_workers)]
+        out_queue = multiprocessing.Queue(self.queue_size * self.num_workers)
+        workers = [multiprocessing.Process(target=_shard_worker, args=(self.pipeline, shard, in_queue, out_queue,
+                                                                       self.shard_batch_size))
+                   for shard, in_queue in enumerate(in_queues)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        # A thread feeds the workers so we can pull the outputs at the same time
+        stop = threading.Event()
+        feeder = threading.Thread(target=self._feed_workers, args=(in_queues, stop), name='FlowShards feeder')
+        feeder.daemon = True
+        feeder.start()
+
+        # Merge the outputs
+        merge = self._merge_ordered if self.order_by else self._merge_unordered
+        finished = False
+        try:
+            for item in merge(out_queue):
+                yield item
+            finished = True
+
+        # All done (closed early or a worker failed, so the workers might be stuck on their queues)
+        finally:
+            stop.set()
+            feeder.join()
+            for worker in workers:
+                if not finished:
+                    worker.terminate()
+                worker.join()
+            if not finished:
+                for in_queue in in_queues:
+                    in_queue.cancel_join_thread()
+
+    def _feed_workers(self, in_queues, stop):
+        """Internal method: hash each packet onto a worker and send the packets in batches
+           (until we run out of packets or we've been told to stop)
+        """
+        num_workers = len(in_queues)
+        pending = [[] for _ in in_queues]
+        try:
+            for item in self.input_stream:
+
+                # Zero-copy raw buffers can't be pickled
+                raw_buf = item['raw_buf']
+                if isinstance(raw_buf, memoryview):
+                    item = dict(item, raw_buf=raw_buf.tobytes())
+
+                # The crc32 is the same in every process (hash() isn't)
+                shard = (zlib.crc32(flow_utils.raw_flow_key(raw_buf)) & 0xffffffff) % num_workers
+                batch = pending[shard]
+                batch.append(item)
+                if len(batch) >= self.shard_batch_size:
+                    if not _put(in_queues[shard], batch, stop):
+                        return
+                    pending[shard] = []
+
+        # Send the partial batches and tell the workers we're done
+        finally:
+            for in_queue, batch in zip(in_queues, pending):
+                if batch:
+                    _put(in_queue, batch, stop)
+                _put(in_queue, None, stop)
+
+    def _worker_messages(self, out_queue):
+        """Internal method: pull (shard, items) off the output queue until every worker is done"""
+        running = self.num_workers
+        while running:
+            shard, kind, payload = out_queue.get()
+            if kind == 'items':
+                yield shard, payload
+            elif kind == 'done':
+                running -= 1
+                yield shard, None
+            else:
+                log_utils.panic('FlowShards worker {:d} failed:\n{:s}'.format(shard, payload))
+
+    def _merge_unordered(self, out_queue):
+        """Internal method: items go out as they arrive"""
+        for _shard, items in self._worker_messages(out_queue):
+            if items:
+                for item in items:
+                    yield item
+
+    def _merge_ordered(self, out_queue):
+        """Internal method: k-way merge of the worker outputs on the order_by field"""
+        order_by = self.order_by
+        pending = [deque() for _ in range(self.num_workers)]
+        running = set(range(self.num_workers))
+        for shard, items in self._worker_messages(out_queue):
+            if items is None:
+                running.discard(shard)
+            else:
+                pending[shard].extend(items)
+
+            # The smallest head can go out once every running worker has something pending
+            while all(pending[index] for index in running):
+                heads = [(items[0][order_by], index) for index, items in enumerate(pending) if items]
+                if not heads:
+                    break
+                _key, index = min(heads)
+                yield pending[index].popleft()
+
+
+def _put(in_queue, batch, stop):
+    """Internal method: put a batch on a worker queue unless we've been told to stop"""
+    while not stop.is_set():
+        try:
+            in_queue.put(batch, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _queue_items(in_queue):
+    """Internal method: the items in batches sent to a worker (None means no more batches)"""
+    while True:
+        batch = in_queue.get()
+        if batch is None:
+            return
+        for item in batch:
+            yield item
+
+def _shard_worker(pipeline, shard, in_queue, out_queue, batch_size):
+    """Internal method: run one copy of the pipeline and send the outputs back in batches"""
+    try:
+        links = pipeline()
+        links[0].link(_queue_items(in_queue))
+        for upstream, downstream in zip(links, links[1:]):
+            downstream.link(upstream)
+        batch = []
+        for item in links[-1].output_stream:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                out_queue.put((shard, 'items', batch))
+                batch = []
+        if batch:
+            out_queue.put((shard, 'items', batch))
+        out_queue.put((shard, 'done', None))
+    except Exception:
+        out_queue.put((shard, 'error', traceback.format_exc()))
+
+def _test_packet_links():
+    """Per packet pipeline for the test"""
+    from chains.links import packet_meta, transport_meta
+    return [packet_meta.PacketMeta(), transport_meta.TransportMeta()]
+
+def _test_flow_links():
+    """Flows pipeline for the test"""
+    from chains.links import packet_meta, reverse_dns, transport_meta, flows
+    return [packet_meta.PacketMeta(), reverse_dns.ReverseDNS(), transport_meta.TransportMeta(),
+            flows.Flows(clock='event', keep_packets=False)]
+
+def _test_broken_links():
+    """Broken pipeline for the test"""
+    return [link.Link()]
+
+def test():
+    """Test for FlowShards class"""
+    from chains.sources import packet_streamer
+
+    data_path = file_utils.relative_dir(__file__, '../../data/http.pcap')
+
+    # Single process flows
+    links = _test_flow_links()
+    links[0].link(packet_streamer.PacketStreamer(iface_name=data_path))
+    for upstream, downstream in zip(links, links[1:]):
+        downstream.link(upstream)
+    flows = sorted((flow['flow_id'], flow['packet_count'], flow['payload']) for flow in links[-1].output_stream)
+
+    # Sharded flows should be the same flows
+    shards = FlowShards(_test_flow_links, num_workers=3)
+    shards.link(packet_streamer.PacketStreamer(iface_name=data_path))
+    sharded_flows = sorted((flow['flow_id'], flow['packet_count'], flow['payload']) for flow in shards.output_stream)
+    assert sharded_flows == flows
+    print('Sharded flows: %d' % len(sharded_flows))
+
+    # Ordered by timestamp
+    shards = FlowShards(_test_packet_links, num_workers=4, order_by='timestamp', batch_size=5)
+    shards.link(packet_streamer.PacketStreamer(iface_name=data_path))
+    timestamps = [packet['timestamp'] for packet in shards.output_stream]
+    assert len(timestamps) == 43
+    assert timestamps == sorted(timestamps)
+
+    # Batches (the Link default, on top of the per-item stream)
+    shards = FlowShards(_test_packet_links, num_workers=2).use_batches(batch_size=10)
+    shards.link(packet_streamer.PacketStreamer(iface_name=data_path).use_batches(batch_size=8))
+    assert [len(batch) for batch in shards.output_stream] == [10, 10, 10, 10, 3]
+
+    # Worker failures come back to the parent
+    shards = FlowShards(_test_broken_links, num_workers=2)
+    shards.link(packet_streamer.PacketStreamer(iface_name=data_path))
+    try:
+        list(shards.output_stream)
+        assert False
+    except RuntimeError:
+        pass
+
+    # Closing the stream early shuts down the feeder and the workers (even with full queues)
+    def _packets():
+        for _ in range(100):
+            for packet in packet_streamer.PacketStreamer(iface_name=data_path).output_stream:
+                yield packet
+    shards = FlowShards(_test_packet_links, num_workers=2, batch_size=1, queue_size=1)
+    shards.link(_packets())
+    output_stream = shards.output_stream
+    next(output_stream)
+    start = time.time()
+    output_stream.close()
+    assert time.time() - start < 5.0
+    assert not [thread for thread in threading.enumerate() if thread.name == 'FlowShards feeder']
+    assert not multiprocessing.active_children()
+
+if __name__ == '__main__':
+    test()
@@ -3,26 +3,63 @@
 """
 from __future__ import print_function
 import time
-from collections import defaultdict
+import heapq
+import itertools
 
 # Local imports
 from chains.links import link
-from chains.utils import file_utils, net_utils, flow_utils
+from chains.utils import file_utils, net_utils, flow_utils, log_utils
+
+# Default (idle, active) flow timeouts in seconds for each protocol, anything
+# that isn't TCP or UDP uses the 'default' timeouts (go out right away)
+DEFAULT_TIMEOUTS = {'TCP': (5, 60), 'UDP': (5, 60), 'default': (0, 0)}
 
 
 class Flows(link.Link):
     """Flows, Takes an input_stream of packets and provides an output_stream of flows
               based on (src, dst, src_port, dst_port, protocol) flow ids.
+
+       Args:
+           timeouts (dict): per protocol (idle, active) timeouts in seconds, e.g. {'UDP': (2, 30)}
+                            these override the DEFAULT_TIMEOUTS (defaults to None)
+           clock (str): 'wall' expires flows by the wall clock, 'event' expires flows by the packet
+                        timestamps, so offline pcaps give the same flows every run (defaults to 'wall')
+           allowed_lateness (float): event clock only, seconds a packet can lag behind the newest packet seen
+                                     (the watermark), later packets are dropped and counted in late_packets
+                                     (defaults to 1.0)
+           keep_packets (bool): keep every packet dict in each flow's packet_list, set to False for long
+                                flows where only the reassembled payload matters (defaults to True)
+           counters_only (bool): NetFlow style flow records (packets, bytes, start/end, TCP flag union
+                                 and direction) in compact flow_utils.FlowRecord slots, no packets or
+                                 payload are kept (defaults to False)
+       Note: TCP flows closed by a FIN/RST go out as soon as they close.
     """
 
-    def __init__(self):
+    def __init__(self, timeouts=None, clock='wall', allowed_lateness=1.0, keep_packets=True, counters_only=False):
         """Initialize Flows Class"""
 
         # Call super class init
         super(Flows, self).__init__()
 
-        # Flows
-        self._flows = defaultdict(flow_utils.Flow)
+        # Clock
+        if clock not in ['wall', 'event']:
+            log_utils.panic('Unknown flow clock: {:s}'.format(clock))
+        self.clock = clock
+        self.allowed_lateness = allowed_lateness
+        self._max_event_time = None
+        self.late_packets = 0
+        self.keep_packets = keep_packets
+        self.counters_only = counters_only
+
+        # Timeouts
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+        if timeouts:
+            self.timeouts.update(timeouts)
+
+        # Flows and a min-heap of (deadline, sequence, flow) expiration entries
+        self._flows = {}
+        self._expirations = []
+        self._sequence = itertools.count()
 
         # Set my output
         self.output_stream = self.packets_to_flows()
@@ -32,26 +69,111 @@ class Flows(link.Link):
 
         # For each packet, place it into either an existing flow or a new flow
         for packet in self.input_stream:
+            for flow_info in self._add_packet(packet):
+                yield flow_info
 
-            # Compute flow tuple and add the packet to the flow
-            flow_id = flow_utils.flow_tuple(packet)
-            self._flows[flow_id].add_packet(packet)
+        # All done so just dump what we have left
+        for flow_info in self._remaining_flows():
+            yield flow_info
 
-            # Yield flows that are ready to go
-            for flow in list(self._flows.values()):
-                if flow.ready():
-                    flow_info = flow.get_flow()
-                    yield flow_info
-                    del self._flows[flow_info['flow_id']]
+    def batch_output_stream(self):
+        """Combine batches of packets into batches of flows"""
+        add_packet = self._add_packet
+        for batch in self.input_stream:
+            flow_batch = []
+            for packet in batch:
+                flow_batch.extend(add_packet(packet))
+            if flow_batch:
+                yield flow_batch
 
         # All done so just dump what we have left
+        flow_batch = self._remaining_flows()
+        if flow_batch:
+            yield flow_batch
+
+    def _add_packet(self, packet):
+        """Internal method: add a packet to its flow
+
+           Returns:
+               list: the flows that are ready to go
+        """
+
+        # Event time: the watermark trails the newest packet timestamp by allowed_lateness
+        if self.clock == 'event':
+            now = flow_utils.event_time(packet)
+            if self._max_event_time is None or now > self._max_event_time:
+                self._max_event_time = now
+            watermark = self._max_event_time - self.allowed_lateness
+
+            # Packets behind the watermark might belong to flows that already went out
+            if now < watermark:
+                self.late_packets += 1
+                return []
+        else:
+            now = watermark = time.time()
+
+        # Compute flow tuple and add the packet to the flow (new flows go on the expiration heap)
+        flow_id = flow_utils.flow_tuple(packet)
+        flow = self._flows.get(flow_id)
+        if flow is None:
+            idle, active = self.timeouts.get(flow_id[4], self.timeouts['default'])
+            if self.counters_only:
+                flow = flow_utils.FlowRecord(idle_timeout=idle, active_timeout=active)
+            else:
+                flow = flow_utils.Flow(idle_timeout=idle, active_timeout=active, keep_packets=self.keep_packets)
+            self._flows[flow_id] = flow
+            flow.add_packet(packet, now)
+            heapq.heappush(self._expirations, (flow.deadline(), next(self._sequence), flow))
+        else:
+            flow.add_packet(packet, now)
+
+        # Closed flows go out right away
+        ready_flows = []
+        if flow.closed:
+            del self._flows[flow_id]
+            ready_flows.append(flow.get_flow())
+
+        # Flows that are past their deadline
+        if self._expirations and self._expirations[0][0] <= watermark:
+            ready_flows.extend(self._expire(watermark))
+        return ready_flows
+
+    def _expire(self, now):
+        """Internal method: pop the expired flows off the expiration heap
+           Note: heap entries are lazy, so a flow that's seen packets since it was pushed
+                 gets pushed back with its new deadline (at most once per idle period)
+
+           Returns:
+               list: the flows that have expired
+        """
+        expired = []
+        expirations = self._expirations
+        while expirations and expirations[0][0] <= now:
+            _deadline, _seq, flow = heapq.heappop(expirations)
+            flow_id = flow.flow_id
+
+            # Already gone out (closed)?
+            if self._flows.get(flow_id) is not flow:
+                continue
+            deadline = flow.deadline()
+            if deadline > now:
+                heapq.heappush(expirations, (deadline, next(self._sequence), flow))
+            else:
+                del self._flows[flow_id]
+                expired.append(flow.get_flow())
+        return expired
+
+    def _remaining_flows(self):
+        """Internal method: flush all of the flows that are left (sorted by start time)"""
         print('---- NO MORE INPUT ----')
-        for flow in sorted(self._flows.values(), key=lambda x: x.meta['start']):
-            yield flow.get_flow()
+        flows = [flow.get_flow() for flow in sorted(self._flows.values(), key=lambda x: x.start)]
+        self._flows.clear()
+        self._expirations = []
+        return flows
 
 def print_flow_info(flow):
     """Print a summary of the flow information"""
-    print('Flow %s (%s)-- Packets:%d Bytes:%d Payload: %s...' % (flow['flow_id'], flow['direction'], len(flow['packet_list']),
+    print('Flow %s (%s)-- Packets:%d Bytes:%d Payload: %s...' % (flow['flow_id'], flow['direction'], flow['packet_count'],
                                                               len(flow['payload']), repr(flow['payload'])[:30]))
 
 def test():
@@ -77,8 +199,109 @@ def test():
     flows.link(tmeta)
 
     # Print out the flow information
+    num_flows = 0
     for flow in flows.output_stream:
         print_flow_info(flow)
+        num_flows += 1
+
+    # Batch mode should give the same flows
+    streamer = packet_streamer.PacketStreamer(iface_name=data_path, max_packets=1000).use_batches(batch_size=32)
+    meta = packet_meta.PacketMeta().use_batches()
+    rdns = reverse_dns.ReverseDNS().use_batches()
+    tmeta = transport_meta.TransportMeta().use_batches()
+    flows = Flows().use_batches()
+    meta.link(streamer)
+    rdns.link(meta)
+    tmeta.link(rdns)
+    flows.link(tmeta)
+    assert sum(len(batch) for batch in flows.output_stream) == num_flows
+
+    # A closed TCP flow goes out as soon as the FIN arrives
+    def _packet(sport, flags):
+        return {'timestamp': 0, 'packet': {'src': b'\x0a\x00\x00\x01', 'dst': b'\x0a\x00\x00\x02', 'type': 'IP',
+                                           'src_domain': 'internal', 'dst_domain': 'internal'},
+                'transport': {'type': 'TCP', 'sport': sport, 'dport': 80, 'flags': flags, 'seq': 0, 'data': b''}}
+    packets = [_packet(1234, ['syn']), _packet(1234, ['psh']), _packet(1234, ['fin_ack']), _packet(5678, ['syn'])]
+    flows = Flows()
+    flows.link(iter(packets))
+    flow = next(flows.output_stream)
+    assert flow['sport'] == 1234 and len(flow['packet_list']) == 3 and flow['state'] == 'complete'
+
+    # Zero timeouts send UDP flows out right away, so every DNS packet is its own flow
+    data_path = file_utils.relative_dir(__file__, '../../data/dns.pcap')
+    streamer = packet_streamer.PacketStreamer(iface_name=data_path)
+    meta = packet_meta.PacketMeta()
+    rdns = reverse_dns.ReverseDNS()
+    tmeta = transport_meta.TransportMeta()
+    flows = Flows(timeouts={'UDP': (0, 0)})
+    meta.link(streamer)
+    rdns.link(meta)
+    tmeta.link(rdns)
+    flows.link(tmeta)
+    assert all(len(flow['packet_list']) == 1 for flow in flows.output_stream)
+
+    # Event time: flows expire by packet timestamps, so the flow table stays small and a late packet gets dropped
+    def _udp_packet(sport, timestamp):
+        packet = _packet(sport, None)
+        packet['timestamp'] = timestamp
+        packet['transport'] = {'type': 'UDP', 'sport': sport, 'dport': 53, 'data': b''}
+        return packet
+    packets = [_udp_packet(1000 + i, float(i)) for i in range(100)] + [_udp_packet(1, 50.0)]
+    flows = Flows(timeouts={'UDP': (2, 10)}, clock='event')
+    flows.link(iter(packets))
+    max_flows = 0
+    for flow in flows.output_stream:
+        max_flows = max(max_flows, len(flows._flows))
+    assert max_flows <= 4
+    assert flows.late_packets == 1
+
+    # Event time gives the same flows every time
+    def _flow_ids(records=False):
+        streamer = packet_streamer.PacketStreamer(iface_name=file_utils.relative_dir(__file__, '../../data/http.pcap'))
+        meta = packet_meta.PacketMeta(fast_decode=records, records=records)
+        rdns = reverse_dns.ReverseDNS()
+        tmeta = transport_meta.TransportMeta()
+        flows = Flows(clock='event')
+        meta.link(streamer)
+        rdns.link(meta)
+        tmeta.link(rdns)
+        flows.link(tmeta)
+        return [(flow['flow_id'], len(flow['packet_list'])) for flow in flows.output_stream]
+    assert _flow_ids() == _flow_ids()
+
+    # Packet records (with the fast path decoder) give the same flows
+    assert _flow_ids(records=True) == _flow_ids()
+
+    # Without the packet list the payloads still get reassembled
+    streamer = packet_streamer.PacketStreamer(iface_name=file_utils.relative_dir(__file__, '../../data/http.pcap'))
+    meta = packet_meta.PacketMeta()
+    rdns = reverse_dns.ReverseDNS()
+    tmeta = transport_meta.TransportMeta()
+    flows = Flows(clock='event', keep_packets=False)
+    meta.link(streamer)
+    rdns.link(meta)
+    tmeta.link(rdns)
+    flows.link(tmeta)
+    responses = []
+    for flow in flows.output_stream:
+        assert flow['packet_list'] == [] and flow['packet_count']
+        if flow['sport'] == 80 and flow['payload']:
+            responses.append(flow['payload'])
+    assert responses and all(payload.startswith(b'HTTP/1.1 200 OK') for payload in responses)
+
+    # Counters only flow records
+    streamer = packet_streamer.PacketStreamer(iface_name=file_utils.relative_dir(__file__, '../../data/http.pcap'))
+    meta = packet_meta.PacketMeta()
+    rdns = reverse_dns.ReverseDNS()
+    tmeta = transport_meta.TransportMeta()
+    flows = Flows(clock='event', counters_only=True)
+    meta.link(streamer)
+    rdns.link(meta)
+    tmeta.link(rdns)
+    flows.link(tmeta)
+    records = list(flows.output_stream)
+    assert sum(record['packet_count'] for record in records) == 43
+    assert [(record['flow_id'], record['packet_count']) for record in records] == _flow_ids()
 
 if __name__ == '__main__':
     test()
@@ -25,32 +25,44 @@ class HTTPMeta(link.Link):
 
         # For each flow process the contents
         for flow in self.input_stream:
-
-            # Client to Server
-            if flow['direction'] == 'CTS':
-                try:
-                    request = dpkt.http.Request(flow['payload'])
-                    request_data = data_utils.make_dict(request)
-                    request_data['uri'] = self._clean_uri(request['uri'])
-                    flow['http'] = {'type':'HTTP_REQUEST', 'data':request_data}
-                except (dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError):
-                    flow['http'] = None
-
-            # Server to Client
-            else:
-                try:
-                    response = dpkt.http.Response(flow['payload'])
-                    flow['http'] = {'type': 'HTTP_RESPONSE', 'data': data_utils.make_dict(response)}
-                except (dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError):
-                    flow['http'] = None
-
-            # Mark non-TCP HTTP
-            if flow['http'] and flow['protocol'] != 'TCP':
-                flow['http'].update({'weird': 'UDP-HTTP'})
+            self._http_meta(flow)
 
             # All done
             yield flow
 
+    def batch_output_stream(self):
+        """Pull out the application metadata for each flow in each batch from the input_stream"""
+        http_meta = self._http_meta
+        for batch in self.input_stream:
+            for flow in batch:
+                http_meta(flow)
+            yield batch
+
+    def _http_meta(self, flow):
+        """Internal method: pull out the application metadata for a single flow"""
+
+        # Client to Server
+        if flow['direction'] == 'CTS':
+            try:
+                request = dpkt.http.Request(flow['payload'])
+                request_data = data_utils.make_dict(request)
+                request_data['uri'] = self._clean_uri(request['uri'])
+                flow['http'] = {'type':'HTTP_REQUEST', 'data':request_data}
+            except (dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError):
+                flow['http'] = None
+
+        # Server to Client
+        else:
+            try:
+                response = dpkt.http.Response(flow['payload'])
+                flow['http'] = {'type': 'HTTP_RESPONSE', 'data': data_utils.make_dict(response)}
+            except (dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError):
+                flow['http'] = None
+
+        # Mark non-TCP HTTP
+        if flow['http'] and flow['protocol'] != 'TCP':
+            flow['http'].update({'weird': 'UDP-HTTP'})
+
     @staticmethod
     def _clean_uri(uri):
         """Clean the URI string"""
@@ -1,29 +1,103 @@
 """
    Links take an input_stream and provides an output_stream. All streams
    are required to be a generator that yields python dictionaries.
+
+   Links can opt in to batch mode (use_batches()), in which case their
+   streams yield lists of python dictionaries instead.
 """
 from __future__ import print_function
 
+import time
 import collections
 
+# Local imports
+from chains.utils import log_utils
+
+# Default number of items in a batch
+DEFAULT_BATCH_SIZE = 256
+
 class Link(object):
     """Link classes take an input_stream and provide an output_stream. All streams
        are required to be a generator that yields python dictionaries.
     """
+
+    # This link (and anything after it) only needs the packet headers, set it on a link class or
+    # instance to tell a capture source upstream it can use a small snaplen
+    headers_only = False
+
     def __init__(self):
         """Initialize Link Class"""
         self._input_stream = None
         self._output_stream = None
+        self._downstream = []
+        self._item_output_stream = None
+        self.batch_size = None
+        self.batch_ms = None
 
     def link(self, stream_instance):
-        """Set my input stream"""
+        """Set my input stream (adapting between per-item and batch streams if needed)"""
         if isinstance(stream_instance, collections.Iterable):
             self.input_stream = stream_instance
         elif getattr(stream_instance, 'output_stream', None):
-            self.input_stream = stream_instance.output_stream
+            stream = stream_instance.output_stream
+            upstream_batched = getattr(stream_instance, 'batched', False)
+            if upstream_batched and not self.batched:
+                stream = from_batches(stream)
+            elif self.batched and not upstream_batched:
+                stream = to_batches(stream, self.batch_size, self.batch_ms)
+            self.input_stream = stream
+            if isinstance(stream_instance, Link):
+                stream_instance._downstream.append(self)
         else:
             raise RuntimeError('Calling link() with unknown instance type %s' % type(stream_instance))
 
+    def use_batches(self, batch_size=DEFAULT_BATCH_SIZE, batch_ms=None):
+        """Switch to batch mode, my streams will exchange lists of items instead of single items
+           Note: Call this before link() (on either side) so the streams get adapted properly
+
+           Args:
+               batch_size: the maximum number of items in a batch (defaults to DEFAULT_BATCH_SIZE)
+               batch_ms: the maximum milliseconds to spend filling a batch, only checked as items
+                         arrive (see to_batches) (defaults to None)
+           Returns:
+               self (so you can do meta = PacketMeta().use_batches())
+        """
+        if self._input_stream is not None or self._downstream:
+            log_utils.panic('Call use_batches() before link() ({:s} is already linked)'.format(
+                self.__class__.__name__))
+        self.batch_size = batch_size
+        self.batch_ms = batch_ms
+
+        # Sinks don't have an output stream
+        if self._output_stream is not None:
+            if self._item_output_stream is None:
+                self._item_output_stream = self._output_stream
+            self.output_stream = self.batch_output_stream()
+        return self
+
+    def only_headers_needed(self):
+        """Do the links after me only need the packet headers?
+
+           Returns:
+               True if every link linked to me is headers_only (or only has headers_only links after it)
+        """
+        return bool(self._downstream) and all(downstream.headers_only or downstream.only_headers_needed()
+                                              for downstream in self._downstream)
+
+    @property
+    def batched(self):
+        """Am I in batch mode?"""
+        return bool(self.batch_size)
+
+    def batch_output_stream(self):
+        """The batch aware version of my output stream. Links can provide their own, by default
+           my per-item output stream runs on the flattened input batches and its output gets
+           grouped into batches again"""
+        if self._input_stream is not None:
+            self._input_stream = from_batches(self._input_stream)
+        for batch in to_batches(self._item_output_stream, self.batch_size, self.batch_ms):
+            yield batch
+
     @property
     def input_stream(self):
         """The input stream property"""
@@ -56,6 +130,44 @@ class Link(object):
             log_utils.panic('The output stream is None!')
         self._output_stream = output_stream
 
+def to_batches(stream, batch_size=DEFAULT_BATCH_SIZE, batch_ms=None):
+    """Adapter: group a per-item stream into batches
+
+       Args:
+           stream: a generator that yields items
+           batch_size: the maximum number of items in a batch
+           batch_ms: the maximum milliseconds to spend filling a batch
+       Returns:
+           generator (list): a generator that yields lists of items
+       Note: batch_ms is only checked as items arrive, so a quiet stream holds its partial
+             batch until the next item shows up (or the stream ends).
+    """
+    batch = []
+    deadline = None
+    for item in stream:
+        if batch_ms and not batch:
+            deadline = time.time() + batch_ms / 1000.0
+        batch.append(item)
+        if len(batch) >= batch_size or (deadline and time.time() >= deadline):
+            yield batch
+            batch = []
+
+    # Partial batch at the end
+    if batch:
+        yield batch
+
+def from_batches(batch_stream):
+    """Adapter: flatten a batch stream into a per-item stream
+
+       Args:
+           batch_stream: a generator that yields lists of items
+       Returns:
+           generator: a generator that yields the individual items
+    """
+    for batch in batch_stream:
+        for item in batch:
+            yield item
+
 def test():
     """Spin up the link class and call the methods"""
 
@@ -66,6 +178,62 @@ def test():
     link2.link(link1)
     print(link2.input_stream)
 
+    # Batch adapters
+    items = [{'num': i} for i in range(10)]
+    batches = list(to_batches(iter(items), batch_size=4))
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+    assert list(from_batches(batches)) == items
+    assert len(list(to_batches(iter(items), batch_size=100, batch_ms=0.001))) > 1
+
+    # Linking batched and per-item links adapts the streams
+    link1 = Link()
+    link1.output_stream = iter(batches)
+    link1.batch_size = 4
+    link2 = Link()
+    link2.link(link1)
+    assert list(link2.input_stream) == items
+    link1 = Link()
+    link1.output_stream = iter(items)
+    link2 = Link()
+    link2.batch_size = 3
+    link2.link(link1)
+    assert [len(batch) for batch in link2.input_stream] == [3, 3, 3, 1]
+
+    # Headers only declarations (every path after a link has to be headers only)
+    source = Link()
+    source.output_stream = iter(items)
+    meta, columns, printer = Link(), Link(), Link()
+    assert not source.only_headers_needed()
+    meta.link(source)
+    meta.output_stream = meta.input_stream
+    columns.headers_only = True
+    columns.link(meta)
+    assert source.only_headers_needed() and meta.only_headers_needed()
+    printer.link(meta)
+    assert not source.only_headers_needed()
+
+    # Links without a batch implementation of their own run their per-item stream on the batches
+    def _double(link):
+        for item in link.input_stream:
+            yield {'num': item['num'] * 2}
+    upstream = Link()
+    upstream.output_stream = iter(batches)
+    upstream.batch_size = 4
+    doubler = Link()
+    doubler.output_stream = _double(doubler)
+    doubler.use_batches(batch_size=3)
+    doubler.link(upstream)
+    assert list(doubler.output_stream) == [[{'num': i * 2} for i in range(start, min(start + 3, 10))]
+                                           for start in range(0, 10, 3)]
+
+    # Too late to switch to batches once linked
+    for linked in [doubler, upstream]:
+        try:
+            linked.use_batches()
+            assert False
+        except RuntimeError:
+            pass
+
 
 if __name__ == '__main__':
     test()
@@ -5,17 +5,32 @@ import dpkt
 
 # Local imports
 from chains.links import link
-from chains.utils import file_utils, data_utils
+from chains.utils import file_utils, data_utils, fast_decode, packet_record
 
 class PacketMeta(link.Link):
     """PacketMeta, Use DPKT to pull out packet information and convert those
-       attributes to a dictionary based output."""
-
-    def __init__(self):
+       attributes to a dictionary based output.
+
+       Args:
+            fast_decode (bool): decode Ethernet/VLAN/IP/IP6/TCP/UDP/ICMP headers with structs
+                                instead of dpkt objects, same output and dpkt for anything else
+                                (defaults to False)
+            records (bool): output compact packet_record.PacketRecord objects (same keys, the
+                            timestamp datetime is only built when it's read) instead of
+                            dictionaries (defaults to False)
+            lazy (bool): output packet_record.LazyPacketRecord objects that keep the raw buffer and
+                         only decode a layer when it's first read, links downstream (TransportMeta,
+                         DNSMeta) defer their work too (defaults to False)
+    """
+
+    def __init__(self, fast_decode=False, records=False, lazy=False):
         """Initialize PacketMeta Class"""
 
         # Call super class init
         super(PacketMeta, self).__init__()
+        self.fast_decode = fast_decode
+        self.records = records
+        self.lazy = lazy
 
         # Set my output
         self.output_stream = self.packet_meta_data()
@@ -29,62 +44,109 @@ class PacketMeta(link.Link):
 
         # For each packet in the pcap process the contents
         for item in self.input_stream:
+            yield self._packet_meta(item)
 
-            # Output object
-            output = {}
-
-            # Grab the fields I need
-            timestamp = item['timestamp']
-            buf = item['raw_buf']
-
-            # Print out the timestamp in UTC
-            output['timestamp'] = datetime.datetime.utcfromtimestamp(timestamp)
-
-            # Unpack the Ethernet frame (mac src/dst, ethertype)
-            eth = dpkt.ethernet.Ethernet(buf)
-            output['eth'] = {'src': eth.src, 'dst': eth.dst, 'type':eth.type, 'len': len(eth)}
-
-            # Grab packet data
-            packet = eth.data
+    def batch_output_stream(self):
+        """Pull out the metadata about each packet in each batch from the input_stream
+           Returns:
+               generator (list): a generator that yields lists of packet meta data dictionaries"""
+        packet_meta = self._packet_meta
+        for batch in self.input_stream:
+            yield [packet_meta(item) for item in batch]
 
-            # Packet Type ('EtherType') (IP, ARP, PPPoE, IP6... see http://en.wikipedia.org/wiki/EtherType)
-            if hasattr(packet, 'data'):
-                output['packet'] = {'type': packet.__class__.__name__, 'data': packet.data}
-            else:
-                output['packet'] = {'type': None, 'data': None}
+    def _packet_meta(self, item):
+        """Internal method: pull out the metadata about a single packet
+           Args:
+               item (dict): a packet from the input_stream (timestamp, raw_buf)
+           Returns:
+               dictionary: the packet meta data"""
+
+        # Grab the fields I need (zero-copy raw buffers become bytes here, so the decoded
+        # fields and payloads downstream are bytes no matter which backend read the packet)
+        timestamp = item['timestamp']
+        buf = item['raw_buf']
+        if isinstance(buf, memoryview):
+            buf = buf.tobytes()
+
+        # Compact (maybe lazy) records
+        if self.lazy:
+            return packet_record.LazyPacketRecord(timestamp, buf, self._record_layers)
+        if self.records:
+            return packet_record.PacketRecord(timestamp, *self._record_layers(buf))
+
+        # Output object
+        output = {}
+
+        # Print out the timestamp in UTC
+        output['timestamp'] = datetime.datetime.utcfromtimestamp(timestamp)
+
+        # Fast path for the common frames (None means this one needs dpkt)
+        layers = fast_decode.decode(buf) if self.fast_decode else None
+        if layers:
+            output['eth'], output['packet'] = layers
+        else:
+            output['eth'], output['packet'] = self._dpkt_layers(buf)
+
+        # For the transport layer we're going to set the transport to None. and
+        # hopefully a 'link' upstream will manage the transport functionality
+        output['transport'] = None
+
+        # For the application layer we're going to set the application to None. and
+        # hopefully a 'link' upstream will manage the application functionality
+        output['application'] = None
+
+        # All done
+        return output
+
+    def _record_layers(self, buf):
+        """Internal method: decode the eth and packet layers as packet_record layers"""
+        layers = fast_decode.decode(buf, records=True) if self.fast_decode else None
+        return layers or packet_record.layers(*self._dpkt_layers(buf))
+
+    @staticmethod
+    def _dpkt_layers(buf):
+        """Internal method: decode the Ethernet and packet layers with dpkt
+           Args:
+               buf: the raw frame
+           Returns:
+               tuple: the eth and packet dictionaries"""
+        output = {}
 
-            # It this an IP packet?
-            if output['packet']['type'] == 'IP':
+        # Unpack the Ethernet frame (mac src/dst, ethertype)
+        eth = dpkt.ethernet.Ethernet(buf)
+        output['eth'] = {'src': eth.src, 'dst': eth.dst, 'type':eth.type, 'len': len(eth)}
 
-                # Pull out fragment information (flags and offset all packed into off field, so use bitmasks)
-                df = bool(packet.off & dpkt.ip.IP_DF)
-                mf = bool(packet.off & dpkt.ip.IP_MF)
-                offset = packet.off & dpkt.ip.IP_OFFMASK
+        # Grab packet data
+        packet = eth.data
 
-                # Pulling out src, dst, length, fragment info, TTL, checksum and Protocol
-                output['packet'].update({'src':packet.src, 'dst':packet.dst, 'p': packet.p, 'len':packet.len, 'ttl':packet.ttl,
-                                         'df':df, 'mf': mf, 'offset': offset, 'checksum': packet.sum})
+        # Packet Type ('EtherType') (IP, ARP, PPPoE, IP6... see http://en.wikipedia.org/wiki/EtherType)
+        if hasattr(packet, 'data'):
+            output['packet'] = {'type': packet.__class__.__name__, 'data': packet.data}
+        else:
+            output['packet'] = {'type': None, 'data': None}
 
-            # Is this an IPv6 packet?
-            elif output['packet']['type'] == 'IP6':
+        # It this an IP packet?
+        if output['packet']['type'] == 'IP':
 
-                # Pulling out the IP6 fields
-                output['packet'].update({'src':packet.src, 'dst':packet.dst, 'p': packet.p, 'len':packet.plen, 'ttl':packet.hlim})
+            # Pull out fragment information (flags and offset all packed into off field, so use bitmasks)
+            df = bool(packet.off & dpkt.ip.IP_DF)
+            mf = bool(packet.off & dpkt.ip.IP_MF)
+            offset = packet.off & dpkt.ip.IP_OFFMASK
 
-            # If the packet isn't IP or IPV6 just pack it as a dictionary
-            else:
-                output['packet'].update(data_utils.make_dict(packet))
+            # Pulling out src, dst, length, fragment info, TTL, checksum and Protocol
+            output['packet'].update({'src':packet.src, 'dst':packet.dst, 'p': packet.p, 'len':packet.len, 'ttl':packet.ttl,
+                                     'df':df, 'mf': mf, 'offset': offset, 'checksum': packet.sum})
 
-            # For the transport layer we're going to set the transport to None. and
-            # hopefully a 'link' upstream will manage the transport functionality
-            output['transport'] = None
+        # Is this an IPv6 packet?
+        elif output['packet']['type'] == 'IP6':
 
-            # For the application layer we're going to set the application to None. and
-            # hopefully a 'link' upstream will manage the application functionality
-            output['application'] = None
+            # Pulling out the IP6 fields
+            output['packet'].update({'src':packet.src, 'dst':packet.dst, 'p': packet.p, 'len':packet.plen, 'ttl':packet.hlim})
 
-            # All done
-            yield output
+        # If the packet isn't IP or IPV6 just pack it as a dictionary
+        else:
+            output['packet'].update(data_utils.make_dict(packet))
+        return output['eth'], output['packet']
 
 def test():
     """Test for PacketMeta class"""
@@ -101,5 +163,54 @@ def test():
     for item in meta.output_stream:
         pprint.pprint(item)
 
+    # Payloads are bytes (the mmap file backend hands over zero-copy memoryviews)
+    from chains.links import transport_meta
+    for fast, lazy in [(False, False), (True, False), (True, True)]:
+        streamer = packet_streamer.PacketStreamer(iface_name=data_path)
+        meta = PacketMeta(fast_decode=fast, lazy=lazy)
+        tmeta = transport_meta.TransportMeta()
+        meta.link(streamer)
+        tmeta.link(meta)
+        transports = [item['transport'] for item in tmeta.output_stream if item['transport']]
+        assert transports and all(type(transport['data']) is bytes for transport in transports)
+
+    # Batch mode should give the same meta data
+    streamer = packet_streamer.PacketStreamer(iface_name=data_path, max_packets=50)
+    meta = PacketMeta()
+    meta.link(streamer)
+    items = list(meta.output_stream)
+    streamer = packet_streamer.PacketStreamer(iface_name=data_path, max_packets=50).use_batches(batch_size=8)
+    meta = PacketMeta().use_batches()
+    meta.link(streamer)
+    batch_items = [item for batch in meta.output_stream for item in batch]
+    assert [item['eth'] for item in batch_items] == [item['eth'] for item in items]
+
+    # The fast path decoder should give the same meta data
+    for pcap in ['http.pcap', 'dns.pcap']:
+        data_path = file_utils.relative_dir(__file__, '../../data/' + pcap)
+        streamer = packet_streamer.PacketStreamer(iface_name=data_path, max_packets=50)
+        meta = PacketMeta()
+        meta.link(streamer)
+        items = list(meta.output_stream)
+        streamer = packet_streamer.PacketStreamer(iface_name=data_path, max_packets=50)
+        meta = PacketMeta(fast_decode=True)
+        meta.link(streamer)
+        fast_items = list(meta.output_stream)
+        assert len(fast_items) == len(items)
+        for item, fast_item in zip(items, fast_items):
+            assert fast_item['eth'] == item['eth']
+            packet = dict(item['packet'], data=None)
+            assert dict(fast_item['packet'], data=None) == packet
+
+    # Records should look just like the dictionaries
+    for fast, lazy in [(False, False), (True, False), (True, True)]:
+        streamer = packet_streamer.PacketStreamer(iface_name=data_path, max_packets=50)
+        meta = PacketMeta(fast_decode=fast, records=True, lazy=lazy)
+        meta.link(streamer)
+        records = list(meta.output_stream)
+        assert [record['eth'] for record in records] == [item['eth'] for item in items]
+        assert [record['timestamp'] for record in records] == [item['timestamp'] for item in items]
+        assert [record['packet']['src'] for record in records] == [item['packet']['src'] for item in items]
+
 if __name__ == '__main__':
     test()
@@ -31,21 +31,34 @@ class PacketTags(link.Link):
 
         # For each packet in the pcap process the contents
         for item in self.input_stream:
+            self._tag_item(item)
 
-            # Make sure it has a tags field (which is a set)
-            if 'tags' not in item:
-                item['tags'] = set()
-
-            # For each tag_methods run it on the item
-            for tag_method in self.tag_methods:
-                item['tags'].add(tag_method(item))
-
-            # Not interested in None tags
-            if None in item['tags']:
-                item['tags'].remove(None)
             # All done
             yield item
 
+    def batch_output_stream(self):
+        """Tag each item in each batch from the input stream"""
+        tag_item = self._tag_item
+        for batch in self.input_stream:
+            for item in batch:
+                tag_item(item)
+            yield batch
+
+    def _tag_item(self, item):
+        """Internal method: run all the tag methods on a single item"""
+
+        # Make sure it has a tags field (which is a set)
+        if 'tags' not in item:
+            item['tags'] = set()
+
+        # For each tag_methods run it on the item
+        for tag_method in self.tag_methods:
+            item['tags'].add(tag_method(item))
+
+        # Not interested in None tags
+        if None in item['tags']:
+            item['tags'].remove(None)
+
     @staticmethod
     def _tag_net_direction(data):
         """Create a tag based on the direction of the traffic"""
@@ -106,5 +119,17 @@ def test():
         dst = item['packet']['dst']
         print('%s --> %s  Tags: %s' % (net_utils.inet_to_str(src), net_utils.inet_to_str(dst), str(list(item['tags']))))
 
+    # Direction tags (link local and loopback addresses are internal too)
+    expected = [('10.0.0.5', '169.254.169.254', 'internal'), ('127.0.0.1', '192.168.1.1', 'internal'),
+                ('fe80::1', '224.0.0.251', 'internal'), ('10.0.0.5', '8.8.8.8', 'outgoing'),
+                ('8.8.8.8', '169.254.1.1', 'incoming')]
+    rdns = reverse_dns.ReverseDNS()
+    rdns.ip_lookup_cache.set('8.8.8.8', 'dns.google')
+    rdns.link(iter([{'packet': {'src': net_utils.str_to_inet(src), 'dst': net_utils.str_to_inet(dst)}}
+                    for src, dst, _direction in expected]))
+    tags = PacketTags()
+    tags.link(rdns)
+    assert [item['tags'] for item in tags.output_stream] == [set([direction]) for _src, _dst, direction in expected]
+
 if __name__ == '__main__':
     test()
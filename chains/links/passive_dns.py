@@ -0,0 +1,122 @@
+"""PassiveDNS, Record the A/AAAA answers that DNSMeta decoded into a passive DNS store
+              (ip address -> queried name) that ReverseDNS can use instead of PTR lookups.
+"""
+from __future__ import print_function
+
+# Local imports
+from chains.links import link
+from chains.utils import file_utils, net_utils, dns_store
+
+# DNS answer types with an ip address in them (A and AAAA)
+ADDRESS_TYPES = {1: 'ip', 28: 'ip6'}
+
+
+class PassiveDNS(link.Link):
+    """Record the A/AAAA answers that DNSMeta decoded into a passive DNS store, goes after DNSMeta.
+       Usage:
+            pdns = PassiveDNS()
+            pdns.link(dns_meta)
+            rdns = ReverseDNS(dns_store=pdns.store)
+            rdns.link(pdns)
+
+       Args:
+           store (DNSStore): the passive DNS store to fill (defaults to a new dns_store.DNSStore())
+       Note: Each answer ip maps to the name in the question, so CNAME chains map back to the
+             name the client asked for.
+    """
+
+    def __init__(self, store=None):
+        """Initialize PassiveDNS Class"""
+
+        # Call super class init
+        super(PassiveDNS, self).__init__()
+
+        self.store = store if store is not None else dns_store.DNSStore()
+
+        # Set my output
+        self.output_stream = self.record_answers()
+
+    def record_answers(self):
+        """Record the answers for each packet in the input_stream (the packets pass through untouched)"""
+        for packet in self.input_stream:
+            if 'dns' in packet:
+                self._record_answers(packet['dns'])
+            yield packet
+
+    def batch_output_stream(self):
+        """Record the answers for each packet in each batch from the input_stream"""
+        record = self._record_answers
+        for batch in self.input_stream:
+            for packet in batch:
+                if 'dns' in packet:
+                    record(packet['dns'])
+            yield batch
+
+    def _record_answers(self, dns):
+        """Internal method: add the A/AAAA answers of a DNS response to the store"""
+        raw_dns = dns['_raw']
+        if not raw_dns['qr'] or raw_dns['rcode'] or not raw_dns['qd']:
+            return
+        name = raw_dns['qd'][0]['name']
+        for answer in raw_dns['an']:
+            field = ADDRESS_TYPES.get(answer['type'])
+            if field and field in answer:
+                self.store.add(net_utils.inet_to_str(answer[field]), name, answer['ttl'])
+
+
+def test():
+    """Test for PassiveDNS class"""
+    from chains.sources import packet_streamer
+    from chains.links import packet_meta, transport_meta, dns_meta, reverse_dns
+
+    # Chain with the passive DNS store feeding ReverseDNS
+    data_path = file_utils.relative_dir(__file__, '../../data/http.pcap')
+    streamer = packet_streamer.PacketStreamer(iface_name=data_path)
+    meta = packet_meta.PacketMeta()
+    tmeta = transport_meta.TransportMeta()
+    dmeta = dns_meta.DNSMeta()
+    pdns = PassiveDNS()
+    rdns = reverse_dns.ReverseDNS(dns_store=pdns.store)
+    meta.link(streamer)
+    tmeta.link(meta)
+    dmeta.link(tmeta)
+    pdns.link(dmeta)
+    rdns.link(pdns)
+
+    # After the DNS answer the web server gets the name the client asked for
+    domains = set()
+    for item in rdns.output_stream:
+        domains.add(item['packet']['dst_domain'])
+    assert 'pagead2.googlesyndication.com' in domains
+    print('Passive DNS entries: %d' % len(pdns.store))
+
+    # Internal hosts stay internal (and get their direction tags) even with a DNS answer
+    from chains.links import packet_tags
+    store = dns_store.DNSStore()
+    store.add('10.0.0.5', 'fileserver.corp', 300)
+    store.add('93.184.216.34', 'example.com', 300)
+    rdns = reverse_dns.ReverseDNS(dns_store=store)
+    rdns.link(iter([{'packet': {'src': net_utils.str_to_inet('10.0.0.5'), 'dst': net_utils.str_to_inet(dst)}}
+                    for dst in ['10.0.0.6', '93.184.216.34']]))
+    tags = packet_tags.PacketTags()
+    tags.link(rdns)
+    output = list(tags.output_stream)
+    assert [item['packet']['src_domain'] for item in output] == ['internal', 'internal']
+    assert [item['packet']['dst_domain'] for item in output] == ['internal', 'example.com']
+    assert [item['tags'] for item in output] == [set(['internal']), set(['outgoing'])]
+
+    # Batches
+    streamer = packet_streamer.PacketStreamer(iface_name=data_path).use_batches(batch_size=8)
+    meta = packet_meta.PacketMeta().use_batches()
+    tmeta = transport_meta.TransportMeta().use_batches()
+    dmeta = dns_meta.DNSMeta().use_batches()
+    batch_pdns = PassiveDNS().use_batches()
+    meta.link(streamer)
+    tmeta.link(meta)
+    dmeta.link(tmeta)
+    batch_pdns.link(dmeta)
+    assert sum(len(batch) for batch in batch_pdns.output_stream) == 43
+    assert len(batch_pdns.store) == len(pdns.store) == 2
+
+if __name__ == '__main__':
+    test()
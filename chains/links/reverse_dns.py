@@ -1,71 +1,264 @@
 """ReverseDNS, Perform a reverse dns lookup on fields in the ip_field_list."""
+import os
+import time
 import socket
+from collections import deque
 
 # Local imports
 from chains.links import link
-from chains.utils import file_utils, net_utils, cache
+from chains.utils import file_utils, net_utils, net_classifier, cache, persistent_cache, ptr_resolver
 
 class ReverseDNS(link.Link):
     """Perform a reverse dns lookup on fields in the ip_field_list."""
 
-    def __init__(self, domain_postfix='_domain'):
+    def __init__(self, domain_postfix='_domain', lookahead=0, resolver=None, lookup_timeout=1.0, pending='pending',
+                 dns_store=None, cache_path=None, classifier=None):
         """Initialize ReverseDNS Class
 
            Args:
                domain_postfix: the string to be appended to the ip fields (e.g. IP.src -> IP.src_domain)
+               lookahead: the number of items held back while their PTR queries are in flight, 0 does
+                          blocking lookups one at a time (defaults to 0)
+               resolver: lookahead only, the resolver address as 'server' or ('server', port) (defaults
+                         to the first nameserver in /etc/resolv.conf)
+               lookup_timeout: lookahead only, seconds an item waits on its lookups (defaults to 1.0)
+               pending: lookahead only, the domain given to an item whose lookups didn't make it in time
+                        (defaults to 'pending')
+               dns_store: a passive DNS store (see PassiveDNS) that gets asked before any lookups, addresses
+                          the classifier tags keep their category (defaults to None)
+               cache_path: keep the lookups in a persistent SQLite cache at this path, shared by every
+                           process using the same path (defaults to None, in process cache)
+               classifier: a NetClassifier, addresses in its networks get the network category (e.g. 'multicast')
+                           instead of a lookup, the INTERNAL_CATEGORIES all get 'internal' (defaults to
+                           net_classifier.DEFAULT_CLASSIFIER)
         """
         # Call super class init
         super(ReverseDNS, self).__init__()
 
         self.domain_postfix = domain_postfix
-        self.ip_lookup_cache = cache.Cache(timeout=600)
+        self.cache_path = cache_path
+        if cache_path:
+            self.ip_lookup_cache = persistent_cache.PersistentCache(cache_path)
+        else:
+            self.ip_lookup_cache = cache.Cache(timeout=600)
+        self.dns_store = dns_store
+        self.classifier = classifier or net_classifier.DEFAULT_CLASSIFIER
+
+        # Lookahead window of (item, unresolved (endpoint, ip_address) list, deadline)
+        self.lookahead = lookahead
+        self.resolver = resolver
+        self.lookup_timeout = lookup_timeout
+        self.pending = pending
+        self._window = deque()
+        self._in_flight = {}
+        self._ptr_resolver = None
 
         # Set my output
-        self.output_stream = self.process_for_rdns()
+        self.output_stream = self.lookahead_rdns() if lookahead else self.process_for_rdns()
 
     def process_for_rdns(self):
         """Look through my input stream for the fields in ip_field_list and
            try to do a reverse dns lookup on those fields.
         """
 
-        # For each packet process the contents
-        for item in self.input_stream:
+        # For each packet process the contents (the cache gets written out even if we're interrupted)
+        try:
+            for item in self.input_stream:
+                self._add_domains(item)
+
+                # All done
+                yield item
+        finally:
+            self._close_cache()
+
+    def lookahead_rdns(self):
+        """Non-blocking version of process_for_rdns, items wait in the lookahead window while their
+           PTR queries are in flight and go out once resolved (or marked pending at the deadline)
+        """
+        self._open_resolver()
+        try:
+            for item in self.input_stream:
+                self._hold_item(item)
+                for ready_item in self._ready_items():
+                    yield ready_item
+
+            # Out of input, give the lookups in flight until their deadline
+            for ready_item in self._ready_items(flush=True):
+                yield ready_item
+        finally:
+            self._close_resolver()
+            self._close_cache()
+
+    def batch_output_stream(self):
+        """Batch version of process_for_rdns, yields each batch once every item has its domains"""
+        add_domains = self._add_domains
+
+        # Lookahead batches hold the same items as the incoming batches did, just shifted
+        if self.lookahead:
+            self._open_resolver()
+            try:
+                for batch in self.input_stream:
+                    for item in batch:
+                        self._hold_item(item)
+                    ready = self._ready_items()
+                    if ready:
+                        yield ready
+                ready = self._ready_items(flush=True)
+                if ready:
+                    yield ready
+            finally:
+                self._close_resolver()
+                self._close_cache()
+            return
+
+        try:
+            for batch in self.input_stream:
+                for item in batch:
+                    add_domains(item)
+                yield batch
+        finally:
+            self._close_cache()
 
-            # Do for both the src and dst
-            for endpoint in ['src', 'dst']:
+    def _add_domains(self, item):
+        """Internal method: set the src/dst domains on a single item"""
 
-                # Sanity check (might be an ARP, whatever... without a src/dst)
-                if endpoint not in item['packet']:
+        # Do for both the src and dst
+        for endpoint in ['src', 'dst']:
 
-                    # Set the domain to None
-                    item['packet'][endpoint+self.domain_postfix] = None
-                    continue
+            # Sanity check (might be an ARP, whatever... without a src/dst)
+            if endpoint not in item['packet']:
 
-                # Convert inet_address to str ip_address
-                ip_address = net_utils.inet_to_str(item['packet'][endpoint])
+                # Set the domain to None
+                item['packet'][endpoint+self.domain_postfix] = None
+                continue
+
+            # Convert inet_address to str ip_address
+            ip_address = net_utils.inet_to_str(item['packet'][endpoint])
+
+            # Cached, local or special? If not look it up at this point
+            domain = self._known_domain(ip_address, item['packet'][endpoint])
+            if domain is None:
+                domain = self._reverse_dns_lookup(ip_address)
+                self.ip_lookup_cache.set(ip_address, domain)
+
+            # Set the domain
+            item['packet'][endpoint+self.domain_postfix] = domain
+
+    def _known_domain(self, ip_address, inet):
+        """Internal method: the domain for an ip address without a lookup
+
+           Args:
+               ip_address: the ip_address (as a str)
+               inet: the raw ip address
+           Returns:
+               the network category (e.g. 'internal' or 'multicast'), the passive DNS name, the cached domain or None
+        """
+        # Is the ip_address internal or special (link local and loopback count as internal)
+        domain = self.classifier.classify(inet)
+        if domain is not None:
+            return 'internal' if domain in net_classifier.INTERNAL_CATEGORIES else domain
 
-                # Is this already in our cache
-                if self.ip_lookup_cache.get(ip_address):
-                    domain = self.ip_lookup_cache.get(ip_address)
+        # Have we seen a DNS answer for it
+        if self.dns_store is not None:
+            domain = self.dns_store.lookup(ip_address)
+            if domain is not None:
+                return domain
 
-                # Is the ip_address local or special
-                elif net_utils.is_internal(ip_address):
-                    domain = 'internal'
-                elif net_utils.is_special(ip_address):
-                    domain = net_utils.is_special(ip_address)
+        # Is this already in our cache
+        return self.ip_lookup_cache.get(ip_address)
 
-                # Look it up at this point
-                else:
-                    domain = self._reverse_dns_lookup(ip_address)
+    def _close_cache(self):
+        """Internal method: write out the persistent cache (if there is one)"""
+        if self.cache_path:
+            self.ip_lookup_cache.close()
 
-                # Set the domain
+    def _open_resolver(self):
+        """Internal method: set up the non-blocking PTR resolver"""
+        server, port = self.resolver if isinstance(self.resolver, tuple) else (self.resolver, 53)
+        self._ptr_resolver = ptr_resolver.PTRResolver(server=server, port=port)
+
+    def _close_resolver(self):
+        """Internal method: tear down the non-blocking PTR resolver"""
+        self._ptr_resolver.close()
+        self._ptr_resolver = None
+        self._in_flight = {}
+
+    def _hold_item(self, item):
+        """Internal method: fill in the domains we already know, send PTR queries for the rest
+           and put the item in the lookahead window
+        """
+        now = time.time()
+        unresolved = []
+        for endpoint in ['src', 'dst']:
+
+            # Sanity check (might be an ARP, whatever... without a src/dst)
+            if endpoint not in item['packet']:
+                item['packet'][endpoint+self.domain_postfix] = None
+                continue
+
+            # Known domain or do we have to ask? (one query per ip address in flight)
+            ip_address = net_utils.inet_to_str(item['packet'][endpoint])
+            domain = self._known_domain(ip_address, item['packet'][endpoint])
+            if domain is not None:
                 item['packet'][endpoint+self.domain_postfix] = domain
+                continue
+            unresolved.append((endpoint, ip_address))
+            if now - self._in_flight.get(ip_address, 0) > self.lookup_timeout:
+                self._ptr_resolver.query(ip_address)
+                self._in_flight[ip_address] = now
+        self._window.append((item, unresolved, now + self.lookup_timeout))
+
+    def _ready_items(self, flush=False):
+        """Internal method: pull the items off the front of the lookahead window that are ready to go
+
+           Args:
+               flush: out of input, wait on the lookups in flight until their deadline (defaults to False)
+           Returns:
+               list: the items (in the order they came in) with their domains set
+        """
+        ready = []
+        window = self._window
+        while window:
 
-                # Cache it
+            # Collect the answers that came in (only waiting when flushing)
+            timeout = max(window[0][2] - time.time(), 0) if flush else 0
+            for ip_address, domain in self._ptr_resolver.answers(timeout=timeout):
                 self.ip_lookup_cache.set(ip_address, domain)
+                self._in_flight.pop(ip_address, None)
 
-            # All done
-            yield item
+            # Items go out in order once resolved, past their deadline, pushed out of the window
+            # or when there's nothing left in flight to wait on
+            now = time.time()
+            in_flight = self._ptr_resolver.in_flight()
+            while window:
+                item, unresolved, deadline = window[0]
+                unresolved[:] = [(endpoint, ip_address) for endpoint, ip_address in unresolved
+                                 if not self._set_cached(item, endpoint, ip_address)]
+                if unresolved and now < deadline and len(window) <= self.lookahead and in_flight:
+                    break
+                for endpoint, _ip_address in unresolved:
+                    item['packet'][endpoint+self.domain_postfix] = self.pending
+                ready.append(window.popleft()[0])
+            if not flush:
+                break
+
+        # Give up on the queries that never got an answer
+        if len(self._in_flight) > self.lookahead:
+            for ip_address in self._ptr_resolver.expire(self.lookup_timeout):
+                self._in_flight.pop(ip_address, None)
+        return ready
+
+    def _set_cached(self, item, endpoint, ip_address):
+        """Internal method: set the domain for an endpoint if the answer is in the cache
+
+           Returns:
+               True if the domain was set
+        """
+        domain = self.ip_lookup_cache.get(ip_address)
+        if domain is None:
+            return False
+        item['packet'][endpoint+self.domain_postfix] = domain
+        return True
 
     @staticmethod
     def _reverse_dns_lookup(ip_address):
@@ -101,5 +294,64 @@ def test():
     for item in dns.output_stream:
         pprint.pprint(item)
 
+    # Lookahead against a local stand-in resolver, 1.2.3.4 never gets an answer
+    local = ptr_resolver._TestResolver({'8.8.8.8': 'dns.google', '8.8.4.4': 'dns.google'}, silent=['1.2.3.4'])
+    ips = ['8.8.8.8', '1.2.3.4', '8.8.4.4', '8.8.8.8', '192.168.1.1', '1.2.3.4']
+    items = [{'packet': {'src': net_utils.str_to_inet(ip), 'dst': net_utils.str_to_inet('10.0.0.1')}} for ip in ips]
+    items.append({'packet': {}})
+    dns = ReverseDNS(lookahead=8, resolver=('127.0.0.1', local.port), lookup_timeout=0.5)
+    dns.link(iter(items))
+    start = time.time()
+    output = list(dns.output_stream)
+    assert time.time() - start < 2.0
+    expected = ['dns.google', 'pending', 'dns.google', 'dns.google', 'internal', 'pending', None]
+    assert output == items
+    assert [item['packet']['src_domain'] for item in output] == expected
+    assert all(item['packet']['dst_domain'] == 'internal' for item in output[:-1])
+    assert local.queries == 3
+
+    # A tiny window pushes unresolved items out right away (never waits on a slow resolver)
+    slow = ptr_resolver._TestResolver({'8.8.8.8': 'dns.google', '8.8.4.4': 'dns.google'}, delay=0.3)
+    slow_items = [{'packet': {'src': net_utils.str_to_inet(ip)}} for ip in ['8.8.8.8', '8.8.4.4', '192.168.1.1']]
+    dns = ReverseDNS(lookahead=1, resolver=('127.0.0.1', slow.port), lookup_timeout=5.0)
+    dns.link(iter(slow_items))
+    start = time.time()
+    output = list(dns.output_stream)
+    assert time.time() - start < 1.0
+    assert [item['packet']['src_domain'] for item in output] == ['pending', 'pending', 'internal']
+    slow.close()
+
+    # Persistent cache, a restart (or another process) doesn't have to ask again
+    import shutil
+    import tempfile
+    temp_dir = tempfile.mkdtemp()
+    cache_path = os.path.join(temp_dir, 'rdns.db')
+    ips = ['8.8.8.8', '8.8.4.4', '10.9.8.7']
+    for _ in range(2):
+        dns = ReverseDNS(lookahead=8, resolver=('127.0.0.1', local.port), cache_path=cache_path)
+        dns.link(iter([{'packet': {'src': net_utils.str_to_inet(ip)}} for ip in ips]))
+        output = list(dns.output_stream)
+        assert [item['packet']['src_domain'] for item in output] == ['dns.google', 'dns.google', 'internal']
+    assert local.queries == 5
+
+    # An interrupted run still writes out its lookups
+    other_path = os.path.join(temp_dir, 'other.db')
+    dns = ReverseDNS(lookahead=8, resolver=('127.0.0.1', local.port), cache_path=other_path)
+    dns.link(iter([{'packet': {'src': net_utils.str_to_inet(ip)}} for ip in ['8.8.4.4', '1.1.1.1', '8.8.8.8']]))
+    output_stream = dns.output_stream
+    next(output_stream)
+    output_stream.close()
+    stored = persistent_cache.PersistentCache(other_path)
+    assert stored.get('8.8.4.4') == 'dns.google'
+    stored.close()
+    shutil.rmtree(temp_dir)
+
+    # Batches
+    dns = ReverseDNS(lookahead=8, resolver=('127.0.0.1', local.port), lookup_timeout=0.5).use_batches()
+    dns.link(iter([[dict(item, packet=dict(item['packet'])) for item in items]]))
+    output = [item for batch in dns.output_stream for item in batch]
+    assert [item['packet']['src_domain'] for item in output] == expected
+    local.close()
+
 if __name__ == '__main__':
     test()
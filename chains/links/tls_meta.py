@@ -28,36 +28,37 @@ class TLSMeta(link.Link):
             # Just TCP for now
             if flow['protocol'] != 'TCP':
                 continue
-
-            # Client to Server
-            if flow['direction'] == 'CTS':
-
-                # Try to process the payload as a set of TLS records
-                try:
-                    tls_records, bytes_consumed = dpkt.ssl.tls_multi_factory(flow['payload'])
-                    if bytes_consumed != len(flow['payload']):
-                        logger.warning('Incomplete TLS record at the end...')
-
-                    # Process the TLS records
-                    flow['tls'] = {'type':'TLS_CTS', 'data':{'tls_records': tls_records, 'uri':None, 'headers':None}}
-                except (dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError, dpkt.ssl.SSL3Exception):
-                    flow['tls'] = None
-
-            # Server to Client
-            else:
-                try:
-                    tls_records, bytes_consumed = dpkt.ssl.tls_multi_factory(flow['payload'])
-                    if bytes_consumed != len(flow['payload']):
-                        logger.warning('Incomplete TLS record at the end...')
-
-                    # Process the TLS records
-                    flow['tls'] = {'type':'TLS_STC', 'data':{'tls_records': tls_records, 'uri':None, 'headers':None}}
-                except (dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError, dpkt.ssl.SSL3Exception):
-                    flow['tls'] = None
+            self._tls_meta(flow)
 
             # All done
             yield flow
 
+    def batch_output_stream(self):
+        """Pull out the TLS metadata for each flow in each batch from the input_stream"""
+        tls_meta = self._tls_meta
+        for batch in self.input_stream:
+
+            # Just TCP for now
+            batch = [flow for flow in batch if flow['protocol'] == 'TCP']
+            for flow in batch:
+                tls_meta(flow)
+            if batch:
+                yield batch
+
+    @staticmethod
+    def _tls_meta(flow):
+        """Internal method: try to process the payload of a single flow as a set of TLS records"""
+        tls_type = 'TLS_CTS' if flow['direction'] == 'CTS' else 'TLS_STC'
+        try:
+            tls_records, bytes_consumed = dpkt.ssl.tls_multi_factory(flow['payload'])
+            if bytes_consumed != len(flow['payload']):
+                logger.warning('Incomplete TLS record at the end...')
+
+            # Process the TLS records
+            flow['tls'] = {'type':tls_type, 'data':{'tls_records': tls_records, 'uri':None, 'headers':None}}
+        except (dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError, dpkt.ssl.SSL3Exception):
+            flow['tls'] = None
+
     def ssl_handshake_processing(tls_records):
         """Process a set of TLS records for a SSL handshake
            In general the order of messages should be the following:
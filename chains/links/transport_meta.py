@@ -3,7 +3,7 @@ import dpkt
 
 # Local imports
 from chains.links import link
-from chains.utils import file_utils, log_utils, data_utils
+from chains.utils import file_utils, log_utils, data_utils, fast_decode, packet_record
 
 
 class TransportMeta(link.Link):
@@ -23,19 +23,51 @@ class TransportMeta(link.Link):
 
         # For each packet in the pcap process the contents
         for item in self.input_stream:
-
-            # Get the transport data and type
-            trans_data = item['packet']['data']
-            trans_type = self._get_transport_type(trans_data)
-            if trans_type and trans_data:
-                item['transport'] = data_utils.make_dict(trans_data)
-                item['transport']['type'] = trans_type
-                item['transport']['flags'] = self._readable_flags(item['transport'])
-                item['transport']['data'] = trans_data['data']
+            self._transport_meta(item)
 
             # All done
             yield item
 
+    def batch_output_stream(self):
+        """Pull out the transport metadata for each packet in each batch from the input_stream"""
+        transport_meta = self._transport_meta
+        for batch in self.input_stream:
+            for item in batch:
+                transport_meta(item)
+            yield batch
+
+    def _transport_meta(self, item):
+        """Internal method: pull out the transport metadata for a single packet"""
+
+        # Lazy records get it when (and if) it's read
+        if isinstance(item, packet_record.LazyPacketRecord):
+            item.defer('transport', self._transport_layer)
+            return
+        transport = self._transport_layer(item)
+        if transport is not None:
+            item['transport'] = transport
+
+    def _transport_layer(self, item):
+        """Internal method: the transport metadata for a single packet (None if it doesn't have any)"""
+
+        # Get the transport data and type
+        trans_data = item['packet']['data']
+        trans_type = self._get_transport_type(trans_data)
+        if not (trans_type and trans_data):
+            return None
+        if isinstance(trans_data, fast_decode.Header):
+            transport = trans_data.to_dict()
+        else:
+            transport = data_utils.make_dict(trans_data)
+        transport['type'] = trans_type
+
+        # Keep the raw TCP flag bits (for flow records) next to the readable list
+        if 'flags' in transport:
+            transport['flag_bits'] = transport['flags']
+        transport['flags'] = self._readable_flags(transport)
+        transport['data'] = trans_data['data']
+        return transport
+
     @staticmethod
     def _get_transport_type(transport):
         """Give the transport as a string or None if not one"""
@@ -94,5 +126,28 @@ def test():
     for item in tmeta.output_stream:
         pprint.pprint(item)
 
+    # Now the same chain in batch mode (the rdns link is left per-item to exercise the adapters)
+    streamer = packet_streamer.PacketStreamer(iface_name=data_path, max_packets=40).use_batches(batch_size=10)
+    meta = packet_meta.PacketMeta().use_batches()
+    rdns = reverse_dns.ReverseDNS()
+    tmeta = TransportMeta().use_batches(batch_size=15)
+    meta.link(streamer)
+    rdns.link(meta)
+    tmeta.link(rdns)
+    batches = list(tmeta.output_stream)
+    assert [len(batch) for batch in batches] == [15, 15, 10]
+    types = [item['transport']['type'] if item['transport'] else None for batch in batches for item in batch]
+    assert 'TCP' in types and 'UDP' in types
+
+    # The fast path decoder should give the same transport meta data
+    def _transports(fast, lazy=False):
+        streamer = packet_streamer.PacketStreamer(iface_name=data_path, max_packets=50)
+        meta = packet_meta.PacketMeta(fast_decode=fast, lazy=lazy)
+        tmeta = TransportMeta()
+        meta.link(streamer)
+        tmeta.link(meta)
+        return [item['transport'] for item in tmeta.output_stream]
+    assert _transports(True) == _transports(False) == _transports(True, lazy=True)
+
 if __name__ == '__main__':
     test()
@@ -17,37 +17,48 @@ class PacketSummary(sink.Sink):
     def pull(self):
         """Print out summary information about each packet from the input_stream"""
 
+        # Batch mode hands us lists of packets
+        if self.batched:
+            for batch in self.input_stream:
+                for item in batch:
+                    self._print_summary(item)
+            return
+
         # For each packet in the pcap process the contents
         for item in self.input_stream:
-
-            # Print out the timestamp in UTC
-            print('%s -' % item['timestamp'], end='')
-
-            # Transport info
-            if item['transport']:
-                print(item['transport']['type'], end='')
-
-            # Print out the Packet info
-            packet_type = item['packet']['type']
-            print(packet_type, end='')
-            packet = item['packet']
-            if packet_type in ['IP', 'IP6']:
-                # Is there domain info?
-                if 'src_domain' in packet:
-                    print('%s(%s) --> %s(%s)' % (net_utils.inet_to_str(packet['src']), packet['src_domain'],
-                                                 net_utils.inet_to_str(packet['dst']), packet['dst_domain']), end='')
-                else:
-                    print('%s --> %s' % (net_utils.inet_to_str(packet['src']), net_utils.inet_to_str(packet['dst'])), end='')
+            self._print_summary(item)
+
+    def _print_summary(self, item):
+        """Internal method: print out summary information about a single packet"""
+
+        # Print out the timestamp in UTC
+        print('%s -' % item['timestamp'], end='')
+
+        # Transport info
+        if item['transport']:
+            print(item['transport']['type'], end='')
+
+        # Print out the Packet info
+        packet_type = item['packet']['type']
+        print(packet_type, end='')
+        packet = item['packet']
+        if packet_type in ['IP', 'IP6']:
+            # Is there domain info?
+            if 'src_domain' in packet:
+                print('%s(%s) --> %s(%s)' % (net_utils.inet_to_str(packet['src']), packet['src_domain'],
+                                             net_utils.inet_to_str(packet['dst']), packet['dst_domain']), end='')
             else:
-                print(str(packet))
+                print('%s --> %s' % (net_utils.inet_to_str(packet['src']), net_utils.inet_to_str(packet['dst'])), end='')
+        else:
+            print(str(packet))
 
-            # Only include application if we have it
-            if item['application']:
-                print('Application: %s' % item['application']['type'], end='')
-                print(str(item['application']), end='')
+        # Only include application if we have it
+        if item['application']:
+            print('Application: %s' % item['application']['type'], end='')
+            print(str(item['application']), end='')
 
-            # Just for newline
-            print()
+        # Just for newline
+        print()
 
 def test():
     """Test for PacketSummary class"""
@@ -72,5 +83,15 @@ def test():
     # Pull the chain
     printer.pull()
 
+    # Pull the chain in batch mode
+    streamer = packet_streamer.PacketStreamer(iface_name=data_path, max_packets=50).use_batches(batch_size=10)
+    meta = packet_meta.PacketMeta().use_batches()
+    rdns = reverse_dns.ReverseDNS().use_batches()
+    printer = PacketSummary().use_batches()
+    meta.link(streamer)
+    rdns.link(meta)
+    printer.link(rdns)
+    printer.pull()
+
 if __name__ == '__main__':
     test()
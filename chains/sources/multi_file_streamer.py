@@ -0,0 +1,229 @@
+"""MultiFileStreamer: Stream the packets from many capture files (or directories of them) as one
+   stream in timestamp order"""
+from __future__ import print_function
+import os
+import heapq
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Local imports
+from chains.links import link
+from chains.sources import source
+from chains.utils import file_utils, log_utils, pcap_reader
+logger = log_utils.get_logger()
+
+
+def capture_files(paths):
+    """The capture files for a path or a list of paths (directories are searched recursively)
+
+       Args:
+           paths: a file/directory path or a list of them
+       Returns:
+           list: the file paths (sorted)
+    """
+    if not isinstance(paths, (list, tuple, set)):
+        paths = [paths]
+    files = []
+    for path in paths:
+        path = os.path.expanduser(path)
+        files += file_utils.all_files_in_directory(path) if os.path.isdir(path) else [path]
+    return sorted(set(files))
+
+
+class MultiFileStreamer(source.Source):
+    """Read many pcap/pcapng files at once (a reader thread per file with a bounded read-ahead)
+       and merge the packets through a heap into one stream sorted by timestamp. The packet_num
+       values run across all the files. Files are only opened once the merge gets to their first
+       timestamp, so rotated captures (that don't overlap) are read one or two at a time.
+       Usage:
+            streamer = MultiFileStreamer('/data/captures/sensor1')
+            for packet in streamer.output_stream:
+                ...
+
+       Args:
+            paths: a capture file, a directory of them or a list of files/directories
+            read_ahead (int): the most packets each reader thread holds (defaults to 4096)
+            max_packets (int): the maximum number of packets to yield (defaults to None)
+       Note: Files that aren't capture files (or have no packets) are skipped with a warning.
+    """
+
+    def __init__(self, paths, read_ahead=4096, max_packets=None):
+        """Initialization for MultiFileStreamer"""
+
+        # Call super class init
+        super(MultiFileStreamer, self).__init__()
+
+        self.paths = paths
+        self.read_ahead = read_ahead
+        self.max_packets = max_packets
+        self.output_stream = self.read_files()
+
+    def read_files(self):
+        """Merge the packets from all the files in timestamp order
+
+           Returns:
+               generator (dictionary): timestamp, raw_buf, packet_num (and file) for each packet
+        """
+        files = self._first_timestamps()
+        stop = threading.Event()
+        readers = []
+        heap = []
+        _packets = 0
+        try:
+            while files or heap:
+
+                # Start the readers for the files that begin before the next packet
+                while files and (not heap or files[0][0] <= heap[0][0]):
+                    _first, rank, file_path = files.pop(0)
+                    packets = self._start_reader(file_path, stop, readers)
+                    self._push(heap, rank, packets)
+
+                # Next packet in timestamp order (ties go to the file that sorts first)
+                timestamp, rank, _num, raw_buf, file_path, packets = heapq.heappop(heap)
+                yield {'timestamp': timestamp, 'raw_buf': raw_buf, 'packet_num': _packets, 'file': file_path}
+                _packets += 1
+                if self.max_packets and _packets >= self.max_packets:
+                    break
+                self._push(heap, rank, packets)
+        finally:
+            stop.set()
+            for reader in readers:
+                reader.join()
+        print('Packet stats: %d read from %d files' % (_packets, len(readers)))
+
+    def batch_output_stream(self):
+        """Merged packets in batches of batch_size packets (or batch_ms milliseconds)"""
+        return link.to_batches(self.read_files(), self.batch_size, self.batch_ms)
+
+    def _first_timestamps(self):
+        """Internal method: the capture files sorted by their first packet timestamp
+
+           Returns:
+               list: (first timestamp, rank, file_path) for each file with packets
+        """
+        files = []
+        for rank, file_path in enumerate(capture_files(self.paths)):
+            try:
+                reader = pcap_reader.PcapReader(file_path)
+            except (RuntimeError, ValueError):
+                logger.warning('Skipping {:s} (not a capture file)'.format(file_path))
+                continue
+            first = next(iter(reader.records()), None)
+            reader.close()
+            if first is None:
+                logger.warning('Skipping {:s} (no packets)'.format(file_path))
+                continue
+            files.append((first[0], rank, file_path))
+        files.sort()
+        return files
+
+    def _start_reader(self, file_path, stop, readers):
+        """Internal method: start a reader thread for a file
+
+           Returns:
+               generator (tuple): (timestamp, raw_buf, file_path) for each packet the thread reads
+        """
+        chunk_size = max(1, min(256, self.read_ahead // 4))
+        chunks = queue.Queue(maxsize=max(1, self.read_ahead // chunk_size))
+        reader = threading.Thread(target=_read_file, args=(file_path, chunks, chunk_size, stop))
+        reader.daemon = True
+        reader.start()
+        readers.append(reader)
+        return _queue_packets(chunks)
+
+    @staticmethod
+    def _push(heap, rank, packets):
+        """Internal method: put the next packet of a file on the heap (if it has one)"""
+        for num, (timestamp, raw_buf, file_path) in packets:
+            heapq.heappush(heap, (timestamp, rank, num, raw_buf, file_path, packets))
+            return
+
+
+def _read_file(file_path, chunks, chunk_size, stop):
+    """Internal method: reader thread, put the packets of a file on the queue in chunks (None at the end)"""
+    reader = pcap_reader.PcapReader(file_path)
+    try:
+        chunk = []
+        for timestamp, raw_buf in reader.packets():
+            chunk.append((timestamp, raw_buf, file_path))
+            if len(chunk) >= chunk_size:
+                if not _put(chunks, chunk, stop):
+                    return
+                chunk = []
+        if chunk:
+            _put(chunks, chunk, stop)
+    finally:
+        reader.close()
+        _put(chunks, None, stop)
+
+def _put(chunks, chunk, stop):
+    """Internal method: put a chunk on the queue unless we've been told to stop"""
+    while not stop.is_set():
+        try:
+            chunks.put(chunk, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _queue_packets(chunks):
+    """Internal method: (num, packet) for each packet the reader thread sends"""
+    num = 0
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            return
+        for packet in chunk:
+            yield num, packet
+            num += 1
+
+
+def test():
+    """Test for MultiFileStreamer"""
+    import struct
+    import shutil
+    import tempfile
+
+    # Deal the packets of a capture file out to a few files (and add some junk)
+    data_path = file_utils.relative_dir(__file__, '../../data/http.pcap')
+    reader = pcap_reader.PcapReader(data_path)
+    packets = [(timestamp, raw_buf.tobytes()) for timestamp, raw_buf in reader.packets()]
+    reader.close()
+    temp_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(temp_dir, 'sub'))
+    for index, name in enumerate(['a.pcap', 'b.pcap', 'sub/c.pcap']):
+        with open(os.path.join(temp_dir, name), 'wb') as pcap_file:
+            pcap_file.write(struct.pack('<IHHiIII', pcap_reader.PCAP_MAGIC_USEC, 2, 4, 0, 0, 65535, 1))
+            for timestamp, raw_buf in packets[index::3]:
+                seconds = int(timestamp)
+                micro_sec = int(round((timestamp - seconds) * 1e6))
+                pcap_file.write(struct.pack('<IIII', seconds, micro_sec, len(raw_buf), len(raw_buf)) + raw_buf)
+    with open(os.path.join(temp_dir, 'notes.txt'), 'w') as notes_file:
+        notes_file.write('not a capture file, but long enough to have a header')
+    open(os.path.join(temp_dir, 'empty.pcap'), 'wb').close()
+
+    # One stream in timestamp order, numbered across the files (with a tiny read-ahead)
+    streamer = MultiFileStreamer(temp_dir, read_ahead=4)
+    merged = list(streamer.output_stream)
+    assert [packet['packet_num'] for packet in merged] == list(range(len(packets)))
+    assert sorted((packet['timestamp'], packet['raw_buf'].tobytes()) for packet in merged) == sorted(packets)
+    assert [packet['timestamp'] for packet in merged] == sorted(packet['timestamp'] for packet in merged)
+    for name in ['a.pcap', 'b.pcap', 'sub/c.pcap']:
+        file_packets = [packet['raw_buf'].tobytes() for packet in merged if packet['file'].endswith(name)]
+        assert file_packets == [raw_buf for _ts, raw_buf in packets[['a.pcap', 'b.pcap', 'sub/c.pcap'].index(name)::3]]
+    assert set(packet['file'] for packet in merged) == set(capture_files(temp_dir)) - set(
+        [os.path.join(temp_dir, 'notes.txt'), os.path.join(temp_dir, 'empty.pcap')])
+
+    # Non-overlapping files (like rotated captures), max packets and batches
+    streamer = MultiFileStreamer([file_utils.relative_dir(__file__, '../../data/dns.pcap'), data_path], max_packets=50)
+    merged = list(streamer.output_stream)
+    assert len(merged) == 50 and [packet['file'].endswith('http.pcap') for packet in merged] == [True] * 43 + [False] * 7
+    streamer = MultiFileStreamer(temp_dir).use_batches(batch_size=10)
+    assert [len(batch) for batch in streamer.output_stream] == [10, 10, 10, 10, 3]
+    shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    test()
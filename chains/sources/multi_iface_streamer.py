@@ -0,0 +1,167 @@
+"""MultiInterfaceStreamer: Capture from several network interfaces at once as one stream"""
+from __future__ import print_function
+import threading
+
+# Local imports
+from chains.links import link
+from chains.sources import source, packet_streamer
+from chains.utils import file_utils, log_utils, reorder_buffer, ring_buffer
+
+
+class MultiInterfaceStreamer(source.Source):
+    """Capture from several interfaces (SPAN ports, taps, ...), each with its own capture thread
+       and ring buffer, and merge them into one stream. A small reorder buffer keeps the output
+       roughly in timestamp order (packets are held for at most max_skew_ms). Each packet is
+       tagged with the interface it came from.
+       Usage:
+            streamer = MultiInterfaceStreamer(['eth1', 'eth2'], bpf='tcp')
+            for packet in streamer.output_stream:
+                print(packet['iface'], packet['timestamp'])
+
+       Args:
+            iface_names (list): The network interfaces to capture packets from (capture files work too)
+            bpf (str): BPF filter for all the interfaces (defaults to None)
+            max_packets (int): Set the maximum number of packets to yield (default to None)
+            max_skew_ms (float): How far out of timestamp order the interfaces can be (defaults to 50)
+            ring_size (int): The number of packets each capture thread can buffer (defaults to 65536)
+            drop_policy (str): When a ring buffer is full, 'drop_newest' or 'drop_oldest' (defaults to 'drop_newest')
+            snaplen (int): The most bytes to capture per packet (defaults to None, 65536 or HEADERS_SNAPLEN
+                           when all the links after this one are headers_only)
+       Note: Packets that show up more than max_skew_ms late still go out (just out of order), they're counted in
+             the 'late' stat. Requires pcapy (pip install pcapy)
+    """
+
+    def __init__(self, iface_names, bpf=None, max_packets=None, max_skew_ms=50, ring_size=65536,
+                 drop_policy='drop_newest', snaplen=None):
+        """Initialization for MultiInterfaceStreamer"""
+
+        # Call super class init
+        super(MultiInterfaceStreamer, self).__init__()
+
+        # Sanity check the interfaces and drop policy
+        if not iface_names:
+            log_utils.panic('MultiInterfaceStreamer needs a list of interfaces')
+        if drop_policy not in ring_buffer.DROP_POLICIES:
+            log_utils.panic('Unknown drop policy: {:s}'.format(drop_policy))
+
+        # A capture thread streamer for each interface
+        self.iface_names = list(iface_names)
+        self.streamers = [packet_streamer.PacketStreamer(iface_name=iface_name, bpf=bpf, file_backend='pcapy',
+                                                         capture_thread=True, ring_size=ring_size,
+                                                         drop_policy=drop_policy, snaplen=snaplen)
+                          for iface_name in self.iface_names]
+        self.max_packets = max_packets
+        self.max_skew_ms = max_skew_ms
+        self.reorder = reorder_buffer.ReorderBuffer(max_skew_ms=max_skew_ms, max_items=ring_size)
+        self.packet_counts = dict((iface_name, 0) for iface_name in self.iface_names)
+        self.output_stream = self.read_interfaces()
+
+    def get_stats(self):
+        """Get the per interface counters (callable while the stream is running)
+
+           Returns:
+               dict: for each interface the PacketStreamer stats (received, dropped, if_dropped, ring_dropped,
+                     ring_buffered, ring_high_water) and the packets it yielded
+        """
+        stats = {}
+        for streamer in self.streamers:
+            stats[streamer.iface_name] = dict(streamer.get_stats(), packets=self.packet_counts[streamer.iface_name])
+        return stats
+
+    def read_interfaces(self):
+        """Merge the packets from all the interfaces
+
+           Returns:
+               generator (dictionary): timestamp, raw_buf, packet_num and iface for each packet
+        """
+        stop = threading.Event()
+        wakeup = threading.Event()
+
+        # Our links decide the snaplen for the streamers (they don't have any links of their own)
+        if self.only_headers_needed():
+            for streamer in self.streamers:
+                streamer.snaplen = streamer.snaplen or packet_streamer.HEADERS_SNAPLEN
+        rings = [(streamer.iface_name, streamer.start_capture(stop, wakeup)) for streamer in self.streamers]
+
+        # Wake up at least twice per skew period to release the packets that have waited long enough
+        poll = self.max_skew_ms / 2000.0
+        _packets = 0
+        try:
+            while rings:
+                wakeup.wait(poll)
+                wakeup.clear()
+                rings = [(iface_name, ring) for iface_name, ring in rings if self._drain(iface_name, ring)]
+                for timestamp, (iface_name, raw_buf) in self.reorder.pop_ready() if rings else self.reorder.flush():
+                    yield {'timestamp': timestamp, 'raw_buf': raw_buf, 'packet_num': _packets, 'iface': iface_name}
+                    _packets += 1
+                    self.packet_counts[iface_name] += 1
+
+                    # Is there a max packets set if so break on it
+                    if self.max_packets and _packets >= self.max_packets:
+                        return
+        finally:
+            stop.set()
+            self._report(_packets)
+
+    def batch_output_stream(self):
+        """Merged packets in batches of batch_size packets (or batch_ms milliseconds)"""
+        return link.to_batches(self.read_interfaces(), self.batch_size, self.batch_ms)
+
+    def _drain(self, iface_name, ring):
+        """Internal method: move everything in a ring buffer into the reorder buffer
+
+           Returns:
+               bool: False when the capture is over (and the ring is empty)
+        """
+        closed = ring.closed
+        while True:
+            packets = ring.get_many(timeout=0)
+            if not packets:
+                break
+            for timestamp, raw_buf in packets:
+                self.reorder.push(timestamp, (iface_name, raw_buf))
+        return not closed
+
+    def _report(self, num_packets):
+        """Internal method: all done so print out a small report"""
+        print('Packet stats: %d merged from %d interfaces, %d late' % (num_packets, len(self.streamers), self.reorder.late))
+        for iface_name, stats in sorted(self.get_stats().items()):
+            print('    %s: %d packets, %d dropped, %d dropped by interface, %d ring dropped' %
+                  (iface_name, stats['packets'], stats.get('dropped', 0), stats.get('if_dropped', 0),
+                   stats.get('ring_dropped', 0)))
+
+
+def test():
+    """Test for MultiInterfaceStreamer (capture files stand in for the interfaces)"""
+    data_files = ['../../data/http.pcap', '../../data/dns.pcap', '../../data/https.pcap']
+    data_paths = [file_utils.relative_dir(__file__, data_file) for data_file in data_files]
+    expected = dict((data_path, [packet['raw_buf'] for packet in
+                                 packet_streamer.PacketStreamer(iface_name=data_path, file_backend='pcapy').output_stream])
+                    for data_path in data_paths)
+
+    # Every packet, tagged with its interface and in order within each interface
+    streamer = MultiInterfaceStreamer(data_paths, max_skew_ms=20)
+    packets = list(streamer.output_stream)
+    assert [packet['packet_num'] for packet in packets] == list(range(sum(len(bufs) for bufs in expected.values())))
+    for data_path in data_paths:
+        iface_packets = [packet for packet in packets if packet['iface'] == data_path]
+        assert [packet['raw_buf'] for packet in iface_packets] == expected[data_path]
+        assert streamer.get_stats()[data_path]['packets'] == len(expected[data_path])
+        assert streamer.get_stats()[data_path]['ring_dropped'] == 0
+
+    # Max packets and batches
+    streamer = MultiInterfaceStreamer(data_paths[:2], max_packets=30)
+    assert len(list(streamer.output_stream)) == 30
+    streamer = MultiInterfaceStreamer(data_paths[:2]).use_batches(batch_size=20)
+    assert sum(len(batch) for batch in streamer.output_stream) == 43 + 38
+
+    # Bad arguments
+    for args in [{'iface_names': []}, {'iface_names': data_paths, 'drop_policy': 'drop_everything'}]:
+        try:
+            MultiInterfaceStreamer(**args)
+            assert False
+        except RuntimeError:
+            pass
+
+if __name__ == '__main__':
+    test()
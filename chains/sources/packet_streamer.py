@@ -1,13 +1,23 @@
 """PacketStreamer: Stream packets from a network interface"""
 from __future__ import print_function
 import os
-import pcapy
+import time
+import struct
+import threading
+try:
+    import pcapy
+except ImportError:
+    pcapy = None
 
 # Local imports
 from chains.sources import source
-from chains.utils import file_utils, log_utils
+from chains.utils import file_utils, log_utils, pcap_reader, ring_buffer, af_packet
 logger = log_utils.get_logger()
 
+# Snaplen for pipelines that only need headers, enough for Ethernet, two VLAN tags and
+# IPv4/TCP headers with all their options (14 + 8 + 60 + 60 = 142, rounded up)
+HEADERS_SNAPLEN = 160
+
 
 class PacketStreamer(source.Source):
     """Stream out the packets from the given network interface
@@ -17,16 +27,49 @@ class PacketStreamer(source.Source):
                               open the first available network interface. You can also set this to a filename (iface_name = 'test.pcap')
             bpf (str): BPF (Berkeley Packet Filter http://biot.com/capstats/bpf.html) (defaults to '*')
             max_packets (int): Set the maximum number of packets to yield (default to None)
+            file_backend (str): How to read capture files, 'mmap' (pure Python, zero-copy memoryview raw_buf,
+                                PacketMeta turns it into bytes) or 'pcapy' (defaults to 'mmap')
+            capture_thread (bool): Drain pcapy on a dedicated thread into a ring buffer so a stalled pipeline
+                                   doesn't overflow the kernel buffer (defaults to False)
+            ring_size (int): The number of packets the capture thread can buffer (defaults to 65536)
+            drop_policy (str): When the ring buffer is full, 'drop_newest' or 'drop_oldest' (defaults to 'drop_newest')
+            live_backend (str): How to capture from interfaces, 'pcapy' or 'af_packet' (Linux TPACKET_V3 memory
+                                mapped ring, see af_packet.PacketRing) (defaults to 'pcapy')
+            block_size (int): The af_packet ring block size in bytes (defaults to 1MB)
+            block_count (int): The number of af_packet ring blocks (defaults to 64)
+            fanout_group (int): The af_packet PACKET_FANOUT group to join, so several processes can split the
+                                interface's traffic (defaults to None)
+            fanout_mode (str): How the fanout group splits the traffic, see af_packet.FANOUT_MODES (defaults to 'hash')
+            snaplen (int): The most bytes to capture per packet on live interfaces (defaults to None, 65536 or
+                           HEADERS_SNAPLEN when all the links after this one are headers_only)
+            buffer_size (int): The kernel capture buffer size in bytes (defaults to None, the libpcap default)
+            timeout_ms (int): The live read timeout (defaults to None, 0 or 100 with the capture thread)
+            immediate (bool): Hand packets over as soon as they arrive instead of filling the buffer first
+                              (libpcap immediate mode, or a 1ms timeout when pcapy can't set it) (defaults to False)
+            dispatch_count (int): The most packets per pcapy dispatch() call (defaults to 256)
      """
 
-    def __init__(self, iface_name=None, bpf=None, max_packets=None):
+    def __init__(self, iface_name=None, bpf=None, max_packets=None, file_backend='mmap',
+                 capture_thread=False, ring_size=65536, drop_policy='drop_newest', live_backend='pcapy',
+                 block_size=1 << 20, block_count=64, fanout_group=None, fanout_mode='hash',
+                 snaplen=None, buffer_size=None, timeout_ms=None, immediate=False, dispatch_count=256):
         """Initialization for PacketStreamer"""
 
         # Call super class init
         super(PacketStreamer, self).__init__()
 
+        # Sanity check the file backend and drop policy
+        if file_backend not in ['mmap', 'pcapy']:
+            log_utils.panic('Unknown file backend: {:s}'.format(file_backend))
+        if drop_policy not in ring_buffer.DROP_POLICIES:
+            log_utils.panic('Unknown drop policy: {:s}'.format(drop_policy))
+        if live_backend not in ['pcapy', 'af_packet']:
+            log_utils.panic('Unknown live backend: {:s}'.format(live_backend))
+
         # Check if the interface name was specified, if not set it to the first device
         if not iface_name:
+            if not pcapy:
+                log_utils.panic('Live capture requires pcapy (pip install pcapy)')
             devices = pcapy.findalldevs()
             iface_name = devices[0]
             print('Auto Setting Interface to: {:s}'.format(iface_name))
@@ -35,7 +78,23 @@ class PacketStreamer(source.Source):
         self.iface_name = iface_name
         self.bpf = bpf
         self.max_packets = max_packets
+        self.file_backend = file_backend
+        self.capture_thread = capture_thread
+        self.ring_size = ring_size
+        self.drop_policy = drop_policy
+        self.live_backend = live_backend
+        self.block_size = block_size
+        self.block_count = block_count
+        self.fanout_group = fanout_group
+        self.fanout_mode = fanout_mode
+        self.snaplen = snaplen
+        self.buffer_size = buffer_size
+        self.timeout_ms = timeout_ms
+        self.immediate = immediate
+        self.dispatch_count = dispatch_count
         self.pcap = None
+        self.ring = None
+        self.packet_ring = None
         self.output_stream = self.read_interface()
 
     def get_interface(self):
@@ -52,7 +111,30 @@ class PacketStreamer(source.Source):
            Returns:
                The BSP filter specification
         """
-        return self.pcap.filter
+        return self.bpf
+
+    def get_stats(self):
+        """Get the live capture counters (callable while the stream is running)
+
+           Returns:
+               dict: kernel counters from pcap.stats() (received, dropped, if_dropped) and, when
+                     using the capture thread, the ring buffer counters (ring_dropped, ring_buffered, ring_high_water)
+        """
+        stats = {}
+        if self.packet_ring:
+            ring_stats = self.packet_ring.get_stats()
+            stats['received'], stats['dropped'], stats['if_dropped'] = ring_stats['received'], ring_stats['dropped'], 0
+        if self.pcap:
+            try:
+                stats['received'], stats['dropped'], stats['if_dropped'] = self.pcap.stats()
+            except pcapy.PcapError:
+                pass
+        if self.ring is not None:
+            ring_stats = self.ring.stats()
+            stats['ring_dropped'] = ring_stats['dropped']
+            stats['ring_buffered'] = ring_stats['buffered']
+            stats['ring_high_water'] = ring_stats['high_water']
+        return stats
 
     def _iface_is_file(self):
         """Check if the iterface given is a file
@@ -64,22 +146,174 @@ class PacketStreamer(source.Source):
 
     def read_interface(self):
         """Read Packets from the packet capture interface"""
+        packets = self._capture_packets()
+
+        # For each packet in the pcap process the contents
+        _packets = 0
+        for timestamp, raw_buf in packets:
+            yield {'timestamp': timestamp, 'raw_buf': raw_buf, 'packet_num': _packets}
+            _packets += 1
+
+            # Is there a max packets set if so break on it
+            if self.max_packets and _packets >= self.max_packets:
+                break
+        packets.close()
+        self._report(_packets)
+
+    def batch_output_stream(self):
+        """Read Packets from the packet capture interface in batches of batch_size packets (or batch_ms milliseconds)"""
+        packets = self._capture_packets()
+        batch_size = self.batch_size
+        batch_ms = self.batch_ms / 1000.0 if self.batch_ms else None
+
+        # Build the batches right here rather than resuming a per-packet generator
+        _packets = 0
+        batch = []
+        deadline = None
+        for timestamp, raw_buf in packets:
+            if batch_ms and not batch:
+                deadline = time.time() + batch_ms
+            batch.append({'timestamp': timestamp, 'raw_buf': raw_buf, 'packet_num': _packets})
+            _packets += 1
+
+            # Is there a max packets set if so break on it
+            if self.max_packets and _packets >= self.max_packets:
+                break
+
+            # Is the batch full (or have we spent too long filling it)?
+            if len(batch) >= batch_size or (deadline and time.time() >= deadline):
+                yield batch
+                batch = []
+        packets.close()
+
+        # Partial batch at the end
+        if batch:
+            yield batch
+        self._report(_packets)
+
+    def _capture_packets(self):
+        """Internal method: pick the capture backend
+
+           Returns:
+               generator (tuple): (timestamp, raw_buf) for each captured packet
+        """
+        # Memory mapped capture files don't need pcapy at all
+        if self._iface_is_file() and self.file_backend == 'mmap':
+            return self._read_mmap_file()
+
+        # The AF_PACKET ring is already a big buffer between the kernel and us
+        if not self._iface_is_file() and self.live_backend == 'af_packet':
+            return self._read_af_packet()
+
+        # The capture thread needs a read timeout so it can notice when we're done
+        if self.capture_thread:
+            stop = threading.Event()
+            return self._read_ring_buffer(self.start_capture(stop), stop)
+        self._open_pcapy(timeout_ms=self.timeout_ms or 0)
+        return self._read_pcapy()
+
+    def _capture_snaplen(self):
+        """Internal method: the snaplen for live captures
+
+           Returns:
+               int: the snaplen argument, or HEADERS_SNAPLEN when the links after us only need headers (else 65536)
+        """
+        if self.snaplen:
+            return self.snaplen
+        if self.only_headers_needed():
+            print('Headers only pipeline, setting the snaplen to %d' % HEADERS_SNAPLEN)
+            return HEADERS_SNAPLEN
+        return 65536
+
+    def _report(self, num_packets):
+        """Internal method: all done so print out a small report"""
+        if not self.pcap and not self.packet_ring:
+            print('Packet stats: %d read from %s' % (num_packets, self.iface_name))
+            return
+        stats = self.get_stats()
+        if 'received' in stats:
+            print('Packet stats: %d  received, %d dropped,  %d dropped by interface' %
+                  (stats['received'], stats['dropped'], stats['if_dropped']))
+        else:
+            print('No stats available...')
+        if self.ring is not None:
+            print('Ring buffer stats: %d dropped (%s), %d high water' %
+                  (stats['ring_dropped'], self.drop_policy, stats['ring_high_water']))
+
+    def _read_mmap_file(self):
+        """Internal method: read packets from a memory mapped pcap/pcapng file
+
+           Returns:
+               generator (tuple): (timestamp, raw_buf) where raw_buf is a zero-copy memoryview
+        """
+        reader = pcap_reader.PcapReader(self.iface_name)
+
+        # BPF on a file still needs pcapy to compile the filter (and a copy of each buffer to run it)
+        bpf = None
+        if self.bpf:
+            if not pcapy:
+                log_utils.panic('BPF filters require pcapy (pip install pcapy)')
+            bpf = pcapy.compile(reader.linktype, reader.snaplen or 65536, self.bpf, 1, 0)
+        print('reading %s: %s' % (self.iface_name, self.bpf))
+
+        try:
+            for timestamp, raw_buf in reader.packets():
+                if bpf and not bpf.filter(raw_buf.tobytes()):
+                    continue
+                yield timestamp, raw_buf
+        finally:
+            reader.close()
+
+    def _read_af_packet(self):
+        """Internal method: read packets from an AF_PACKET TPACKET_V3 ring
+
+           Returns:
+               generator (tuple): (timestamp, raw_buf) where raw_buf is copied out of the ring (downstream links
+                                  can keep packets around, the ring blocks get reused by the kernel)
+        """
+        # The BPF gets compiled by pcapy and attached to the socket
+        # (the accept instructions return the snaplen, so the kernel only copies that much)
+        snaplen = self._capture_snaplen()
+        bpf = [(0x06, 0, 0, snaplen)] if snaplen < 65536 else None
+        if self.bpf:
+            if not pcapy:
+                log_utils.panic('BPF filters require pcapy (pip install pcapy)')
+            bpf = pcapy.compile(1, snaplen, self.bpf, 1, 0).get_bpf()
+        try:
+            self.packet_ring = af_packet.PacketRing(self.iface_name, block_size=self.block_size,
+                                                    block_count=self.block_count, fanout_group=self.fanout_group,
+                                                    fanout_mode=self.fanout_mode, bpf=bpf)
+        except OSError as error:
+            log_utils.panic('Could not open an AF_PACKET ring on {:s} (may need to be sudo): {:s}'.format(
+                self.iface_name, str(error)))
+        print('listening on %s (af_packet): %s' % (self.iface_name, self.bpf))
+        try:
+            for packet in self.packet_ring.packets():
+                yield packet
+        finally:
+            self.packet_ring.close()
+
+    def _open_pcapy(self, timeout_ms):
+        """Internal method: open the pcapy capture (live interface or file)
+
+           Args:
+               timeout_ms: the read timeout for live captures (0 blocks until a packet arrives)
+        """
+        if not pcapy:
+            log_utils.panic('The pcapy backend requires pcapy (pip install pcapy)')
 
         # Spin up the packet capture
         if self._iface_is_file():
             self.pcap = pcapy.open_offline(self.iface_name)
         else:
+            snaplen = self._capture_snaplen()
             try:
-                # self.pcap = pcap.pcap(name=self.iface_name, promisc=True, immediate=True)
-                #   snaplen (maximum number of bytes to capture _per_packet_)
-                #   promiscious mode (1 for true)
-                #   timeout (in milliseconds)
-                self.pcap = pcapy.open_live(self.iface_name, 65536, 1, 0)
-            except OSError:
+                self.pcap = self._open_live(snaplen, 1, timeout_ms)
+            except (OSError, pcapy.PcapError):
                 try:
                     logger.warning('Could not get promisc mode, turning flag off')
-                    self.pcap = pcapy.open_live(self.iface_name, 65536, 0, 0)
-                except OSError:
+                    self.pcap = self._open_live(snaplen, 0, timeout_ms)
+                except (OSError, pcapy.PcapError):
                     log_utils.panic('Could no open interface with any options (may need to be sudo)')
 
         # Add the BPF if it's specified
@@ -87,33 +321,152 @@ class PacketStreamer(source.Source):
             self.pcap.setfilter(self.bpf)
         print('listening on %s: %s' % (self.iface_name, self.bpf))
 
-        # For each packet in the pcap process the contents
-        _packets = 0
-        while True:
-            # Grab the next header and packet buffer
-            header, raw_buf = self.pcap.next()
+    def _open_live(self, snaplen, promisc, timeout_ms):
+        """Internal method: create, configure and activate a live pcapy capture
 
-            # If we don't get a packet header break out of the loop
-            if not header:
-                break
+           Args:
+               snaplen: maximum number of bytes to capture per packet
+               promisc: promiscuous mode (1 for true)
+               timeout_ms: the read timeout (in milliseconds)
+           Returns:
+               the activated pcapy capture
+        """
+        # Older pcapy can only do open_live (no buffer size or immediate mode)
+        if not hasattr(pcapy, 'create'):
+            if self.buffer_size:
+                logger.warning('This pcapy can not set the buffer size, using the default')
+            return pcapy.open_live(self.iface_name, snaplen, promisc, 1 if self.immediate else timeout_ms)
+        pcap = pcapy.create(self.iface_name)
+
+        # Without immediate mode support a short timeout is the next best thing
+        if self.immediate and hasattr(pcap, 'set_immediate_mode'):
+            pcap.set_immediate_mode(1)
+        elif self.immediate:
+            timeout_ms = 1
+        pcap.set_snaplen(snaplen)
+        pcap.set_promisc(promisc)
+        pcap.set_timeout(timeout_ms)
+        if self.buffer_size:
+            pcap.set_buffer_size(self.buffer_size)
 
-            # Extract the timestamp from the header and yield the packet
+        # Negative status codes are errors (positive ones are just warnings)
+        status = pcap.activate()
+        if status < 0:
+            raise pcapy.PcapError('Could not activate {:s} (status {:d})'.format(self.iface_name, status))
+        return pcap
+
+    def _read_pcapy(self):
+        """Internal method: read packets from the pcapy capture with dispatch() (a batch of packets per call)
+
+           Returns:
+               generator (tuple): (timestamp, raw_buf)
+        """
+        is_file = self._iface_is_file()
+        packets = []
+
+        def _collect(header, raw_buf):
             seconds, micro_sec = header.getts()
-            timestamp = seconds + micro_sec * 10**-6
-            yield {'timestamp': timestamp, 'raw_buf': raw_buf, 'packet_num': _packets}
-            _packets += 1
+            packets.append((seconds + micro_sec * 10**-6, raw_buf))
 
-            # Is there a max packets set if so break on it
-            if self.max_packets and _packets >= self.max_packets:
-                break
+        while True:
+            # Nothing back means the end of the file (or a read timeout on a live interface)
+            self.pcap.dispatch(self.dispatch_count, _collect)
+            if not packets:
+                if is_file:
+                    break
+                continue
+            for packet in packets:
+                yield packet
+            del packets[:]
+
+    def start_capture(self, stop, wakeup=None):
+        """Open the capture and start the capture thread (sources that merge several
+           streamers drain the ring buffers themselves)
 
-        # All done so print out a small report
+           Args:
+               stop: a threading.Event that tells the capture thread we're done
+               wakeup: a threading.Event the ring buffer sets when packets come in (defaults to None)
+           Returns:
+               RingBuffer: the ring buffer of (timestamp, raw_buf), closed when the capture ends
+        """
+        self._open_pcapy(timeout_ms=self.timeout_ms or 100)
+        self.ring = ring_buffer.RingBuffer(capacity=self.ring_size, drop_policy=self.drop_policy, wakeup=wakeup)
+        thread = threading.Thread(target=self._capture_loop, args=(self.ring, stop))
+        thread.daemon = True
+        thread.start()
+        return self.ring
+
+    def _read_ring_buffer(self, ring, stop):
+        """Internal method: read packets that the capture thread put into the ring buffer
+
+           Returns:
+               generator (tuple): (timestamp, raw_buf)
+        """
+        # Drain whatever is buffered in one go (one lock per chunk rather than per packet)
         try:
-            print('Packet stats: %d  received, %d dropped,  %d dropped by interface' % self.pcap.stats())
-        except pcapy.PcapError:
-            print('No stats available...')
+            while True:
+                packets = ring.get_many(timeout=0.1)
+                if not packets:
+                    if ring.closed and not len(ring):
+                        break
+                    continue
+                for packet in packets:
+                    yield packet
+        finally:
+            stop.set()
+
+    def _capture_loop(self, ring, stop):
+        """Internal method: the capture thread, drains pcapy into the ring buffer until told to stop
+
+           Args:
+               ring: the RingBuffer to put (timestamp, raw_buf) tuples into
+               stop: a threading.Event that tells the thread we're done
+        """
+        is_file = self._iface_is_file()
+
+        def _collect(header, raw_buf):
+            seconds, micro_sec = header.getts()
+            ring.put((seconds + micro_sec * 10**-6, raw_buf))
+
+        try:
+            while not stop.is_set():
+                # Nothing back means end of file (or a read timeout on a live interface)
+                if not self.pcap.dispatch(self.dispatch_count, _collect) and is_file:
+                    break
+        finally:
+            ring.close()
 
 
+def _loopback_capture(headers_only=False, max_packets=10, **kwargs):
+    """Capture numbered UDP datagrams (1000 byte payloads) sent over loopback for the test"""
+    import socket
+    from chains.links import link
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    done = threading.Event()
+
+    def _send():
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for num in range(5000):
+            if done.wait(0.001):
+                break
+            sender.sendto(b'chains test' + b'.' * 985 + struct.pack('!I', num), receiver.getsockname())
+        sender.close()
+    sender = threading.Thread(target=_send)
+    sender.start()
+
+    # Pull the packets through a (maybe headers only) link
+    streamer = PacketStreamer(iface_name='lo', bpf='udp dst port %d' % receiver.getsockname()[1],
+                              max_packets=max_packets, **kwargs)
+    downstream = link.Link()
+    downstream.headers_only = headers_only
+    downstream.link(streamer)
+    packets = list(downstream.input_stream)
+    done.set()
+    sender.join()
+    receiver.close()
+    return packets, streamer
+
 def test():
     """Open up a test pcap file and stream the packets"""
 
@@ -128,6 +481,56 @@ def test():
     for packet in streamer.output_stream:
         print(packet)
 
+    # Both file backends should give the same packets (pcapng too)
+    for data_file in ['../../data/http.pcap', '../../data/https.pcap']:
+        data_path = file_utils.relative_dir(__file__, data_file)
+        mmap_packets = list(PacketStreamer(iface_name=data_path).output_stream)
+        pcapy_packets = list(PacketStreamer(iface_name=data_path, file_backend='pcapy').output_stream)
+        assert len(mmap_packets) == len(pcapy_packets)
+        for mmap_packet, pcapy_packet in zip(mmap_packets, pcapy_packets):
+            assert mmap_packet['raw_buf'] == pcapy_packet['raw_buf']
+            assert mmap_packet['packet_num'] == pcapy_packet['packet_num']
+
+    # Capture thread with a ring buffer big enough to hold everything
+    data_path = file_utils.relative_dir(__file__, '../../data/http.pcap')
+    packets = list(PacketStreamer(iface_name=data_path, file_backend='pcapy').output_stream)
+    streamer = PacketStreamer(iface_name=data_path, file_backend='pcapy', capture_thread=True)
+    thread_packets = list(streamer.output_stream)
+    assert [packet['raw_buf'] for packet in thread_packets] == [packet['raw_buf'] for packet in packets]
+    assert streamer.get_stats()['ring_dropped'] == 0
+
+    # A tiny ring buffer will drop packets, but everything is accounted for
+    for drop_policy in ['drop_newest', 'drop_oldest']:
+        streamer = PacketStreamer(iface_name=data_path, file_backend='pcapy', capture_thread=True,
+                                  ring_size=1, drop_policy=drop_policy)
+        thread_packets = list(streamer.output_stream)
+        assert len(thread_packets) + streamer.get_stats()['ring_dropped'] == len(packets)
+
+    # Live captures on loopback (Linux and root only)
+    if hasattr(af_packet.socket, 'AF_PACKET') and os.geteuid() == 0:
+        for backend, snaplen, headers_only, caplen in [('af_packet', None, False, 1042), ('af_packet', 100, False, 100),
+                                                       ('pcapy', None, True, HEADERS_SNAPLEN), ('pcapy', None, False, 1042)]:
+            packets, streamer = _loopback_capture(live_backend=backend, snaplen=snaplen, headers_only=headers_only,
+                                                  block_size=1 << 16, block_count=8, buffer_size=1 << 20, immediate=True)
+            assert len(packets) == 10 and all(len(packet['raw_buf']) == caplen for packet in packets)
+            assert all(bytes(packet['raw_buf'][42:50]) == b'chains t' for packet in packets)
+            assert streamer.get_stats()['received'] >= 10
+
+        # The packets are still good after the ring blocks they came in got reused (loopback sees
+        # each datagram twice, going out and coming in)
+        packets, streamer = _loopback_capture(live_backend='af_packet', block_size=1 << 16, block_count=2,
+                                              max_packets=400)
+        assert len(packets) == 400 and all(bytes(packet['raw_buf'][42:53]) == b'chains test' for packet in packets)
+        nums = [struct.unpack('!I', bytes(packet['raw_buf'][-4:]))[0] for packet in packets]
+        assert nums == sorted(nums) and max(nums.count(num) for num in nums) <= 2
+
+    # Batch mode
+    data_path = file_utils.relative_dir(__file__, '../../data/http.pcap')
+    streamer = PacketStreamer(iface_name=data_path, max_packets=40).use_batches(batch_size=16)
+    batches = list(streamer.output_stream)
+    assert [len(batch) for batch in batches] == [16, 16, 8]
+    assert [packet['packet_num'] for batch in batches for packet in batch] == list(range(40))
+
 
 if __name__ == '__main__':
     test()
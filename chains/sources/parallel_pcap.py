@@ -0,0 +1,196 @@
+"""ParallelPcap: Decode one (big) capture file with a pool of worker processes, each worker takes
+   a chunk of the file at a time and the outputs come back in the original packet order"""
+from __future__ import print_function
+import traceback
+import multiprocessing
+from collections import deque
+
+# Local imports
+from chains.sources import source
+from chains.utils import file_utils, log_utils, pcap_reader
+
+
+def default_pipeline():
+    """The default links for each chunk (PacketMeta and TransportMeta)"""
+    from chains.links import packet_meta, transport_meta
+    return [packet_meta.PacketMeta(), transport_meta.TransportMeta()]
+
+
+class ParallelPcap(source.Source):
+    """Split a pcap/pcapng file into chunks (on record boundaries) and have a pool of worker
+       processes run the pipeline links on each chunk. The workers memory map the file, so
+       only the record offsets are sent to them (not the packet bytes).
+       Usage:
+            def my_links():
+                return [PacketMeta(), ReverseDNS(), TransportMeta()]
+
+            streamer = ParallelPcap('big.pcap', pipeline=my_links, num_workers=8)
+            for item in streamer.output_stream:
+                ...
+
+       Args:
+            file_path (str): the capture file (classic pcap or pcapng)
+            pipeline (callable): returns a list of (unlinked) links for one chunk, the first link gets
+                                 the raw packets (has to be picklable, so a module level function)
+                                 (defaults to default_pipeline, PacketMeta and TransportMeta)
+            num_workers (int): the number of worker processes (defaults to the number of cores)
+            chunk_bytes (int): the (approximate) size of each chunk of the file (defaults to 8MB)
+            max_pending (int): the most chunks out at the workers at a time (defaults to 2 * num_workers)
+            max_packets (int): the maximum number of packets to read (defaults to None, all of them)
+       Note: The outputs are in packet order and get the 'packet_num' of the packet that was last
+             read when they came out (for per packet links that's their own packet). Each chunk
+             gets its own copy of the links, so stateful links (Flows) only see one chunk.
+    """
+
+    def __init__(self, file_path, pipeline=default_pipeline, num_workers=None, chunk_bytes=8*1024*1024,
+                 max_pending=None, max_packets=None):
+        """Initialization for ParallelPcap"""
+
+        # Call super class init
+        super(ParallelPcap, self).__init__()
+
+        self.file_path = file_path
+        self.pipeline = pipeline
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.chunk_bytes = chunk_bytes
+        self.max_pending = max_pending or 2 * self.num_workers
+        self.max_packets = max_packets
+        self.output_stream = self.read_chunks()
+
+    def read_chunks(self):
+        """Send the chunks out to the workers and yield the outputs in order
+           Returns:
+               generator (dictionary): the output of the pipeline for each chunk in order
+        """
+        pool = multiprocessing.Pool(self.num_workers, initializer=_open_reader, initargs=(self.file_path,))
+        pending = deque()
+        num_packets = 0
+        try:
+            for chunk in self._chunks():
+                num_packets += len(chunk[1])
+                pending.append(pool.apply_async(_decode_chunk, (self.pipeline, chunk)))
+                if len(pending) >= self.max_pending:
+                    for item in self._chunk_output(pending.popleft()):
+                        yield item
+            while pending:
+                for item in self._chunk_output(pending.popleft()):
+                    yield item
+        finally:
+            pool.terminate()
+            pool.join()
+        print('Packet stats: %d read from %s' % (num_packets, self.file_path))
+
+    def _chunks(self):
+        """Internal method: walk the record headers and cut the file into chunks
+
+           Returns:
+               generator (tuple): (first packet_num, [(timestamp, start, end), ...]) for each chunk
+        """
+        reader = pcap_reader.PcapReader(self.file_path)
+        try:
+            packet_num = 0
+            records = []
+            chunk_start = None
+            for record in reader.records():
+                if chunk_start is None:
+                    chunk_start = record[1]
+                records.append(record)
+                if self.max_packets and packet_num + len(records) >= self.max_packets:
+                    break
+                if record[2] - chunk_start >= self.chunk_bytes:
+                    yield packet_num, records
+                    packet_num += len(records)
+                    records = []
+                    chunk_start = None
+            if records:
+                yield packet_num, records
+        finally:
+            reader.close()
+
+    def _chunk_output(self, result):
+        """Internal method: wait for a chunk and hand back its outputs"""
+        kind, payload = result.get()
+        if kind == 'error':
+            log_utils.panic('ParallelPcap worker failed:\n{:s}'.format(payload))
+        return payload
+
+
+# Each worker maps the file once
+_reader = None
+
+def _open_reader(file_path):
+    """Internal method: worker initializer, memory map the capture file"""
+    global _reader
+    _reader = pcap_reader.PcapReader(file_path)
+
+def _decode_chunk(pipeline, chunk):
+    """Internal method: run a copy of the pipeline on one chunk of the file
+
+       Returns:
+           tuple: ('items', outputs) or ('error', traceback)
+    """
+    try:
+        first_packet_num, records = chunk
+        current = [first_packet_num]
+
+        # The outputs get pickled back, so each buffer is copied out of the map
+        def _packets():
+            for index, (timestamp, start, end) in enumerate(records):
+                current[0] = first_packet_num + index
+                yield {'timestamp': timestamp, 'raw_buf': _reader.buffer(start, end).tobytes(),
+                       'packet_num': current[0]}
+
+        links = pipeline()
+        links[0].link(_packets())
+        for upstream, downstream in zip(links, links[1:]):
+            downstream.link(upstream)
+        outputs = []
+        for item in links[-1].output_stream:
+            if hasattr(item, 'keys') and 'packet_num' not in item:
+                item['packet_num'] = current[0]
+            outputs.append(item)
+        return 'items', outputs
+    except Exception:
+        return 'error', traceback.format_exc()
+
+def _test_broken_pipeline():
+    """Broken pipeline for the test"""
+    from chains.links import link
+    return [link.Link()]
+
+def test():
+    """Test for ParallelPcap"""
+    from chains.sources import packet_streamer
+    from chains.links import packet_meta, transport_meta
+
+    for data_file in ['../../data/http.pcap', '../../data/https.pcap']:
+        data_path = file_utils.relative_dir(__file__, data_file)
+
+        # One process
+        streamer = packet_streamer.PacketStreamer(iface_name=data_path)
+        meta = packet_meta.PacketMeta()
+        tmeta = transport_meta.TransportMeta()
+        meta.link(streamer)
+        tmeta.link(meta)
+        expected = [(item['timestamp'], item['eth'], item['transport']) for item in tmeta.output_stream]
+
+        # Small chunks over a few workers give the same packets in the same order
+        streamer = ParallelPcap(data_path, num_workers=3, chunk_bytes=2000, max_pending=2)
+        items = list(streamer.output_stream)
+        assert [item['packet_num'] for item in items] == list(range(len(expected)))
+        assert [(item['timestamp'], item['eth'], item['transport']) for item in items] == expected
+
+    # Max packets
+    streamer = ParallelPcap(data_path, num_workers=2, chunk_bytes=1000, max_packets=10)
+    assert [item['packet_num'] for item in streamer.output_stream] == list(range(10))
+
+    # Worker failures come back to the parent
+    streamer = ParallelPcap(data_path, pipeline=_test_broken_pipeline, num_workers=2)
+    try:
+        list(streamer.output_stream)
+        assert False
+    except RuntimeError:
+        pass
+
+if __name__ == '__main__':
+    test()
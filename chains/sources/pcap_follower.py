@@ -0,0 +1,295 @@
+"""PcapFollower: Follow a pcap file (like tail -f) while another process (tcpdump -w) is writing it"""
+from __future__ import print_function
+import os
+import re
+import time
+import glob
+import struct
+
+# Local imports
+from chains.sources import source
+from chains.utils import file_utils, log_utils, pcap_reader
+logger = log_utils.get_logger()
+
+
+def _natural_key(path):
+    """Internal method: sort key so that dump2 comes before dump10 (tcpdump -C file names)"""
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', path)]
+
+
+class PcapFollower(source.Source):
+    """Follow a pcap file that's still being written, yielding each packet as soon as its record
+       is complete on disk. The file is read from a tracked offset (bytes are never read twice),
+       and when the writer rotates (tcpdump -C/-G) the follower finishes the current file and
+       moves on to the next one in sequence. Waiting for data polls with an exponential backoff
+       from poll_ms to max_poll_ms, so a busy capture is picked up within a millisecond or two.
+       Usage:
+            # tcpdump -i eth0 -w /data/dump -C 100
+            streamer = PcapFollower('/data/dump')
+            for packet in streamer.output_stream:
+                ...
+
+       Args:
+            file_path (str): the (first) capture file, it's fine if it doesn't exist yet
+            follow_rotation (bool): move on to the rotated files (defaults to True)
+            rotation_glob (str): the glob for the rotated files, they're taken in natural sort order
+                                 (defaults to file_path + '*', the tcpdump -C names dump, dump1, dump2, ...)
+            poll_ms (float): the first wait when there's no new data (defaults to 1)
+            max_poll_ms (float): the longest wait when there's no new data (defaults to 100)
+            idle_timeout (float): stop after this many seconds without new data (defaults to None, follow forever)
+            max_packets (int): the maximum number of packets to yield (defaults to None)
+            read_size (int): the most bytes to read at a time (defaults to 1MB)
+       Note: Follow mode reads classic pcap (what tcpdump -w writes), not pcapng.
+    """
+
+    def __init__(self, file_path, follow_rotation=True, rotation_glob=None, poll_ms=1, max_poll_ms=100,
+                 idle_timeout=None, max_packets=None, read_size=1024*1024):
+        """Initialization for PcapFollower"""
+
+        # Call super class init
+        super(PcapFollower, self).__init__()
+
+        self.file_path = os.path.expanduser(file_path)
+        self.follow_rotation = follow_rotation
+        self.rotation_glob = rotation_glob or self.file_path + '*'
+        self.poll_ms = poll_ms
+        self.max_poll_ms = max_poll_ms
+        self.idle_timeout = idle_timeout
+        self.max_packets = max_packets
+        self.read_size = read_size
+        self.stats = {'files': 0, 'bytes': 0, 'packets': 0, 'truncated': 0}
+        self.output_stream = self.follow()
+
+    def get_stats(self):
+        """Get the follower counters (callable while the stream is running)
+
+           Returns:
+               dict: files opened, bytes read, packets yielded and truncated records dropped at rotation
+        """
+        return dict(self.stats)
+
+    def follow(self):
+        """Follow the capture file (and the rotated files after it)
+
+           Returns:
+               generator (dictionary): timestamp, raw_buf and packet_num for each packet
+        """
+        for packets in self._follow_files():
+            for timestamp, raw_buf in packets:
+                yield {'timestamp': timestamp, 'raw_buf': raw_buf, 'packet_num': self.stats['packets']}
+                self.stats['packets'] += 1
+                if self.max_packets and self.stats['packets'] >= self.max_packets:
+                    self._report()
+                    return
+        self._report()
+
+    def batch_output_stream(self):
+        """Follow the capture file in batches, each read hands over what it completed right away
+           (split up to batch_size) so a quiet capture doesn't hold packets back"""
+        batch_size = self.batch_size
+        for packets in self._follow_files():
+            if self.max_packets:
+                packets = packets[:self.max_packets - self.stats['packets']]
+            for index in range(0, len(packets), batch_size):
+                batch = []
+                for timestamp, raw_buf in packets[index:index + batch_size]:
+                    batch.append({'timestamp': timestamp, 'raw_buf': raw_buf, 'packet_num': self.stats['packets']})
+                    self.stats['packets'] += 1
+                yield batch
+            if self.max_packets and self.stats['packets'] >= self.max_packets:
+                break
+        self._report()
+
+    def _report(self):
+        """Internal method: all done so print out a small report"""
+        print('Packet stats: %d read from %s (%d files)' % (self.stats['packets'], self.file_path, self.stats['files']))
+
+    def _follow_files(self):
+        """Internal method: follow each file in the rotation sequence
+
+           Returns:
+               generator (list): the (timestamp, raw_buf) packets completed by each read
+        """
+        file_path = self.file_path
+        while file_path:
+            for packets in self._follow_file(file_path):
+                yield packets
+            file_path = self._next_file(file_path) if self.follow_rotation else None
+
+    def _next_file(self, file_path):
+        """Internal method: the rotated file after this one (None if it isn't there yet)"""
+        key = _natural_key(file_path)
+        later = [path for path in glob.glob(self.rotation_glob) if _natural_key(path) > key]
+        return min(later, key=_natural_key) if later else None
+
+    def _wait(self, wait):
+        """Internal method: wait for new data with an exponential backoff
+
+           Args:
+               wait: [start time, current delay] (updated in place)
+           Returns:
+               bool: False when the idle timeout is up
+        """
+        if self.idle_timeout and time.time() - wait[0] >= self.idle_timeout:
+            return False
+        time.sleep(wait[1])
+        wait[1] = min(wait[1] * 2, self.max_poll_ms / 1000.0)
+        return True
+
+    def _follow_file(self, file_path):
+        """Internal method: read a file from a tracked offset as it grows
+
+           Returns:
+               generator (list): the (timestamp, raw_buf) packets completed by each read, it returns when
+                                 the file is finished (the next rotated file showed up) or on the idle timeout
+        """
+        wait = [time.time(), self.poll_ms / 1000.0]
+
+        # The writer might not have created the file yet
+        while not os.path.isfile(file_path):
+            if not self._wait(wait):
+                return
+        self.stats['files'] += 1
+
+        # Unbuffered reads hand back whatever is on disk past our offset
+        with open(file_path, 'rb', buffering=0) as capture_file:
+            data = b''
+            offset = 0
+            record_header = None
+            draining = False
+            while True:
+                chunk = capture_file.read(self.read_size)
+                if chunk:
+                    self.stats['bytes'] += len(chunk)
+                    wait = [time.time(), self.poll_ms / 1000.0]
+
+                    # Only the bytes of an incomplete record get carried over
+                    data = data[offset:] + chunk if offset < len(data) else chunk
+                    offset = 0
+                    if record_header is None:
+                        if len(data) < 24:
+                            continue
+                        record_header, ts_scale = self._file_header(data, file_path)
+                        offset = 24
+                    packets, offset = self._complete_records(data, offset, record_header, ts_scale)
+                    if packets:
+                        yield packets
+                    continue
+
+                # At the end of the file, once the next file shows up the writer is done with this one
+                # (read one more time in case the last write landed after our read)
+                if draining:
+                    break
+                if self.follow_rotation and self._next_file(file_path):
+                    draining = True
+                    continue
+                if not self._wait(wait):
+                    return
+
+            if offset < len(data):
+                self.stats['truncated'] += 1
+                logger.warning('Dropping {:d} bytes of a truncated record at the end of {:s}'.format(
+                    len(data) - offset, file_path))
+
+    @staticmethod
+    def _file_header(data, file_path):
+        """Internal method: byte order and timestamp scale from the pcap file header
+
+           Returns:
+               tuple: (record header struct, timestamp scale)
+        """
+        for endian in ['<', '>']:
+            magic, = struct.unpack_from(endian+'I', data, 0)
+            if magic in (pcap_reader.PCAP_MAGIC_USEC, pcap_reader.PCAP_MAGIC_NSEC):
+                ts_scale = 1e-6 if magic == pcap_reader.PCAP_MAGIC_USEC else 1e-9
+                return struct.Struct(endian+'IIII'), ts_scale
+        log_utils.panic('Follow mode reads classic pcap files (tcpdump -w): %s' % file_path)
+
+    @staticmethod
+    def _complete_records(data, offset, record_header, ts_scale):
+        """Internal method: the complete records in the data
+
+           Returns:
+               tuple: (list of (timestamp, raw_buf) zero-copy slices, offset of the first incomplete record)
+        """
+        view = memoryview(data)
+        size = len(data)
+        packets = []
+        while offset + 16 <= size:
+            ts_sec, ts_frac, caplen, _orig_len = record_header.unpack_from(data, offset)
+            end = offset + 16 + caplen
+            if end > size:
+                break
+            packets.append((ts_sec + ts_frac * ts_scale, view[offset+16:end]))
+            offset = end
+        return packets, offset
+
+
+def test():
+    """Test for PcapFollower"""
+    import shutil
+    import tempfile
+    import threading
+
+    # The packets (as pcap records) to write out
+    data_path = file_utils.relative_dir(__file__, '../../data/http.pcap')
+    reader = pcap_reader.PcapReader(data_path)
+    packets = [raw_buf.tobytes() for _ts, raw_buf in reader.packets()]
+    records = [struct.pack('<IIII', 1000 + num, 500, len(raw_buf), len(raw_buf)) + raw_buf
+               for num, raw_buf in enumerate(packets)]
+    reader.close()
+    file_header = struct.pack('<IHHiIII', pcap_reader.PCAP_MAGIC_USEC, 2, 4, 0, 0, 65535, 1)
+
+    # A 'tcpdump -C' writer: three files, the headers and records are written in pieces with pauses
+    temp_dir = tempfile.mkdtemp()
+    dump_path = os.path.join(temp_dir, 'dump')
+    written = {}
+
+    def _writer():
+        time.sleep(0.05)
+        for index, name in enumerate(['dump', 'dump1', 'dump2']):
+            with open(os.path.join(temp_dir, name), 'wb') as pcap_file:
+                pcap_file.write(file_header[:10])
+                pcap_file.flush()
+                time.sleep(0.01)
+                pcap_file.write(file_header[10:])
+                for num in range(index, len(records), 3):
+                    record = records[num]
+                    pcap_file.write(record[:20])
+                    pcap_file.flush()
+                    time.sleep(0.002)
+                    pcap_file.write(record[20:])
+                    pcap_file.flush()
+                    written[num] = time.time()
+    writer = threading.Thread(target=_writer)
+    writer.start()
+
+    # Every packet (in order across the files) shortly after it lands
+    streamer = PcapFollower(dump_path, idle_timeout=0.5, max_poll_ms=20)
+    followed = []
+    for packet in streamer.output_stream:
+        followed.append((packet['packet_num'], packet['timestamp'], packet['raw_buf'].tobytes(), time.time()))
+    writer.join()
+    expected = [num for index in range(3) for num in range(index, len(records), 3)]
+    assert [raw_buf for _num, _ts, raw_buf, _seen in followed] == [packets[num] for num in expected]
+    assert [timestamp for _num, timestamp, _buf, _seen in followed] == [1000 + num + 0.0005 for num in expected]
+    assert [num for num, _ts, _buf, _seen in followed] == list(range(len(packets)))
+    assert max(seen - written[num] for (_n, _t, _b, seen), num in zip(followed, expected)) < 0.1
+
+    # Never read twice, nothing truncated
+    stats = streamer.get_stats()
+    total = sum(os.path.getsize(os.path.join(temp_dir, name)) for name in ['dump', 'dump1', 'dump2'])
+    assert stats == {'files': 3, 'bytes': total, 'packets': len(packets), 'truncated': 0}
+
+    # Batches, max packets, no rotation and a half written record at the end
+    with open(dump_path, 'ab') as pcap_file:
+        pcap_file.write(records[0][:30])
+    streamer = PcapFollower(dump_path, follow_rotation=False, idle_timeout=0.05).use_batches(batch_size=4)
+    batches = list(streamer.output_stream)
+    assert [len(batch) for batch in batches] == [4, 4, 4, 3]
+    streamer = PcapFollower(dump_path, idle_timeout=0.05, max_packets=20).use_batches(batch_size=8)
+    assert [len(batch) for batch in streamer.output_stream] == [8, 7, 5]
+    shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    test()
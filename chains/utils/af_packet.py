@@ -0,0 +1,345 @@
+"""AF_PACKET: Linux live capture with a TPACKET_V3 memory mapped RX ring (stdlib socket, no libpcap)"""
+from __future__ import print_function
+import mmap
+import time
+import select
+import socket
+import struct
+import ctypes
+
+# Local imports
+from chains.utils import log_utils
+
+# Socket options (linux/if_packet.h)
+SOL_PACKET = 263
+PACKET_ADD_MEMBERSHIP = 1
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+PACKET_FANOUT = 18
+PACKET_MR_PROMISC = 1
+SIOCGIFINDEX = 0x8933
+TPACKET_V3 = 2
+SO_ATTACH_FILTER = 26
+ETH_P_ALL = 0x0003
+
+# Block status
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+# Fanout modes (how the kernel splits the packets between the sockets in a group)
+FANOUT_MODES = {'hash': 0, 'lb': 1, 'cpu': 2, 'rollover': 3, 'rnd': 4, 'qm': 5}
+PACKET_FANOUT_FLAG_DEFRAG = 0x8000
+
+# Ring layouts: tpacket_req3, the block header (block_status, num_pkts, offset_to_first_pkt)
+# and the tpacket3_hdr fields we use (tp_next_offset, tp_sec, tp_nsec, tp_snaplen, tp_len, tp_status, tp_mac)
+_REQ3 = struct.Struct('=IIIIIII')
+_BLOCK = struct.Struct('=III')
+_FRAME = struct.Struct('=IIIIIIH')
+_STATS = struct.Struct('=III')
+_BLOCK_STATUS = 8
+
+
+class _SockFilter(ctypes.Structure):
+    """struct sock_filter (one classic BPF instruction)"""
+    _fields_ = [('code', ctypes.c_ushort), ('jt', ctypes.c_ubyte), ('jf', ctypes.c_ubyte), ('k', ctypes.c_uint)]
+
+
+class _SockFprog(ctypes.Structure):
+    """struct sock_fprog (the BPF program for SO_ATTACH_FILTER)"""
+    _fields_ = [('len', ctypes.c_ushort), ('filter', ctypes.POINTER(_SockFilter))]
+
+
+class PacketRing(object):
+    """An AF_PACKET socket with a TPACKET_V3 RX ring mapped into our memory. The kernel fills whole
+       blocks of frames and hands each block over at once (when it's full or after block_timeout_ms),
+       so reading a block is one pass of struct.unpack_from over the ring, no system call per packet.
+       Usage:
+            ring = PacketRing('eth0', fanout_group=42)
+            for timestamp, raw_buf in ring.packets():
+                print(timestamp, len(raw_buf))
+            ring.close()
+
+       Args:
+            iface_name (str): The network interface to capture from ('lo', 'eth0', ...)
+            block_size (int): Bytes per ring block, a multiple of the page size (defaults to 1MB)
+            block_count (int): Number of blocks in the ring (defaults to 64)
+            frame_size (int): The frame size the kernel checks the ring against (defaults to 2048)
+            block_timeout_ms (int): Hand over a block that isn't full after this long (defaults to 10)
+            fanout_group (int): Join this PACKET_FANOUT group, so several processes split the traffic (defaults to None)
+            fanout_mode (str): How the group splits the traffic, see FANOUT_MODES (defaults to 'hash', by flow)
+            promisc (bool): Put the interface in promiscuous mode (defaults to True)
+            bpf (list): Classic BPF instructions, (code, jt, jf, k) tuples (e.g. pcapy.compile(...).get_bpf())
+       Note: The raw_buf values are copied out of the ring (bytes), a block goes back to the kernel as soon as
+             the reader moves past it. Readers that are done with each block before asking for the next one can
+             pass copy=False to blocks()/packets() and get zero-copy memoryviews into the ring instead.
+             Linux only, and needs CAP_NET_RAW (root).
+    """
+    def __init__(self, iface_name, block_size=1 << 20, block_count=64, frame_size=2048, block_timeout_ms=10,
+                 fanout_group=None, fanout_mode='hash', promisc=True, bpf=None):
+        """PacketRing Initialization"""
+        if not hasattr(socket, 'AF_PACKET'):
+            log_utils.panic('AF_PACKET capture is only available on Linux')
+        if block_size % mmap.PAGESIZE or block_size % frame_size:
+            log_utils.panic('The block size must be a multiple of the page and frame size: %d' % block_size)
+        if fanout_mode not in FANOUT_MODES:
+            log_utils.panic('Unknown fanout mode: {:s}'.format(fanout_mode))
+        self.iface_name = iface_name
+        self.block_size = block_size
+        self.block_count = block_count
+        self.stats = {'received': 0, 'dropped': 0, 'freeze_q': 0}
+
+        # Version 3 ring (with a BPF program attached before anything gets queued)
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        try:
+            if bpf:
+                self._attach_filter(bpf)
+            self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING, _REQ3.pack(
+                block_size, block_count, frame_size, block_size * block_count // frame_size, block_timeout_ms, 0, 0))
+            self._ring = mmap.mmap(self.sock.fileno(), block_size * block_count, mmap.MAP_SHARED,
+                                   mmap.PROT_READ | mmap.PROT_WRITE)
+            self._view = memoryview(self._ring)
+
+            # Bind to the interface, then promiscuous mode and the fanout group
+            self.sock.bind((iface_name, ETH_P_ALL))
+            if promisc:
+                self.sock.setsockopt(SOL_PACKET, PACKET_ADD_MEMBERSHIP, struct.pack(
+                    'iHH8s', _ifindex(self.sock, iface_name), PACKET_MR_PROMISC, 0, b''))
+            if fanout_group is not None:
+                mode = FANOUT_MODES[fanout_mode] | (PACKET_FANOUT_FLAG_DEFRAG if fanout_mode == 'hash' else 0)
+                self.sock.setsockopt(SOL_PACKET, PACKET_FANOUT, (fanout_group & 0xffff) | (mode << 16))
+        except Exception:
+            self.sock.close()
+            raise
+        self._block = 0
+
+    def blocks(self, timeout_ms=100, stop=None, copy=True):
+        """Generator for the blocks the kernel hands over
+
+           Args:
+               timeout_ms: how long to wait in poll() before checking stop (defaults to 100)
+               stop: a threading.Event that ends the generator (defaults to None, run until closed)
+               copy: copy each frame out of the ring (defaults to True), with False the raw_buf values are
+                     memoryviews that the kernel overwrites once the next block is asked for
+           Returns:
+               generator (list): the (timestamp, raw_buf) packets in each block, the block goes back to
+                                 the kernel when the next one is asked for
+        """
+        view = self._view
+        poller = select.poll()
+        poller.register(self.sock, select.POLLIN | select.POLLERR)
+        while not (stop and stop.is_set()) and self.sock.fileno() != -1:
+            offset = self._block * self.block_size
+            status, num_pkts, frame = _BLOCK.unpack_from(view, offset + _BLOCK_STATUS)
+            if not status & TP_STATUS_USER:
+                poller.poll(timeout_ms)
+                continue
+
+            # Walk the frames in the block
+            packets = []
+            frame += offset
+            for _ in range(num_pkts):
+                next_offset, sec, nsec, snaplen, _len, _status, mac = _FRAME.unpack_from(view, frame)
+                raw_buf = view[frame + mac:frame + mac + snaplen]
+                packets.append((sec + nsec * 1e-9, raw_buf.tobytes() if copy else raw_buf))
+                frame += next_offset
+            yield packets
+
+            # Give the block back to the kernel
+            struct.pack_into('=I', view, offset + _BLOCK_STATUS, TP_STATUS_KERNEL)
+            self._block = (self._block + 1) % self.block_count
+
+    def packets(self, timeout_ms=100, stop=None, copy=True):
+        """Generator for the packets (see blocks())
+
+           Returns:
+               generator (tuple): (timestamp, raw_buf) for each packet
+        """
+        for packets in self.blocks(timeout_ms, stop, copy):
+            for packet in packets:
+                yield packet
+
+    def get_stats(self):
+        """Get the kernel counters (the kernel resets them on each read, so we keep the totals)
+
+           Returns:
+               dict: received, dropped and freeze_q (times the ring was full and the queue froze)
+        """
+        if self.sock.fileno() != -1:
+            received, dropped, freeze_q = _STATS.unpack(self.sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, _STATS.size))
+            self.stats['received'] += received
+            self.stats['dropped'] += dropped
+            self.stats['freeze_q'] += freeze_q
+        return dict(self.stats)
+
+    def close(self):
+        """Close the socket and unmap the ring (views still held downstream keep the map alive)"""
+        try:
+            if self.sock.fileno() != -1:
+                self.get_stats()
+        finally:
+            self.sock.close()
+
+        # Python 2 memoryviews can't be released, so just let go of the ring (it's unmapped with the last view)
+        if not hasattr(self._view, 'release'):
+            self._view = self._ring = None
+            return
+        try:
+            self._view.release()
+        except BufferError:
+            pass
+        try:
+            self._ring.close()
+        except BufferError:
+            pass
+
+    def _attach_filter(self, bpf):
+        """Internal method: attach classic BPF instructions to the socket"""
+        instructions = (_SockFilter * len(bpf))(*[_SockFilter(*instruction) for instruction in bpf])
+        program = _SockFprog(len(bpf), instructions)
+        self.sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, ctypes.string_at(ctypes.addressof(program),
+                                                                                   ctypes.sizeof(program)))
+
+
+def _ifindex(sock, iface_name):
+    """Internal method: the interface index (socket.if_nametoindex is Python 3 only, so SIOCGIFINDEX otherwise)"""
+    if hasattr(socket, 'if_nametoindex'):
+        return socket.if_nametoindex(iface_name)
+    import fcntl
+    ifreq = fcntl.ioctl(sock.fileno(), SIOCGIFINDEX, struct.pack('16sI', iface_name.encode('ascii'), 0))
+    return struct.unpack('16sI', ifreq)[1]
+
+
+def test():
+    """Test for PacketRing (on the loopback interface)"""
+    import os
+    import threading
+
+    # Needs Linux and CAP_NET_RAW
+    try:
+        ring = PacketRing('lo', block_size=1 << 16, block_count=8, block_timeout_ms=5)
+    except (RuntimeError, OSError) as error:
+        print('AF_PACKET not available here, skipping the PacketRing test: %s' % error)
+        return
+
+    # Send some marked UDP datagrams over loopback (to a socket that's listening, so no ICMP comes back)
+    marker = os.urandom(8)
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    port = receiver.getsockname()[1]
+
+    def _send(count, pad=0, pause=0):
+        time.sleep(0.05)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for num in range(count):
+            sender.sendto(marker + b'.' * pad + struct.pack('!I', num), ('127.0.0.1', port))
+            time.sleep(pause)
+        sender.close()
+
+    def _collect(rings, wanted, seconds=5.0):
+        stop = threading.Event()
+        timer = threading.Timer(seconds, stop.set)
+        timer.start()
+        seen = {}
+        streams = [iter(each.blocks(timeout_ms=10, stop=stop, copy=False)) for each in rings]
+        while streams and sum(len(nums) for nums in seen.values()) < wanted:
+            for index, stream in enumerate(list(streams)):
+                packets = next(stream, None)
+                if packets is None:
+                    streams.remove(stream)
+                    continue
+                for timestamp, raw_buf in packets:
+                    assert isinstance(raw_buf, memoryview) and abs(timestamp - time.time()) < 60
+                    payload = raw_buf.tobytes()
+                    if marker in payload:
+                        seen.setdefault(index, []).append(struct.unpack('!I', payload[-4:])[0])
+        timer.cancel()
+        return seen
+
+    # Every datagram shows up (loopback sees each one going out and coming in)
+    sender = threading.Thread(target=_send, args=(50,))
+    sender.start()
+    seen = _collect([ring], 100)
+    sender.join()
+    assert sorted(seen[0]) == sorted(list(range(50)) * 2)
+    assert ring.get_stats()['received'] >= 100
+    ring.close()
+
+    # A fanout group splits the datagrams between the sockets (round robin)
+    group = os.getpid() & 0xffff
+    rings = [PacketRing('lo', block_size=1 << 16, block_count=8, block_timeout_ms=5, fanout_group=group,
+                        fanout_mode='lb') for _ in range(2)]
+    sender = threading.Thread(target=_send, args=(50,))
+    sender.start()
+    seen = _collect(rings, 100)
+    sender.join()
+    assert sorted(seen.get(0, []) + seen.get(1, [])) == sorted(list(range(50)) * 2)
+    assert seen.get(0) and seen.get(1)
+    for each in rings:
+        each.close()
+
+    # A BPF program (only our UDP port)
+    bpf = [(0x28, 0, 0, 12), (0x15, 0, 5, 0x0800), (0x30, 0, 0, 23), (0x15, 0, 3, 17),
+           (0x28, 0, 0, 36), (0x15, 0, 1, port), (0x6, 0, 0, 65535), (0x6, 0, 0, 0)]
+    ring = PacketRing('lo', block_size=1 << 16, block_count=8, block_timeout_ms=5, bpf=bpf)
+    sender = threading.Thread(target=_send, args=(10,))
+    sender.start()
+    seen = _collect([ring], 20)
+    sender.join()
+    assert len(seen[0]) == 20
+    ring.close()
+
+    # Copied frames stay good after their blocks go back to the kernel (a two block ring gets reused a lot)
+    ring = PacketRing('lo', block_size=1 << 16, block_count=2, block_timeout_ms=5, bpf=bpf)
+    sender = threading.Thread(target=_send, args=(200, 1000, 0.001))
+    sender.start()
+    stop = threading.Event()
+    timer = threading.Timer(5.0, stop.set)
+    timer.start()
+    kept = []
+    for timestamp, raw_buf in ring.packets(timeout_ms=10, stop=stop):
+        kept.append(raw_buf)
+        if len(kept) == 400:
+            break
+    timer.cancel()
+    sender.join()
+    ring.close()
+    assert len(kept) > 100 and all(isinstance(raw_buf, bytes) and marker in raw_buf for raw_buf in kept)
+    nums = [struct.unpack('!I', raw_buf[-4:])[0] for raw_buf in kept]
+    assert nums == sorted(nums) and max(nums.count(num) for num in nums) <= 2
+
+    # Closing with a zero-copy view still held downstream closes the socket (the view keeps the map alive)
+    ring = PacketRing('lo', block_size=1 << 16, block_count=8, block_timeout_ms=5, bpf=bpf)
+    sender = threading.Thread(target=_send, args=(1,))
+    sender.start()
+    timestamp, raw_buf = next(ring.packets(timeout_ms=10, copy=False))
+    sender.join()
+    ring.close()
+    ring.close()
+    assert ring.sock.fileno() == -1 and marker in raw_buf.tobytes()
+    receiver.close()
+
+    # The SIOCGIFINDEX fallback (Python 2) gives the same interface index
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if_nametoindex = getattr(socket, 'if_nametoindex', None)
+    if if_nametoindex:
+        del socket.if_nametoindex
+    try:
+        index = _ifindex(sock, 'lo')
+    finally:
+        if if_nametoindex:
+            socket.if_nametoindex = if_nametoindex
+    sock.close()
+    assert index > 0 and (not if_nametoindex or index == if_nametoindex('lo'))
+
+    # Bad arguments
+    for kwargs in [{'block_size': 1000}, {'fanout_mode': 'everything'}]:
+        try:
+            PacketRing('lo', **kwargs)
+            assert False
+        except RuntimeError:
+            pass
+
+if __name__ == '__main__':
+    test()
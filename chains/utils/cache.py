@@ -1,10 +1,20 @@
 """Cache class for key/value pairs"""
 from __future__ import print_function
+import sys
 import time
+import weakref
+import threading
 from collections import OrderedDict
 
+# Python 2 OrderedDicts don't have move_to_end
+HAS_MOVE_TO_END = hasattr(OrderedDict, 'move_to_end')
+
+def sizeof(key, value):
+    """Default size (in bytes) of a cache entry for the max_bytes limit"""
+    return sys.getsizeof(key) + sys.getsizeof(value)
+
 class Cache(object):
-    """In process memory cache. Not thread safe.
+    """In process LRU memory cache with TTLs. Not thread safe (see ThreadSafeCache).
        Usage:
             cache = Cache(max_size=5, timeout=10)
             cache.set('foo', 'bar')
@@ -14,53 +24,250 @@ class Cache(object):
             cache.get('foo')
             >>> None
             cache.clear()
+
+       Args:
+            max_size (int): the maximum number of items, the least recently used go first (defaults to 1000)
+            timeout (float): seconds an item lives, set() can give an item its own ttl (defaults to None, forever)
+            max_bytes (int): the maximum total size of the items, see sizeof() (defaults to None, no limit)
+            sweep_interval (float): seconds between sweeps of the expired items (defaults to 60)
+            clock (callable): returns the current time in seconds (defaults to time.time)
     """
-    def __init__(self, max_size=1000, timeout=None):
+    def __init__(self, max_size=1000, timeout=None, max_bytes=None, sweep_interval=60, clock=time.time):
         """Cache Initialization"""
         self._store = OrderedDict()
         self._max_size = max_size
         self._timeout = timeout
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._sweep_interval = sweep_interval
+        self._clock = clock
+        self._next_sweep = clock() + sweep_interval if sweep_interval else None
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
 
-    def set(self, key, value):
+    def set(self, key, value, ttl=None):
         """Add an item to the cache
         Args:
                key: item key
                value: the value associated with this key
+               ttl: seconds this item lives, 0 for forever (defaults to None, the cache timeout)
         """
+        ttl = ttl if ttl is not None else self._timeout
+        now = self._clock() if ttl else None
+        _expire = now + ttl if ttl else None
+        if key in self._store:
+            self._remove(key)
+        size = sizeof(key, value) if self._max_bytes else 0
+        self._store[key] = (value, _expire, size)
+        self._bytes += size
         self._check_limit()
-        _expire = time.time() + self._timeout if self._timeout else None
-        self._store[key] = (value, _expire)
 
-    def get(self, key):
+        # Every so often clear out the expired items nobody asked for again
+        if ttl and self._next_sweep and now >= self._next_sweep:
+            self.sweep()
+
+    def get(self, key, default=None):
         """Get an item from the cache
            Args:
                key: item key
+               default: what to return on a miss (defaults to None)
            Returns:
-               the value of the item or None if the item isn't in the cache
+               the value of the item or default if the item isn't in the cache
         """
         data = self._store.get(key)
-        if not data:
-            return None
-        value, expire = data
-        if expire and time.time() > expire:
+        if data is None:
+            self.misses += 1
+            return default
+        value, expire, _size = data
+        if expire and self._clock() > expire:
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        # Most recently used goes to the end
+        if HAS_MOVE_TO_END:
+            self._store.move_to_end(key)
+        else:
             del self._store[key]
-            return None
+            self._store[key] = data
+        self.hits += 1
         return value
 
+    def get_many(self, keys, default=None):
+        """Get several items from the cache
+           Args:
+               keys: the item keys
+               default: the value for the misses (defaults to None)
+           Returns:
+               dict: key -> value (or default) for each key
+        """
+        return dict((key, self.get(key, default)) for key in keys)
+
+    def set_many(self, items, ttl=None):
+        """Add several items to the cache
+           Args:
+               items: a dict (or list of (key, value) pairs)
+               ttl: seconds these items live (defaults to None, the cache timeout)
+        """
+        for key, value in (items.items() if isinstance(items, dict) else items):
+            self.set(key, value, ttl)
+
+    def delete(self, key):
+        """Remove an item from the cache (if it's there)"""
+        if key in self._store:
+            self._remove(key)
+
+    def sweep(self):
+        """Remove all the expired items
+           Returns:
+               int: the number of items removed
+        """
+        now = self._clock()
+        expired = [key for key, (_value, expire, _size) in self._store.items() if expire and now > expire]
+        for key in expired:
+            self._remove(key)
+        self.expirations += len(expired)
+        if self._sweep_interval:
+            self._next_sweep = now + self._sweep_interval
+        return len(expired)
+
+    def stats(self):
+        """Get the cache counters
+           Returns:
+               dict: size, bytes, hits, misses, evictions and expirations
+        """
+        return {'size': len(self._store), 'bytes': self._bytes, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'expirations': self.expirations}
+
+    def _remove(self, key):
+        """Internal method: remove an item and its size"""
+        self._bytes -= self._store.pop(key)[2]
+
     def _check_limit(self):
         """Intenal method: check if current cache size exceeds maximum cache
-           size and pop the oldest item in this case"""
-        if len(self._store) >= self._max_size:
-            self._store.popitem(last=False) # FIFO
+           size (items or bytes) and pop the least recently used items in this case"""
+        while len(self._store) > self._max_size or (self._max_bytes and self._bytes > self._max_bytes):
+            self._bytes -= self._store.popitem(last=False)[1][2] # LRU
+            self.evictions += 1
 
     def clear(self):
         """Clear the cache"""
         self._store = OrderedDict()
+        self._bytes = 0
 
     def dump(self):
         """Dump the cache (for debugging)"""
-        for key in self._store.keys():
-            print(key, ':', self.get(key))
+        for key, (value, _expire, _size) in list(self._store.items()):
+            print(key, ':', value)
+
+    def __contains__(self, key):
+        """Is the key in the cache (and not expired)? Doesn't count as a use"""
+        data = self._store.get(key)
+        return data is not None and not (data[1] and self._clock() > data[1])
+
+    def __len__(self):
+        """Number of items in the cache (expired items count until they're removed)"""
+        return len(self._store)
+
+class ThreadSafeCache(Cache):
+    """Cache that several threads can share, with an optional background thread doing the sweeps
+       Args:
+            background_sweep (bool): sweep from a daemon thread every sweep_interval seconds instead
+                                     of from set() (defaults to False)
+            (the other args are the same as Cache)
+    """
+    def __init__(self, max_size=1000, timeout=None, max_bytes=None, sweep_interval=60, clock=time.time,
+                 background_sweep=False):
+        """ThreadSafeCache Initialization"""
+        super(ThreadSafeCache, self).__init__(max_size=max_size, timeout=timeout, max_bytes=max_bytes,
+                                              sweep_interval=None if background_sweep else sweep_interval,
+                                              clock=clock)
+        self._lock = threading.RLock()
+
+        # The sweeper only holds a weak reference, so a cache nobody stopped can still go away
+        if background_sweep and sweep_interval:
+            self._stop = threading.Event()
+            self._sweeper = threading.Thread(target=_sweep_loop, args=(weakref.ref(self), self._stop, sweep_interval))
+            self._sweeper.daemon = True
+            self._sweeper.start()
+
+    def set(self, key, value, ttl=None):
+        """Add an item to the cache (see Cache.set)"""
+        with self._lock:
+            super(ThreadSafeCache, self).set(key, value, ttl)
+
+    def get(self, key, default=None):
+        """Get an item from the cache (see Cache.get)"""
+        with self._lock:
+            return super(ThreadSafeCache, self).get(key, default)
+
+    def get_many(self, keys, default=None):
+        """Get several items from the cache (see Cache.get_many)"""
+        with self._lock:
+            return super(ThreadSafeCache, self).get_many(keys, default)
+
+    def set_many(self, items, ttl=None):
+        """Add several items to the cache (see Cache.set_many)"""
+        with self._lock:
+            super(ThreadSafeCache, self).set_many(items, ttl)
+
+    def delete(self, key):
+        """Remove an item from the cache (see Cache.delete)"""
+        with self._lock:
+            super(ThreadSafeCache, self).delete(key)
+
+    def sweep(self):
+        """Remove all the expired items (see Cache.sweep)"""
+        with self._lock:
+            return super(ThreadSafeCache, self).sweep()
+
+    def clear(self):
+        """Clear the cache"""
+        with self._lock:
+            super(ThreadSafeCache, self).clear()
+
+    def stats(self):
+        """Get the cache counters (see Cache.stats)"""
+        with self._lock:
+            return super(ThreadSafeCache, self).stats()
+
+    def dump(self):
+        """Dump the cache (see Cache.dump)"""
+        with self._lock:
+            super(ThreadSafeCache, self).dump()
+
+    def __contains__(self, key):
+        """Is the key in the cache (see Cache.__contains__)"""
+        with self._lock:
+            return super(ThreadSafeCache, self).__contains__(key)
+
+    def __len__(self):
+        """Number of items in the cache (see Cache.__len__)"""
+        with self._lock:
+            return super(ThreadSafeCache, self).__len__()
+
+    def stop(self):
+        """Stop the background sweeps"""
+        if hasattr(self, '_stop'):
+            self._stop.set()
+
+    def __del__(self):
+        """Stop the background sweeps when the cache goes away"""
+        self.stop()
+
+def _sweep_loop(cache_ref, stop, sweep_interval):
+    """Internal method: sweep a cache every sweep_interval seconds until stopped (or the cache is gone)"""
+    while not stop.wait(sweep_interval):
+        my_cache = cache_ref()
+        if my_cache is None:
+            return
+        my_cache.sweep()
+        del my_cache
 
 def test():
     """Test for the Cache class"""
@@ -81,7 +288,7 @@ def test():
     for i in range(6):
         my_cache.set(str(i), i)
 
-    # So the '0' key should no longer be there FIFO
+    # So the '0' key should no longer be there
     assert my_cache.get('0') is None
     assert my_cache.get('5') is not None
 
@@ -97,6 +304,77 @@ def test():
     assert my_cache.get(None) == 'foo'
     assert my_cache.get(0) == 'bar'
 
+    # Falsy values are hits, not misses
+    my_cache = Cache()
+    my_cache.set('zero', 0)
+    my_cache.set('empty', '')
+    assert my_cache.get('zero', 'miss') == 0
+    assert my_cache.get('empty', 'miss') == ''
+    assert my_cache.get('nope', 'miss') == 'miss'
+    assert 'zero' in my_cache and 'nope' not in my_cache
+
+    # LRU, a hit moves the item to the end
+    my_cache = Cache(max_size=3)
+    my_cache.set_many([('a', 1), ('b', 2), ('c', 3)])
+    my_cache.get('a')
+    my_cache.set('d', 4)
+    assert my_cache.get_many(['a', 'b', 'c', 'd']) == {'a': 1, 'b': None, 'c': 3, 'd': 4}
+    assert my_cache.stats() == {'size': 3, 'bytes': 0, 'hits': 4, 'misses': 1, 'evictions': 1, 'expirations': 0}
+
+    # Per item TTLs and sweeps (with a fake clock)
+    now = [1000.0]
+    my_cache = Cache(timeout=10, sweep_interval=30, clock=lambda: now[0])
+    my_cache.set('short', 1, ttl=1)
+    my_cache.set('long', 2)
+    my_cache.set('forever', 3, ttl=0)
+    now[0] += 5
+    assert my_cache.get('short') is None
+    assert my_cache.get('long') == 2
+    now[0] += 100
+    my_cache.set('new', 4)
+    assert len(my_cache) == 2
+    assert my_cache.get('forever') == 3
+    assert my_cache.expirations == 2
+
+    # Byte limit
+    my_cache = Cache(max_bytes=sizeof('key0', 'x' * 100) * 3)
+    for i in range(10):
+        my_cache.set('key%d' % i, 'x' * 100)
+    assert len(my_cache) == 3
+    assert my_cache.stats()['bytes'] <= sizeof('key0', 'x' * 100) * 3
+    my_cache.delete('key9')
+    assert len(my_cache) == 2
+
+    # Thread safe with a background sweeper
+    my_cache = ThreadSafeCache(timeout=0.05, sweep_interval=0.05, background_sweep=True)
+
+    def _worker(offset):
+        for i in range(1000):
+            my_cache.set(offset + i, i)
+            my_cache.get(offset + i // 2)
+    threads = [threading.Thread(target=_worker, args=(offset * 1000,)) for offset in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert my_cache.hits + my_cache.misses == 4000
+    time.sleep(0.3)
+    assert len(my_cache) == 0
+    my_cache.stop()
+
+    # A cache with a background sweeper that nobody stopped still gets collected (and its sweeper ends)
+    import gc
+    unstopped = ThreadSafeCache(sweep_interval=0.05, background_sweep=True)
+    unstopped.set('foo', 'bar')
+    assert 'foo' in unstopped and unstopped.stats()['size'] == 1
+    sweeper = unstopped._sweeper
+    cache_ref = weakref.ref(unstopped)
+    del unstopped
+    gc.collect()
+    assert cache_ref() is None
+    sweeper.join(1.0)
+    assert not sweeper.is_alive()
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,249 @@
+"""Columnar: Decode a batch of raw frames into NumPy arrays (one per header field) with vectorized
+   reads at the fixed IPv4/TCP/UDP header offsets, plus helpers to get PacketMeta style rows back"""
+from __future__ import print_function
+import struct
+import datetime
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Bytes of each frame that get packed (enough for two VLAN tags, IPv4 options and the TCP flags)
+HEADER_LEN = 96
+
+# Ethernet types
+ETH_TYPE_IP = 0x0800
+ETH_TYPE_8021Q = 0x8100
+ETH_TYPES_QINQ = (0x8100, 0x88a8, 0x9100, 0x9200)
+
+# Protocols and TCP flags (for the readable flags in the rows)
+IP_PROTO_TCP = 6
+IP_PROTO_UDP = 17
+TH_FIN, TH_SYN, TH_RST, TH_PUSH, TH_ACK = 0x01, 0x02, 0x04, 0x08, 0x10
+
+
+class PacketColumns(object):
+    """A batch of packets as a struct of arrays, element i of each array is packet i.
+       Iterating gives the rows as PacketMeta/TransportMeta style dictionaries (see row).
+       Usage:
+            columns = decode_batch(packets)
+            columns.src[columns.proto == 6]
+            talkers, index = np.unique(columns.src, return_inverse=True)
+            np.bincount(index, weights=columns.eth_len)
+
+       Columns:
+            timestamp (float64), packet_num (int64), caplen, eth_len (uint32), eth_type (uint16),
+            ip (bool, an IPv4 packet), src, dst (uint32), proto, ttl (uint8), ip_len, frag, checksum,
+            sport, dport (uint16), tcp_flags (uint8) and headers (uint8, the first HEADER_LEN bytes)
+       Note: The fields of packets that aren't IPv4 (or TCP/UDP for the ports/flags) are 0
+    """
+    fields = ('timestamp', 'packet_num', 'caplen', 'eth_len', 'eth_type', 'ip', 'src', 'dst', 'proto', 'ttl',
+              'ip_len', 'frag', 'checksum', 'sport', 'dport', 'tcp_flags', 'headers')
+
+    def __init__(self, **columns):
+        """PacketColumns Initialization"""
+        for field in self.fields:
+            setattr(self, field, columns[field])
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def __iter__(self):
+        return self.rows()
+
+    def rows(self, mask=None):
+        """Generator for the rows as dictionaries
+
+           Args:
+               mask: a boolean array (or index array) to pick the rows (defaults to None, all rows)
+           Returns:
+               generator (dictionary): see row()
+        """
+        indexes = range(len(self)) if mask is None else np.arange(len(self))[mask]
+        for index in indexes:
+            yield self.row(index)
+
+    def row(self, index):
+        """A packet as a dictionary in the PacketMeta/TransportMeta schema (just the header fields,
+           the payloads aren't kept so the 'data' values are None)
+
+           Args:
+               index: the row
+           Returns:
+               dictionary: timestamp, packet_num, eth, packet, transport (None if not TCP/UDP) and application
+        """
+        headers = self.headers[index]
+        output = {'timestamp': datetime.datetime.utcfromtimestamp(float(self.timestamp[index])),
+                  'packet_num': int(self.packet_num[index]),
+                  'eth': {'src': headers[6:12].tobytes(), 'dst': headers[:6].tobytes(),
+                          'type': int(self.eth_type[index]), 'len': int(self.eth_len[index])},
+                  'transport': None, 'application': None}
+
+        # Only the IPv4 headers are decoded
+        if not self.ip[index]:
+            output['packet'] = {'type': None, 'data': None}
+            return output
+        frag = int(self.frag[index])
+        output['packet'] = {'type': 'IP', 'data': None, 'src': struct.pack('!I', self.src[index]),
+                            'dst': struct.pack('!I', self.dst[index]), 'p': int(self.proto[index]),
+                            'len': int(self.ip_len[index]), 'ttl': int(self.ttl[index]), 'df': bool(frag & 0x4000),
+                            'mf': bool(frag & 0x2000), 'offset': frag & 0x1fff, 'checksum': int(self.checksum[index])}
+
+        # TCP/UDP ports (and flags)
+        proto = output['packet']['p']
+        if self.sport[index] or self.dport[index]:
+            output['transport'] = {'type': 'TCP' if proto == IP_PROTO_TCP else 'UDP', 'data': None,
+                                   'sport': int(self.sport[index]), 'dport': int(self.dport[index]),
+                                   'flags': readable_flags(int(self.tcp_flags[index])) if proto == IP_PROTO_TCP else None}
+            if proto == IP_PROTO_TCP:
+                output['transport']['flag_bits'] = int(self.tcp_flags[index])
+        return output
+
+
+def readable_flags(flags):
+    """TCP flag bits as the TransportMeta readable list (e.g. ['syn_ack'])"""
+    if flags & TH_SYN:
+        return ['syn_ack'] if flags & TH_ACK else ['syn']
+    elif flags & TH_FIN:
+        return ['fin_ack'] if flags & TH_ACK else ['fin']
+    elif flags & TH_RST:
+        return ['rst']
+    elif flags & TH_PUSH:
+        return ['psh']
+    return []
+
+def pack_headers(raw_bufs):
+    """Pack the first HEADER_LEN bytes of each frame into one (n, HEADER_LEN) uint8 array
+
+       Args:
+           raw_bufs: the raw frames
+       Returns:
+           tuple: (headers array, caplen array)
+    """
+    pad = b'\x00' * HEADER_LEN
+    packed = b''.join([bytes(raw_buf[:HEADER_LEN]) + pad[len(raw_buf):] for raw_buf in raw_bufs])
+    headers = np.frombuffer(packed, dtype=np.uint8).reshape(len(raw_bufs), HEADER_LEN)
+    caplen = np.array([len(raw_buf) for raw_buf in raw_bufs], dtype=np.uint32)
+    return headers, caplen
+
+def decode_batch(packets):
+    """Decode a batch of packets into columns
+
+       Args:
+           packets: a list of packets from a source (timestamp, raw_buf, packet_num)
+       Returns:
+           PacketColumns: the header fields as arrays
+    """
+    if np is None:
+        raise ImportError('Columnar decoding requires numpy (pip install numpy)')
+    count = len(packets)
+    headers, caplen = pack_headers([packet['raw_buf'] for packet in packets])
+    rows = np.arange(count)
+    wide = headers.astype(np.uint32)
+
+    def u8(offset):
+        return wide[rows, offset]
+
+    def u16(offset):
+        return (wide[rows, offset] << 8) | wide[rows, offset + 1]
+
+    def u32(offset):
+        return (u16(offset) << 16) | u16(offset + 2)
+
+    # Ethernet (up to two VLAN tags like dpkt)
+    eth_type = u16(np.full(count, 12))
+    next_type = eth_type
+    l3 = np.full(count, 14)
+    tagged = np.isin(next_type, ETH_TYPES_QINQ)
+    for _ in range(2):
+        next_type = np.where(tagged, u16(l3 + 2), next_type)
+        l3 = l3 + 4 * tagged
+        tagged = tagged & (next_type == ETH_TYPE_8021Q)
+
+    # IPv4
+    ip = (next_type == ETH_TYPE_IP) & (caplen >= l3 + 20)
+    ihl = (u8(l3) & 0xf) * 4
+    ip_len = np.where(ip, u16(l3 + 2), 0)
+    frag = np.where(ip, u16(l3 + 6), 0)
+    proto = np.where(ip, u8(l3 + 9), 0)
+
+    # TCP/UDP (not for fragments past the first one)
+    l4 = l3 + ihl
+    ports = ip & (ihl >= 20) & ((frag & 0x1fff) == 0) & np.isin(proto, (IP_PROTO_TCP, IP_PROTO_UDP)) & (caplen >= l4 + 4)
+    l4 = np.where(ports, l4, 0)
+    tcp = ports & (proto == IP_PROTO_TCP) & (caplen >= l4 + 14)
+
+    return PacketColumns(timestamp=np.array([packet['timestamp'] for packet in packets], dtype=np.float64),
+                         packet_num=np.array([packet.get('packet_num', 0) for packet in packets], dtype=np.int64),
+                         caplen=caplen,
+                         eth_len=np.where(ip & (ip_len > 0), np.minimum(l3 + ip_len, caplen), caplen).astype(np.uint32),
+                         eth_type=eth_type.astype(np.uint16),
+                         ip=ip,
+                         src=np.where(ip, u32(l3 + 12), 0).astype(np.uint32),
+                         dst=np.where(ip, u32(l3 + 16), 0).astype(np.uint32),
+                         proto=proto.astype(np.uint8),
+                         ttl=np.where(ip, u8(l3 + 8), 0).astype(np.uint8),
+                         ip_len=ip_len.astype(np.uint16),
+                         frag=frag.astype(np.uint16),
+                         checksum=np.where(ip, u16(l3 + 10), 0).astype(np.uint16),
+                         sport=np.where(ports, u16(l4), 0).astype(np.uint16),
+                         dport=np.where(ports, u16(l4 + 2), 0).astype(np.uint16),
+                         tcp_flags=np.where(tcp, u8(l4 + 13), 0).astype(np.uint8),
+                         headers=headers)
+
+
+def test():
+    """Test for the columnar decoder (compared against PacketMeta/TransportMeta)"""
+    from chains.sources import packet_streamer
+    from chains.links import packet_meta, transport_meta
+    from chains.utils import file_utils
+    if np is None:
+        print('numpy not installed, skipping the columnar test')
+        return
+
+    for pcap in ['http.pcap', 'dns.pcap']:
+        data_path = file_utils.relative_dir(__file__, '../../data/' + pcap)
+        streamer = packet_streamer.PacketStreamer(iface_name=data_path)
+        packets = [dict(packet, raw_buf=bytes(packet['raw_buf'])) for packet in streamer.output_stream]
+        columns = decode_batch(packets)
+        assert len(columns) == len(packets)
+
+        # Same header fields as the dictionaries
+        meta = packet_meta.PacketMeta()
+        tmeta = transport_meta.TransportMeta()
+        meta.link(iter(packets))
+        tmeta.link(meta)
+        for row, item in zip(columns, tmeta.output_stream):
+            assert row['timestamp'] == item['timestamp'] and row['eth'] == item['eth']
+            assert row['packet'] == dict(item['packet'], data=None)
+            transport = item['transport']
+            if transport:
+                expected_transport = {'type': transport['type'], 'data': None, 'sport': transport['sport'],
+                                      'dport': transport['dport'], 'flags': transport['flags']}
+                if 'flag_bits' in transport:
+                    expected_transport['flag_bits'] = transport['flag_bits']
+                assert row['transport'] == expected_transport
+
+        # Top talkers
+        talkers, index = np.unique(columns.src[columns.ip], return_inverse=True)
+        talker_bytes = np.bincount(index, weights=columns.eth_len[columns.ip])
+        expected = {}
+        for row in columns.rows(columns.ip):
+            expected[row['packet']['src']] = expected.get(row['packet']['src'], 0) + row['eth']['len']
+        assert dict((struct.pack('!I', src), count) for src, count in zip(talkers, talker_bytes)) == expected
+
+    # VLAN tags, fragments and runts
+    ip = b'\x45\x00\x00\x1c\x00\x01\x20\x00\x40\x11\x00\x00' + b'\x0a\x00\x00\x01\x0a\x00\x00\x02'
+    udp = b'\x04\xd2\x00\x35\x00\x08\x00\x00'
+    macs = b'\x01\x02\x03\x04\x05\x06' * 2
+    frames = [macs + b'\x81\x00\x00\x0a\x81\x00\x00\x0b\x08\x00' + ip + udp,
+              macs + b'\x08\x00' + ip[:6] + b'\x00\x10' + ip[8:] + udp,
+              macs + b'\x08\x06' + b'\x00' * 28, macs]
+    columns = decode_batch([{'timestamp': 0.0, 'raw_buf': frame} for frame in frames])
+    assert list(columns.ip) == [True, True, False, False]
+    assert list(columns.sport) == [1234, 0, 0, 0] and list(columns.eth_type) == [0x8100, 0x0800, 0x0806, 0]
+    assert columns.row(0)['transport']['dport'] == 53 and columns.row(1)['packet']['offset'] == 16
+    assert columns.row(0)['packet']['mf'] and columns.row(2)['packet'] == {'type': None, 'data': None}
+
+if __name__ == '__main__':
+    test()
@@ -6,13 +6,77 @@ from collections import OrderedDict
 # Local imports
 from chains.utils import log_utils
 
+# Per class [field names, extras], see make_dict
+_class_fields = {}
+
 def make_dict(obj):
-    """This method creates a dictionary out of a non-builtin object"""
+    """This method creates a dictionary out of a non-builtin object. The field names of
+       each class (the non-callable class attributes) are worked out once and cached along
+       with the attribute names its objects set on themselves (learned from vars() as new
+       ones show up), after that converting an object is just a read of each field"""
 
     # Recursion base case
     if is_builtin(obj) or isinstance(obj, OrderedDict):
         return obj
 
+    # The field names for this class
+    cls = type(obj)
+    class_fields = _class_fields.get(cls)
+    if class_fields is None:
+        if getattr(cls, '__dir__', None) is not getattr(object, '__dir__', None):
+            return _reflect_dict(obj)
+        class_fields = _class_fields[cls] = _compile_fields(cls)
+    fields, extras = class_fields
+
+    output_dict = {}
+    for key in fields:
+        output_dict[key] = _field_dict(getattr(obj, key))
+
+    # The attributes this object set on itself (anything we haven't seen before gets learned)
+    obj_dict = getattr(obj, '__dict__', None)
+    if obj_dict:
+        found = 0
+        for key, include in extras:
+            if key in obj_dict:
+                found += 1
+                if include:
+                    output_dict[key] = _field_dict(obj_dict[key])
+        if found < len(obj_dict):
+            _learn_extras(class_fields, obj, output_dict)
+
+    # All done
+    return output_dict
+
+def _field_dict(attr):
+    """Internal method: make_dict for a field value (lists are converted item by item)"""
+    if isinstance(attr, list):
+        return [make_dict(item) for item in attr]
+    return make_dict(attr)
+
+def _compile_fields(cls):
+    """Internal method: [the non-callable class attribute names, no extras yet]"""
+    fields = tuple(key for key in dir(cls) if not key.startswith('__') and not callable(getattr(cls, key, None)))
+    return [fields, ()]
+
+def _learn_extras(class_fields, obj, output_dict):
+    """Internal method: add the attributes an object set on itself that its class hasn't shown before
+       to the class extras (as (name, include) like dir() would) and to the output
+    """
+    fields, extras = class_fields
+    known = set(fields).union(key for key, _include in extras)
+    learned = []
+    for key in list(obj.__dict__):
+        if key in known:
+            continue
+        attr = getattr(obj, key)
+        include = not key.startswith('__') and not callable(attr)
+        learned.append((key, include))
+        if include:
+            output_dict[key] = _field_dict(attr)
+    class_fields[1] = extras + tuple(learned)
+
+def _reflect_dict(obj):
+    """Internal method: make_dict the slow way (for objects with their own __dir__)"""
     output_dict = {}
     for key in dir(obj):
         if not key.startswith('__') and not callable(getattr(obj, key)):
@@ -69,6 +133,60 @@ def test_utils():
     bla.a = 'foo'
     bla.b = 'bar'
     print(make_dict(bla))
+
+    # The cached field lists should give the same output as dir() on every dpkt object
+    import dpkt
+    import struct
+    from chains.utils import file_utils, pcap_reader
+    data_path = file_utils.relative_dir(__file__, '../../data/http.pcap')
+    reader = pcap_reader.PcapReader(data_path)
+    for _timestamp, raw_buf in reader.packets():
+        eth = dpkt.ethernet.Ethernet(bytes(raw_buf))
+        assert make_dict(eth) == _reflect_dict(eth)
+        transport = eth.data.data
+        if isinstance(transport, dpkt.udp.UDP):
+            dns = dpkt.dns.DNS(transport.data)
+            assert make_dict(dns) == _reflect_dict(dns)
+        elif getattr(transport, 'data', b'').startswith(b'GET'):
+            request = dpkt.http.Request(transport.data)
+            assert make_dict(request) == _reflect_dict(request)
+    reader.close()
+
+    # VLAN tags and IPv6 (with the payload under its class name) come out the same way too
+    udp = dpkt.udp.UDP(sport=5353, dport=5353, data=b'hello')
+    udp.ulen = len(udp)
+    ip6_header = b'\x60\x00\x00\x00' + struct.pack('!HBB', len(udp), 17, 64) + b'\xfe\x80' + b'\x00' * 13 + b'\x01' * 17
+    frames = [b'\x01' * 6 + b'\x02' * 6 + b'\x81\x00\x00\x05\x86\xdd' + ip6_header + bytes(udp),
+              b'\x01' * 6 + b'\x02' * 6 + b'\x86\xdd' + ip6_header + bytes(udp)]
+    for frame in frames:
+        eth = dpkt.ethernet.Ethernet(frame)
+        assert make_dict(eth) == _reflect_dict(eth)
+        assert make_dict(eth.data)['udp']['data'] == b'hello'
+    assert 'vlan_tags' in make_dict(dpkt.ethernet.Ethernet(frames[0]))
+
+    # TLS records, DNS records of each type and ICMP errors (each class learns its extras as they show up)
+    records = [dpkt.ssl.TLSRecord(b'\x16\x03\x01\x00\x05hello'), dpkt.ssl.TLSRecord(b'\x17\x03\x03\x00\x02hi')]
+    records[1].compressed = False
+    rrs = []
+    for rr_type, rdata in [(dpkt.dns.DNS_A, b'\x0a\x00\x00\x01'), (dpkt.dns.DNS_CNAME, b'\x03www\x00'),
+                           (dpkt.dns.DNS_MX, b'\x00\x0a\x02mx\x00'), (dpkt.dns.DNS_TXT, b'\x02hi')]:
+        rr = dpkt.dns.DNS.RR(name='example.com', type=rr_type, rdata=rdata)
+        dns = dpkt.dns.DNS(id=1, qd=[], an=[rr])
+        rrs += dpkt.dns.DNS(bytes(dns)).an
+    unreach = dpkt.icmp.ICMP(bytes(dpkt.icmp.ICMP(type=3, data=dpkt.icmp.ICMP.Unreach(data=dpkt.ip.IP()))))
+    for obj in records + rrs + [unreach, unreach.data]:
+        assert make_dict(obj) == _reflect_dict(obj), obj.__class__.__name__
+    assert 'encrypted' in make_dict(records[0]) and make_dict(records[1])['compressed'] is False
+    assert make_dict(rrs[1])['cname'] == 'www' and 'mxname' in make_dict(rrs[2])
+
+    # Attributes set on an object (including callables) are handled like dir() does
+    item = bla()
+    item.c = 'baz'
+    item.d = len
+    assert make_dict(item) == _reflect_dict(item) == {'a': 'foo', 'b': 'bar', 'c': 'baz'}
+    other = bla()
+    other.e = [bla()]
+    assert make_dict(other) == _reflect_dict(other) == {'a': 'foo', 'b': 'bar', 'e': [{'a': 'foo', 'b': 'bar'}]}
     print('Success!')
 
 if __name__ == '__main__':
@@ -0,0 +1,92 @@
+"""DNSStore: Passive DNS table of ip address -> queried name, built from the DNS answers seen on the wire"""
+from __future__ import print_function
+import time
+
+# Local imports
+from chains.utils import cache
+
+
+class DNSStore(object):
+    """Bounded ip address -> name table where each entry lives for its DNS answer TTL.
+       Usage:
+            store = DNSStore(max_size=2)
+            store.add('93.184.216.34', 'example.com', ttl=300)
+            store.lookup('93.184.216.34')
+            >>> example.com
+            store.lookup('10.0.0.1')
+            >>> None
+
+       Args:
+            max_size (int): the maximum number of ip addresses kept, the least recently
+                            seen ones go first (defaults to 100000)
+            min_ttl (int): floor on the answer TTLs, CDN answers often have TTLs of a
+                           few seconds (defaults to 60)
+            clock (callable): returns the current time in seconds (defaults to time.time)
+    """
+    def __init__(self, max_size=100000, min_ttl=60, clock=time.time):
+        """DNSStore Initialization"""
+        self._store = cache.Cache(max_size=max_size, clock=clock)
+        self.max_size = max_size
+        self.min_ttl = min_ttl
+
+    def add(self, ip_address, name, ttl):
+        """Add (or refresh) an ip address -> name entry
+
+           Args:
+               ip_address: the ip address (as a str)
+               name: the name that was queried
+               ttl: the TTL in seconds from the DNS answer
+        """
+        self._store.set(ip_address, name, ttl=max(ttl, self.min_ttl, 1))
+
+    def lookup(self, ip_address):
+        """Get the name for an ip address
+
+           Args:
+               ip_address: the ip address (as a str)
+           Returns:
+               the name or None if the ip address isn't in the store (or has expired)
+        """
+        return self._store.get(ip_address)
+
+    def stats(self):
+        """Get the store counters (see Cache.stats)"""
+        return self._store.stats()
+
+    def __len__(self):
+        """Number of ip addresses in the store"""
+        return len(self._store)
+
+
+def test():
+    """Test for the DNSStore class"""
+
+    # Add/lookup (with a fake clock)
+    now = [1000.0]
+    store = DNSStore(max_size=3, min_ttl=10, clock=lambda: now[0])
+    store.add('1.1.1.1', 'one.one.one.one', ttl=300)
+    now[0] = 1100
+    assert store.lookup('1.1.1.1') == 'one.one.one.one'
+    assert store.lookup('2.2.2.2') is None
+
+    # TTLs (with the floor)
+    store.add('3.3.3.3', 'short.ttl', ttl=1)
+    now[0] = 1105
+    assert store.lookup('3.3.3.3') == 'short.ttl'
+    now[0] = 1111
+    assert store.lookup('3.3.3.3') is None
+    now[0] = 1301
+    assert store.lookup('1.1.1.1') is None
+    assert len(store) == 0
+
+    # Bounded, the least recently seen ip address goes first
+    for i in range(3):
+        store.add('10.0.0.%d' % i, 'host%d' % i, ttl=300)
+    store.add('10.0.0.0', 'host0', ttl=300)
+    store.add('10.0.0.3', 'host3', ttl=300)
+    assert len(store) == 3
+    assert store.lookup('10.0.0.1') is None
+    assert store.lookup('10.0.0.0') == 'host0'
+
+if __name__ == '__main__':
+    test()
@@ -1,30 +1,212 @@
 """Flow class for aggregating packets into a Flow"""
 from __future__ import print_function
 
-from datetime import datetime, timedelta
+import time
+import heapq
+import struct
+from datetime import datetime
 from collections import defaultdict
 
 # Local imports
-from chains.utils import file_utils, net_utils
+from chains.utils import file_utils, net_utils, net_classifier, packet_record
+
+# Start of time for converting datetimes into seconds since the epoch
+EPOCH = datetime(1970, 1, 1)
+
+# TCP sequence numbers are 32 bits
+SEQ_MOD = 2**32
+SEQ_HALF = 2**31
+
+# TCP flag bits that close a flow
+TH_FIN = 0x01
+TH_RST = 0x04
+
+# EtherTypes and IPv6 extension headers that raw_flow_key() walks over
+ETH_TYPE_IP = 0x0800
+ETH_TYPE_IP6 = 0x86dd
+ETH_TYPE_VLANS = (0x8100, 0x88a8)
+IP6_EXT_HEADERS = (0, 43, 44, 60)
 
 # Helper methods
 def flow_tuple(data):
     """Tuple for flow (src, dst, sport, dport, proto)"""
-    src = net_utils.inet_to_str(data['packet'].get('src')) if data['packet'].get('src') else None
-    dst = net_utils.inet_to_str(data['packet'].get('dst')) if data['packet'].get('dst') else None
+    src = data['packet'].get('src')
+    dst = data['packet'].get('dst')
+    src = net_utils.inet_to_str(src) if src else None
+    dst = net_utils.inet_to_str(dst) if dst else None
     sport = data['transport'].get('sport') if data.get('transport') else None
     dport = data['transport'].get('dport') if data.get('transport') else None
     proto = data['transport'].get('type') if data.get('transport') else data['packet']['type']
     return (src, dst, sport, dport, proto)
 
+def event_time(data):
+    """Packet timestamp in seconds since the epoch (PacketMeta gives us a UTC datetime)"""
+    if isinstance(data, packet_record.PacketRecord):
+        return data.ts
+    timestamp = data['timestamp']
+    if isinstance(timestamp, datetime):
+        return (timestamp - EPOCH).total_seconds()
+    return timestamp
+
+def raw_flow_key(raw_buf):
+    """Direction normalized flow key pulled straight out of a raw Ethernet frame (no dpkt decode)
+
+       Args:
+           raw_buf: the raw packet (bytes or memoryview)
+       Returns:
+           bytes: the same key for both directions of a flow (b'' for non IP packets)
+    """
+    size = len(raw_buf)
+    if size < 14:
+        return b''
+    eth_type, = struct.unpack_from('!H', raw_buf, 12)
+    offset = 14
+    while eth_type in ETH_TYPE_VLANS and offset + 4 <= size:
+        eth_type, = struct.unpack_from('!H', raw_buf, offset+2)
+        offset += 4
+
+    # IPv4
+    if eth_type == ETH_TYPE_IP and offset + 20 <= size:
+        ver_ihl, frag, proto, src, dst = struct.unpack_from('!B5xH1xB2x4s4s', raw_buf, offset)
+        frag_offset = frag & 0x1fff
+        offset += (ver_ihl & 0x0f) * 4
+
+    # IPv6 (skipping over the extension headers)
+    elif eth_type == ETH_TYPE_IP6 and offset + 40 <= size:
+        proto, src, dst = struct.unpack_from('!6xB1x16s16s', raw_buf, offset)
+        frag_offset = 0
+        offset += 40
+        while proto in IP6_EXT_HEADERS and offset + 8 <= size:
+            if proto == 44:
+                proto, frag = struct.unpack_from('!B1xH', raw_buf, offset)
+                frag_offset = frag >> 3
+                offset += 8
+            else:
+                proto, ext_len = struct.unpack_from('!BB', raw_buf, offset)
+                offset += (ext_len + 1) * 8
+    else:
+        return b''
+
+    # Ports (TCP/UDP and not a trailing fragment)
+    sport = dport = 0
+    if proto in (6, 17) and not frag_offset and offset + 4 <= size:
+        sport, dport = struct.unpack_from('!HH', raw_buf, offset)
+    src_end = src + struct.pack('!H', sport)
+    dst_end = dst + struct.pack('!H', dport)
+    if dst_end < src_end:
+        src_end, dst_end = dst_end, src_end
+    return src_end + dst_end + struct.pack('!B', proto)
+
 def _flow_tuple_reversed(f_tuple):
     """Reversed tuple for flow (dst, src, dport, sport, proto)"""
     return (f_tuple[1], f_tuple[0], f_tuple[3], f_tuple[2], f_tuple[4])
 
+class TCPReassembler(object):
+    """Incremental reassembly of one direction of a TCP stream.
+       In order data is appended straight onto the payload, out of order segments wait in
+       a heap (keyed on stream offset) until the gap in front of them is filled.
+       Usage:
+            stream = TCPReassembler()
+            stream.add(1000, b'', syn=True)
+            stream.add(1006, b'world')
+            stream.add(1001, b'hello')
+            stream.flush()
+            >>> bytearray(b'helloworld')
+    """
+    def __init__(self):
+        """Initialize TCPReassembler Class"""
+        self.payload = bytearray()
+        self.next_seq = None
+        self._offset = 0
+        self._pending = []
+        self._segments = {}
+
+        # Counters
+        self.retransmitted = 0
+        self.missing = 0
+
+    def add(self, seq, data, syn=False):
+        """Add a segment to the stream
+
+           Args:
+               seq: the TCP sequence number of the segment
+               data: the segment payload
+               syn: is the SYN flag set? (the SYN uses up a sequence number)
+        """
+        if syn:
+            seq = (seq + 1) % SEQ_MOD
+        if self.next_seq is None:
+            self.next_seq = seq
+        if not data:
+            return
+
+        # Signed distance from the next byte we expect (handles sequence wraparound)
+        delta = (seq - self.next_seq + SEQ_HALF) % SEQ_MOD - SEQ_HALF
+
+        # At (or overlapping) the next byte we expect: trim off what we already have
+        if delta <= 0:
+            if -delta >= len(data):
+                self.retransmitted += len(data)
+                return
+            self.retransmitted += -delta
+            self._append(data[-delta:])
+            self._drain()
+
+        # Out of order, hold it until the gap is filled (keep the longer copy of duplicates)
+        else:
+            offset = self._offset + delta
+            existing = self._segments.get(offset)
+            if existing is None:
+                heapq.heappush(self._pending, offset)
+                self._segments[offset] = data
+            elif len(data) > len(existing):
+                self._segments[offset] = data
+
+    def flush(self):
+        """Append any segments still waiting behind a gap (the missing bytes are counted in missing)
+
+           Returns:
+               bytearray: the reassembled payload
+        """
+        while self._pending:
+            offset = self._pending[0]
+            if offset > self._offset:
+                self.missing += offset - self._offset
+                self.next_seq = (self.next_seq + offset - self._offset) % SEQ_MOD
+                self._offset = offset
+            self._drain()
+        return self.payload
+
+    def _append(self, data):
+        """Internal method: append in order data to the payload"""
+        self.payload += data
+        self._offset += len(data)
+        self.next_seq = (self.next_seq + len(data)) % SEQ_MOD
+
+    def _drain(self):
+        """Internal method: append the waiting segments that are now in order"""
+        pending = self._pending
+        while pending and pending[0] <= self._offset:
+            offset = heapq.heappop(pending)
+            data = self._segments.pop(offset)
+            skip = self._offset - offset
+            if skip >= len(data):
+                self.retransmitted += len(data)
+            else:
+                self.retransmitted += skip
+                self._append(data[skip:])
+
 class Flow(object):
-    """Flow object"""
+    """Flow object
 
-    def __init__(self):
+       Args:
+           idle_timeout: seconds without a packet before the flow expires (defaults to 5)
+           active_timeout: seconds after the first packet before the flow expires (defaults to 60)
+           keep_packets: keep every packet in the packet_list (defaults to True), when False only the
+                         reassembled payload is kept, so packet dicts are released as soon as they're added
+    """
+
+    def __init__(self, idle_timeout=5, active_timeout=60, keep_packets=True):
         """Initialize Flow Class"""
 
         # Set up my meta data
@@ -39,17 +221,39 @@ class Flow(object):
         self.meta['protocol'] = None
         self.meta['direction'] = None
         self.meta['packet_list'] = []
+        self.meta['packet_count'] = 0
         self.meta['payload'] = b''
         self.meta['start'] = None
         self.meta['end'] = None
         self.meta['state'] = 'partial'
-        self.meta['timeout'] = datetime.now() + timedelta(seconds=5)
-
-    def add_packet(self, packet):
-        """Add a packet to this flow"""
+        self.meta['timeout'] = None
+
+        # Expiration info
+        self.idle_timeout = idle_timeout
+        self.active_timeout = active_timeout
+        self.first_seen = None
+        self.last_seen = None
+        self.closed = False
+
+        # TCP stream reassembly (flows are directional, so one stream per flow)
+        self.keep_packets = keep_packets
+        self._stream = None
+
+    def add_packet(self, packet, now=None):
+        """Add a packet to this flow
+
+           Args:
+               packet: the packet dictionary
+               now: the current time in seconds since the epoch, either wall clock or
+                    packet (event) time (defaults to time.time())
+        """
+        # Event time can step backwards (out of order packets) but the flow never gets younger
+        now = time.time() if now is None else now
+        self.last_seen = now if self.last_seen is None else max(self.last_seen, now)
 
         # First packet?
         if not self.meta['flow_id']:
+            self.first_seen = self.last_seen
             self.meta['flow_id'] = flow_tuple(packet)
             self.meta['src'] = self.meta['flow_id'][0]
             self.meta['dst'] = self.meta['flow_id'][1]
@@ -63,7 +267,9 @@ class Flow(object):
             self.meta['end'] = packet['timestamp']
 
         # Add the packet
-        self.meta['packet_list'].append(packet)
+        self.meta['packet_count'] += 1
+        if self.keep_packets:
+            self.meta['packet_list'].append(packet)
         if packet['timestamp'] < self.meta['start']:
             self.meta['start'] = packet['timestamp']
         if packet['timestamp'] > self.meta['end']:
@@ -72,41 +278,66 @@ class Flow(object):
         # State of connection/flow
         if self.meta['protocol'] == 'TCP':
             flags = packet['transport']['flags']
+
+            # Reassemble the payload as we go
+            if self._stream is None:
+                self._stream = TCPReassembler()
+            self._stream.add(packet['transport']['seq'], packet['transport']['data'],
+                             syn='syn' in flags or 'syn_ack' in flags)
+
             if 'syn' in flags:
                 self.meta['state'] = 'partial_syn'
                 self.meta['direction'] = 'CTS'
             elif 'fin' in flags:
                 # print('--- FIN RECEIVED %s ---'  % str(self.meta['flow_id))
                 self.meta['state'] = 'complete' if self.meta['state'] == 'partial_syn' else 'partial'
-                self.meta['timeout'] = datetime.now() + timedelta(seconds=1)
+                self.closed = True
             elif 'syn_ack' in flags:
                 self.meta['state'] = 'partial_syn'
                 self.meta['direction'] = 'STC'
             elif 'fin_ack'in flags:
                 # print('--- FIN_ACK RECEIVED %s ---' % str(self.meta['flow_id))
                 self.meta['state'] = 'complete' if self.meta['state'] == 'partial_syn' else 'partial'
-                self.meta['timeout'] = datetime.now() + timedelta(seconds=1)
+                self.closed = True
             elif 'rst' in flags:
                 # print('--- RESET RECEIVED %s ---' % str(self.meta['flow_id))
                 self.meta['state'] = 'partial'
-                self.meta['timeout'] = datetime.now() + timedelta(seconds=1)
+                self.closed = True
 
         # Only collect UDP and TCP
         if self.meta['protocol'] not in ['UDP', 'TCP']:
-            self.meta['timeout'] = datetime.now()
+            self.closed = True
+
+    @property
+    def flow_id(self):
+        """The flow tuple for this flow"""
+        return self.meta['flow_id']
+
+    @property
+    def start(self):
+        """The timestamp of the earliest packet in this flow"""
+        return self.meta['start']
 
     def get_flow(self):
         """Reassemble the flow and return all the info/data"""
-        if self.meta['protocol'] == 'TCP':
-            self.meta['packet_list'].sort(key=lambda packet: packet['transport']['seq'])
-            for packet in self.meta['packet_list']:
-                self.meta['payload'] += packet['transport']['data']
-
+        self.meta['timeout'] = self.deadline()
+        if self._stream is not None:
+            self.meta['payload'] = bytes(self._stream.flush())
         return self.meta
 
-    def ready(self):
+    def deadline(self):
+        """When does this flow expire? (closed flows expire right away)
+
+           Returns:
+               the expiration time in seconds since the epoch
+        """
+        if self.closed:
+            return self.last_seen
+        return min(self.last_seen + self.idle_timeout, self.first_seen + self.active_timeout)
+
+    def ready(self, now=None):
         """Is this flow ready to go?"""
-        return datetime.now() > self.meta['timeout']
+        return (time.time() if now is None else now) >= self.deadline()
 
     @staticmethod
     def _cts_or_stc(data):
@@ -145,20 +376,101 @@ class Flow(object):
 
         # Internal/External
         if 'src' in data['packet'] and 'dst' in data['packet']:
-            src = net_utils.inet_to_str(data['packet']['src'])
-            dst = net_utils.inet_to_str(data['packet']['dst'])
+            src_internal = net_classifier.is_internal(data['packet']['src'])
+            dst_internal = net_classifier.is_internal(data['packet']['dst'])
 
             # Internal talking to external?
-            if net_utils.is_internal(src) and not net_utils.is_internal(dst):
+            if src_internal and not dst_internal:
                 return 'CTS'
 
             # External talking to internal?
-            if net_utils.is_internal(dst) and not net_utils.is_internal(src):
+            if dst_internal and not src_internal:
                 return 'STC'
 
         # Okay we have no idea
         return 'CTS'
 
+class FlowRecord(object):
+    """Counters only (NetFlow style) flow record, stays the same size no matter how many packets
+       are in the flow (no meta dict, packet list or payload, just slots)
+
+       Args:
+           idle_timeout: seconds without a packet before the flow expires (defaults to 5)
+           active_timeout: seconds after the first packet before the flow expires (defaults to 60)
+    """
+    __slots__ = ('flow_id', 'direction', 'packets', 'bytes', 'start', 'end', 'tcp_flags',
+                 'first_seen', 'last_seen', 'closed', 'idle_timeout', 'active_timeout')
+
+    def __init__(self, idle_timeout=5, active_timeout=60):
+        """Initialize FlowRecord Class"""
+        self.flow_id = None
+        self.direction = None
+        self.packets = 0
+        self.bytes = 0
+        self.start = None
+        self.end = None
+        self.tcp_flags = 0
+        self.first_seen = None
+        self.last_seen = None
+        self.closed = False
+        self.idle_timeout = idle_timeout
+        self.active_timeout = active_timeout
+
+    def add_packet(self, packet, now=None):
+        """Count a packet in this flow
+
+           Args:
+               packet: the packet dictionary
+               now: the current time in seconds since the epoch, either wall clock or
+                    packet (event) time (defaults to time.time())
+        """
+        now = time.time() if now is None else now
+        self.last_seen = now if self.last_seen is None else max(self.last_seen, now)
+        timestamp = packet['timestamp']
+
+        # First packet?
+        if self.flow_id is None:
+            self.flow_id = flow_tuple(packet)
+            self.direction = Flow._cts_or_stc(packet)
+            self.first_seen = self.last_seen
+            self.start = self.end = timestamp
+
+            # Only collect UDP and TCP
+            if self.flow_id[4] not in ('UDP', 'TCP'):
+                self.closed = True
+        elif timestamp < self.start:
+            self.start = timestamp
+        elif timestamp > self.end:
+            self.end = timestamp
+
+        # Counters (bytes are frame bytes)
+        self.packets += 1
+        self.bytes += packet['eth']['len']
+
+        # TCP flag union (FIN/RST close the flow)
+        if self.flow_id[4] == 'TCP':
+            flags = packet['transport'].get('flag_bits', 0)
+            self.tcp_flags |= flags
+            if flags & (TH_FIN | TH_RST):
+                self.closed = True
+
+    def get_flow(self):
+        """Return the flow record as a dictionary"""
+        return {'flow_id': self.flow_id, 'src': self.flow_id[0], 'dst': self.flow_id[1], 'sport': self.flow_id[2],
+                'dport': self.flow_id[3], 'protocol': self.flow_id[4], 'direction': self.direction,
+                'packet_count': self.packets, 'bytes': self.bytes, 'start': self.start, 'end': self.end,
+                'tcp_flags': self.tcp_flags, 'timeout': self.deadline()}
+
+    def deadline(self):
+        """When does this flow expire? (closed flows expire right away)
+
+           Returns:
+               the expiration time in seconds since the epoch
+        """
+        if self.closed:
+            return self.last_seen
+        return min(self.last_seen + self.idle_timeout, self.first_seen + self.active_timeout)
+
 def test():
     """Test for the Flow class"""
 
@@ -190,6 +502,71 @@ def test():
         print('Flow %s -- Packets:%d Bytes:%d Payload: %s' % (fd['flow_id'], len(fd['packet_list']),
                                                               len(fd['payload']), repr(fd['payload'])[:20]))
 
+    # Flow records have the same counts as the flows
+    streamer = packet_streamer.PacketStreamer(iface_name=data_path, max_packets=100)
+    meta = packet_meta.PacketMeta()
+    rdns = reverse_dns.ReverseDNS()
+    tmeta = transport_meta.TransportMeta()
+    meta.link(streamer)
+    rdns.link(meta)
+    tmeta.link(rdns)
+    records = defaultdict(FlowRecord)
+    flag_union = defaultdict(int)
+    first_packet = None
+    for packet in tmeta.output_stream:
+        records[flow_tuple(packet)].add_packet(packet)
+        flag_union[flow_tuple(packet)] |= getattr(packet['packet']['data'], 'flags', 0)
+        first_packet = first_packet or packet
+    assert not hasattr(FlowRecord(), '__dict__')
+    for flow_id, record in records.items():
+        record_info = record.get_flow()
+        assert record_info['packet_count'] == flows[flow_id].meta['packet_count']
+        assert record_info['direction'] == flows[flow_id].meta['direction'] or record_info['protocol'] == 'TCP'
+        assert record_info['tcp_flags'] == (flag_union[flow_id] if record_info['protocol'] == 'TCP' else 0)
+        print('Flow %s -- Packets:%d Bytes:%d Flags:%#x' % (flow_id, record_info['packet_count'],
+                                                            record_info['bytes'], record_info['tcp_flags']))
+
+    # Raw flow keys are the same in both directions and follow the flow tuples
+    streamer = packet_streamer.PacketStreamer(iface_name=data_path, max_packets=100)
+    meta = packet_meta.PacketMeta()
+    tmeta = transport_meta.TransportMeta()
+    meta.link(streamer)
+    tmeta.link(meta)
+    raw_keys = defaultdict(set)
+    for item, packet in zip(packet_streamer.PacketStreamer(iface_name=data_path, max_packets=100).output_stream,
+                            tmeta.output_stream):
+        f_tuple = flow_tuple(packet)
+        raw_keys[frozenset([f_tuple, _flow_tuple_reversed(f_tuple)])].add(raw_flow_key(item['raw_buf']))
+    assert all(len(keys) == 1 for keys in raw_keys.values())
+    assert len(set.union(*raw_keys.values())) == len(raw_keys)
+    assert raw_flow_key(b'\x00' * 10) == b''
+
+    # A late (out of order) packet doesn't pull the expiration back
+    for flow in [Flow(), FlowRecord()]:
+        for now in [100.0, 103.0, 101.0]:
+            flow.add_packet(first_packet, now=now)
+        assert flow.last_seen == 103.0
+
+    # Out of order, overlapping and retransmitted segments
+    stream = TCPReassembler()
+    stream.add(1000, b'', syn=True)
+    stream.add(1011, b'world')
+    stream.add(1006, b' big ')
+    stream.add(1001, b'hel')
+    stream.add(1001, b'hello')
+    stream.add(1009, b'g wo')
+    stream.add(1016, b'!')
+    assert stream.flush() == bytearray(b'hello big world!')
+    assert stream.retransmitted == 3 + 4
+
+    # Sequence wraparound and a gap
+    stream = TCPReassembler()
+    stream.add(SEQ_MOD - 3, b'abc')
+    stream.add(5, b'fgh')
+    stream.add(0, b'de')
+    assert stream.flush() == bytearray(b'abcdefgh')
+    assert stream.missing == 3
+
 if __name__ == '__main__':
 
     # Run the test
@@ -0,0 +1,198 @@
+"""NetClassifier: Tag raw inet addresses (4 or 16 bytes) with a network category using CIDR lists"""
+from __future__ import print_function
+import socket
+import struct
+
+# Default networks, the longest matching prefix wins (so 224.0.0.251 is 'multicast_dns' not 'multicast')
+DEFAULT_NETWORKS = [
+    # RFC1918 and IPv6 unique local addresses
+    ('10.0.0.0/8', 'internal'), ('172.16.0.0/12', 'internal'), ('192.168.0.0/16', 'internal'),
+    ('fc00::/7', 'internal'),
+
+    # Link local
+    ('169.254.0.0/16', 'link_local'), ('fe80::/10', 'link_local'),
+
+    # Loopback
+    ('127.0.0.0/8', 'loopback'), ('::1/128', 'loopback'),
+
+    # Multicast (and multicast DNS)
+    ('224.0.0.0/4', 'multicast'), ('ff00::/8', 'multicast'),
+    ('224.0.0.251/32', 'multicast_dns'), ('ff02::fb/128', 'multicast_dns'),
+]
+
+# The categories that count as internal (for traffic direction and reverse DNS)
+INTERNAL_CATEGORIES = ('internal', 'link_local', 'loopback')
+
+_V4 = struct.Struct('!I')
+_V6 = struct.Struct('!QQ')
+
+
+class NetClassifier(object):
+    """Longest prefix match of raw inet addresses against CIDR lists. Each address is turned
+       into an integer and looked up in one table per prefix length, longest first (no strings).
+       Usage:
+            classifier = NetClassifier(networks=[('198.51.100.0/24', 'dmz')])
+            classifier.classify(b'\\xc0\\xa8\\x01\\x01')
+            >>> internal
+            classifier.classify(b'\\xc6\\x33\\x64\\x07')
+            >>> dmz
+            classifier.classify(b'\\x08\\x08\\x08\\x08')
+            >>> None
+
+       Args:
+            networks (list): (cidr, category) pairs on top of the defaults (defaults to None)
+            defaults (bool): load DEFAULT_NETWORKS (defaults to True)
+    """
+    def __init__(self, networks=None, defaults=True):
+        """NetClassifier Initialization"""
+
+        # Per family: list of (shift, {network >> shift: category}) longest prefix first
+        self._tables = {4: [], 16: []}
+        if defaults:
+            self.load(DEFAULT_NETWORKS)
+        if networks:
+            self.load(networks)
+
+    def add(self, cidr, category):
+        """Add a network
+
+           Args:
+               cidr: the network as a str, e.g. '10.0.0.0/8' or 'fc00::/7' (a plain address is a /32 or /128)
+               category: the tag for addresses in this network
+        """
+        address, _, prefix_len = cidr.partition('/')
+        if ':' in address:
+            inet = socket.inet_pton(socket.AF_INET6, address)
+        else:
+            inet = socket.inet_pton(socket.AF_INET, address)
+        bits = len(inet) * 8
+        prefix_len = int(prefix_len) if prefix_len else bits
+        if not 0 <= prefix_len <= bits:
+            raise ValueError('Bad prefix length: {:s}'.format(cidr))
+        shift = bits - prefix_len
+
+        # Find (or make) the table for this prefix length
+        tables = self._tables[len(inet)]
+        for table_shift, table in tables:
+            if table_shift == shift:
+                break
+        else:
+            table = {}
+            tables.append((shift, table))
+            tables.sort(key=lambda entry: entry[0])
+        table[self._to_int(inet) >> shift] = category
+
+    def load(self, networks):
+        """Add networks from (cidr, category) pairs or a {category: [cidr, ...]} dict"""
+        if isinstance(networks, dict):
+            networks = [(cidr, category) for category, cidrs in networks.items() for cidr in cidrs]
+        for cidr, category in networks:
+            self.add(cidr, category)
+
+    def load_file(self, file_path):
+        """Add networks from a file with a 'cidr category' pair on each line ('#' starts a comment)"""
+        with open(file_path) as network_file:
+            for line in network_file:
+                fields = line.split('#', 1)[0].split()
+                if len(fields) >= 2:
+                    self.add(fields[0], fields[1])
+
+    def classify(self, inet):
+        """The category of an address
+
+           Args:
+               inet: the raw address (4 or 16 bytes)
+           Returns:
+               the category of the longest matching network or None
+        """
+        tables = self._tables.get(len(inet))
+        if not tables:
+            return None
+        address = self._to_int(inet)
+        for shift, table in tables:
+            category = table.get(address >> shift)
+            if category is not None:
+                return category
+        return None
+
+    def is_internal(self, inet):
+        """Is the address internal (RFC1918/ULA, link local or loopback)?"""
+        return self.classify(inet) in INTERNAL_CATEGORIES
+
+    @staticmethod
+    def _to_int(inet):
+        """Internal method: raw address bytes to an integer"""
+        if len(inet) == 4:
+            return _V4.unpack(inet)[0]
+        high, low = _V6.unpack(inet)
+        return (high << 64) | low
+
+
+# Shared classifier (add your own networks to it with DEFAULT_CLASSIFIER.add/load)
+DEFAULT_CLASSIFIER = NetClassifier()
+
+def classify(inet):
+    """The category of an address using the shared classifier (see NetClassifier.classify)"""
+    return DEFAULT_CLASSIFIER.classify(inet)
+
+def is_internal(inet):
+    """Is the address internal using the shared classifier (see NetClassifier.is_internal)"""
+    return DEFAULT_CLASSIFIER.is_internal(inet)
+
+
+def test():
+    """Test for the NetClassifier class"""
+    import os
+    import tempfile
+
+    def inet(address):
+        return socket.inet_pton(socket.AF_INET6 if ':' in address else socket.AF_INET, address)
+
+    # Defaults
+    classifier = NetClassifier()
+    expected = {'10.1.2.3': 'internal', '172.16.0.1': 'internal', '172.31.255.255': 'internal',
+                '172.32.0.1': None, '192.168.1.1': 'internal', '192.169.1.1': None, '169.254.1.1': 'link_local',
+                '127.0.0.1': 'loopback', '224.0.0.251': 'multicast_dns', '224.0.0.252': 'multicast',
+                '239.1.1.1': 'multicast', '8.8.8.8': None, 'fd12:3456::1': 'internal', 'fc00::1': 'internal',
+                'fe80::1': 'link_local', 'ff02::fb': 'multicast_dns', 'ff02::1': 'multicast', '::1': 'loopback',
+                'fdfe::1': 'internal', '2001:4860:4860::8888': None}
+    for address, category in expected.items():
+        assert classifier.classify(inet(address)) == category, address
+    assert classifier.is_internal(inet('172.20.1.1'))
+    assert not classifier.is_internal(inet('172.15.1.1'))
+    assert not classifier.is_internal(inet('224.0.0.251'))
+    assert classifier.classify(b'\x01\x02') is None
+
+    # User supplied networks (longest prefix wins)
+    classifier = NetClassifier(networks=[('198.51.100.0/24', 'dmz'), ('10.10.0.0/16', 'lab')])
+    classifier.load({'vpn': ['10.10.5.0/24', '2001:db8::/32']})
+    assert classifier.classify(inet('198.51.100.7')) == 'dmz'
+    assert classifier.classify(inet('10.10.1.1')) == 'lab'
+    assert classifier.classify(inet('10.10.5.1')) == 'vpn'
+    assert classifier.classify(inet('10.11.5.1')) == 'internal'
+    assert classifier.classify(inet('2001:db8:1::1')) == 'vpn'
+
+    # Networks from a file
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as network_file:
+        network_file.write('# Sensor networks\n203.0.113.0/25 sensors\n\n0.0.0.0/0 external  # everything else\n')
+    classifier = NetClassifier(defaults=False)
+    classifier.load_file(network_file.name)
+    os.remove(network_file.name)
+    assert classifier.classify(inet('203.0.113.5')) == 'sensors'
+    assert classifier.classify(inet('203.0.113.200')) == 'external'
+    assert classifier.classify(inet('10.0.0.1')) == 'external'
+    assert classifier.classify(inet('::1')) is None
+
+    # Bad networks
+    try:
+        classifier.add('10.0.0.0/33', 'oops')
+        assert False
+    except ValueError:
+        pass
+
+    # Shared classifier
+    assert classify(inet('192.168.0.1')) == 'internal'
+    assert is_internal(inet('10.0.0.1'))
+
+if __name__ == '__main__':
+    test()
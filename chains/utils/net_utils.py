@@ -8,7 +8,7 @@ import binascii
 import netifaces
 
 # Local imports
-from chains.utils import file_utils, compat
+from chains.utils import file_utils, compat, net_classifier
 
 def get_default_interface():
     """Grab the name of the local default network interface"""
@@ -48,19 +48,30 @@ def str_to_mac(mac_string):
     mac_string = ''.join(sp)
     return binascii.unhexlify(mac_string)
 
+# Raw address bytes -> canonical str, shared by every link/sink (cleared when it fills up)
+ADDRESS_CACHE_SIZE = 65536
+_address_strs = {}
+
 def inet_to_str(inet):
-    """Convert inet object to a string
+    """Convert inet object to a string, each address is only formatted once and every
+       caller gets the same str object back (so dict keys and flow tuples share memory)
 
         Args:
             inet (inet struct): inet network address
         Returns:
             str: Printable/readable IP address
     """
-    # First try ipv4 and then ipv6
-    try:
-        return socket.inet_ntop(socket.AF_INET, inet)
-    except ValueError:
-        return socket.inet_ntop(socket.AF_INET6, inet)
+    # Memoryview/bytearray addresses (DNS answers, mmap'ed packets) get keyed on their bytes
+    if not isinstance(inet, bytes):
+        inet = bytes(bytearray(inet))
+    address = _address_strs.get(inet)
+    if address is None:
+        # IPv4 or IPv6 based on the length
+        address = socket.inet_ntop(socket.AF_INET if len(inet) == 4 else socket.AF_INET6, inet)
+        if len(_address_strs) >= ADDRESS_CACHE_SIZE:
+            _address_strs.clear()
+        _address_strs[inet] = address
+    return address
 
 def str_to_inet(address):
     """Convert an a string IP address to a inet struct
@@ -77,20 +88,17 @@ def str_to_inet(address):
         return socket.inet_pton(socket.AF_INET6, address)
 
 def is_internal(ip_address):
-    """Determine if the address is an internal ip address
-       Note: This is super bad, improve it
+    """Determine if the address is an internal ip address (RFC1918/ULA, link local or loopback)
+       Note: This converts the str back to an inet, use net_classifier.is_internal on inets
     """
-    # Local networks 10.0.0.0/8, 172.16.0.0/12, '192.168.0.0/16
-    local_nets = '10.', '172.16.', '192.168.', '169.254', 'fd', 'fe80::'
-    return any([ip_address.startswith(local) for local in local_nets])
+    return net_classifier.is_internal(str_to_inet(ip_address))
 
 def is_special(ip_address):
-    """Determine if the address is SPECIAL
-       Note: This is super bad, improve it
+    """Determine if the address is SPECIAL (multicast and such)
+       Note: This converts the str back to an inet, use net_classifier.classify on inets
     """
-    special = {'224.0.0.251': 'multicast_dns',
-               'ff02::fb': 'multicast_dns'}
-    return special[ip_address] if ip_address in special else False
+    category = net_classifier.classify(str_to_inet(ip_address))
+    return category if category and category not in net_classifier.INTERNAL_CATEGORIES else False
 
 def test_utils():
     """Test the utility methods"""
@@ -104,10 +112,16 @@ def test_utils():
     print(inet_to_str(b'\x91\xfe\xa0\xed'))
     assert inet_to_str(b'\x91\xfe\xa0\xed') == '145.254.160.237'
     assert str_to_inet('145.254.160.237') == b'\x91\xfe\xa0\xed'
+    assert inet_to_str(b'\x91\xfe\xa0\xed') is inet_to_str(bytes(bytearray(b'\x91\xfe\xa0\xed')))
+    assert inet_to_str(memoryview(bytearray(b'\x91\xfe\xa0\xed'))) == '145.254.160.237'
+    assert inet_to_str(str_to_inet('2001:db8::1')) == '2001:db8::1'
     assert is_internal('10.0.0.1')
     assert is_internal('222.2.2.2') == False
     assert is_special('224.0.0.251')
-    assert is_special('224.0.0.252') == False
+    assert is_special('224.0.0.252') == 'multicast'
+    assert is_special('8.8.8.8') == False
+    assert is_internal('172.31.0.1')
+    assert is_internal('fdfe::1')
 
     my_iface = get_default_interface()
     print(get_mac_address(my_iface))
@@ -0,0 +1,413 @@
+"""PacketRecord: Compact (slotted) packet records with the same dictionary interface as the
+   PacketMeta output dictionaries, so links using item['packet']['src'] just work"""
+from __future__ import print_function
+import datetime
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+
+class Record(MutableMapping):
+    """Base class for the records: a fixed set of fields kept in slots with a dictionary
+       interface on top. Keys that aren't fields (e.g. 'src_domain' from ReverseDNS) go
+       into a small dictionary that's only created when needed."""
+    __slots__ = ('_extra',)
+    fields = ()
+    _field_set = frozenset()
+
+    def __getitem__(self, key):
+        if key in self._field_set:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self._field_set:
+            setattr(self, key, value)
+        elif self._extra is None:
+            self._extra = {key: value}
+        else:
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._field_set:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        if key in self._field_set:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def get(self, key, default=None):
+        if key in self._field_set:
+            return getattr(self, key, default)
+        return self._extra.get(key, default) if self._extra is not None else default
+
+    def __iter__(self):
+        for field in self.fields:
+            if hasattr(self, field):
+                yield field
+        if self._extra is not None:
+            for key in list(self._extra):
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def to_dict(self):
+        """The record as plain (nested) dictionaries"""
+        return dict((key, value.to_dict() if isinstance(value, Record) else value) for key, value in self.items())
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class EthLayer(Record):
+    """The 'eth' layer (src, dst, type, len)"""
+    __slots__ = ('src', 'dst', 'type', 'len')
+    fields = __slots__
+    _field_set = frozenset(fields)
+
+    def __init__(self, src, dst, eth_type, eth_len):
+        self.src = src
+        self.dst = dst
+        self.type = eth_type
+        self.len = eth_len
+        self._extra = None
+
+
+class IPLayer(Record):
+    """The 'packet' layer for IPv4 packets"""
+    __slots__ = ('type', 'data', 'src', 'dst', 'p', 'len', 'ttl', 'df', 'mf', 'offset', 'checksum')
+    fields = __slots__
+    _field_set = frozenset(fields)
+
+    def __init__(self, data, src, dst, p, ip_len, ttl, df, mf, offset, checksum):
+        self.type = 'IP'
+        self.data = data
+        self.src = src
+        self.dst = dst
+        self.p = p
+        self.len = ip_len
+        self.ttl = ttl
+        self.df = df
+        self.mf = mf
+        self.offset = offset
+        self.checksum = checksum
+        self._extra = None
+
+
+class IP6Layer(Record):
+    """The 'packet' layer for IPv6 packets (ttl is the hop limit and len the payload length)"""
+    __slots__ = ('type', 'data', 'src', 'dst', 'p', 'len', 'ttl')
+    fields = __slots__
+    _field_set = frozenset(fields)
+
+    def __init__(self, data, src, dst, p, plen, hlim):
+        self.type = 'IP6'
+        self.data = data
+        self.src = src
+        self.dst = dst
+        self.p = p
+        self.len = plen
+        self.ttl = hlim
+        self._extra = None
+
+
+class PacketRecord(Record):
+    """A packet: the PacketMeta output keys with the timestamp kept as seconds since the epoch
+       (the 'ts' attribute). The 'timestamp' key gives the UTC datetime, built on first use.
+       Usage:
+            record = PacketRecord(1437687540.5, EthLayer(...), IPLayer(...))
+            record['packet']['src']
+            record.ts
+            >>> 1437687540.5
+            record['timestamp']
+            >>> datetime.datetime(2015, 7, 23, 21, 39, 0, 500000)
+
+       Args:
+            ts (float): seconds since the epoch
+            eth: the eth layer (EthLayer or dictionary)
+            packet: the packet layer (IPLayer, IP6Layer or dictionary)
+            transport: the transport layer (defaults to None)
+            application: the application layer (defaults to None)
+    """
+    __slots__ = ('ts', '_datetime', 'eth', 'packet', 'transport', 'application')
+    fields = ('timestamp', 'eth', 'packet', 'transport', 'application')
+    _field_set = frozenset(fields)
+
+    def __init__(self, ts, eth, packet, transport=None, application=None):
+        self.ts = ts
+        self._datetime = None
+        self.eth = eth
+        self.packet = packet
+        self.transport = transport
+        self.application = application
+        self._extra = None
+
+    @property
+    def timestamp(self):
+        """The UTC datetime (or whatever was set as the timestamp)"""
+        if self._datetime is None:
+            self._datetime = datetime.datetime.utcfromtimestamp(self.ts)
+        return self._datetime
+
+    @timestamp.setter
+    def timestamp(self, value):
+        self._datetime = value
+
+
+# Returned by a deferred function when the key shouldn't be there after all (see LazyPacketRecord.defer)
+MISSING = object()
+
+# The PacketRecord slots behind the LazyPacketRecord layer properties
+_ETH_SLOT = PacketRecord.__dict__['eth']
+_PACKET_SLOT = PacketRecord.__dict__['packet']
+_TRANSPORT_SLOT = PacketRecord.__dict__['transport']
+
+
+class LazyPacketRecord(PacketRecord):
+    """A packet that keeps its raw buffer and only decodes a layer the first time it's read
+       (the result is kept). Links can also defer their own keys with defer(), so a pipeline
+       only pays for the layers and keys it actually looks at.
+       Usage:
+            record = LazyPacketRecord(timestamp, raw_buf, decode_layers)
+            record.defer('transport', lambda record: {...})
+            record['packet']['src']   # decodes the eth and packet layers
+            record['transport']       # runs the deferred function
+
+       Args:
+            ts (float): seconds since the epoch
+            raw_buf: the raw frame
+            decode_layers (callable): raw_buf -> (eth, packet) layers
+    """
+    __slots__ = ('raw_buf', '_decode_layers', '_deferred')
+
+    def __init__(self, ts, raw_buf, decode_layers):
+        self.ts = ts
+        self._datetime = None
+        self.raw_buf = raw_buf
+        self._decode_layers = decode_layers
+        self._deferred = None
+        self.application = None
+        self._extra = None
+
+    def defer(self, key, function):
+        """Compute a key when it's first read
+
+           Args:
+               key: the key (a layer like 'transport' or a new key like 'dns')
+               function (callable): record -> value, or MISSING if the key shouldn't be there
+        """
+        if self._deferred is None:
+            self._deferred = {key: function}
+        else:
+            self._deferred[key] = function
+
+    def resolve(self):
+        """Decode everything that's still waiting (e.g. before the record leaves the process)"""
+        self.eth
+        while self._deferred:
+            self._resolve(next(iter(self._deferred)))
+
+    @property
+    def eth(self):
+        """The eth layer (decoded on first use)"""
+        try:
+            return _ETH_SLOT.__get__(self)
+        except AttributeError:
+            return self._layers()[0]
+
+    @eth.setter
+    def eth(self, value):
+        _ETH_SLOT.__set__(self, value)
+
+    @property
+    def packet(self):
+        """The packet layer (decoded on first use)"""
+        try:
+            return _PACKET_SLOT.__get__(self)
+        except AttributeError:
+            return self._layers()[1]
+
+    @packet.setter
+    def packet(self, value):
+        _PACKET_SLOT.__set__(self, value)
+
+    @property
+    def transport(self):
+        """The transport layer (None until a link like TransportMeta defers or sets it)"""
+        try:
+            return _TRANSPORT_SLOT.__get__(self)
+        except AttributeError:
+            if self._deferred and 'transport' in self._deferred:
+                self._resolve('transport')
+                return self.transport
+            return None
+
+    @transport.setter
+    def transport(self, value):
+        _TRANSPORT_SLOT.__set__(self, value)
+
+    def __getitem__(self, key):
+        if self._deferred and key in self._deferred:
+            self._resolve(key)
+        return PacketRecord.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        if self._deferred and key in self._deferred:
+            del self._deferred[key]
+        PacketRecord.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if self._deferred and key in self._deferred:
+            del self._deferred[key]
+        PacketRecord.__delitem__(self, key)
+
+    def __contains__(self, key):
+        # The layers are always there (no need to decode them to say so)
+        if key in self._field_set:
+            return True
+        if self._deferred and key in self._deferred:
+            self._resolve(key)
+        return PacketRecord.__contains__(self, key)
+
+    def get(self, key, default=None):
+        if self._deferred and key in self._deferred:
+            self._resolve(key)
+        return PacketRecord.get(self, key, default)
+
+    def __iter__(self):
+        if self._deferred:
+            for key in list(self._deferred):
+                self._resolve(key)
+        return PacketRecord.__iter__(self)
+
+    def __reduce__(self):
+        """Pickles as a plain PacketRecord with everything decoded (the raw buffer stays here)"""
+        self.resolve()
+        return (_rebuild, (self.ts, self._datetime, self.eth, self.packet, self.transport, self.application,
+                           self._extra))
+
+    def _layers(self):
+        """Internal method: decode the eth and packet layers"""
+        eth, packet = self._decode_layers(self.raw_buf)
+        _ETH_SLOT.__set__(self, eth)
+        _PACKET_SLOT.__set__(self, packet)
+        return eth, packet
+
+    def _resolve(self, key):
+        """Internal method: run the deferred function for a key"""
+        value = self._deferred.pop(key)(self)
+        if value is not MISSING:
+            PacketRecord.__setitem__(self, key, value)
+
+def _rebuild(ts, _datetime, eth, packet, transport, application, extra):
+    """Internal method: unpickle a (lazy) packet record"""
+    record = PacketRecord(ts, eth, packet, transport, application)
+    record._datetime = _datetime
+    record._extra = extra
+    return record
+
+
+def layers(eth, packet):
+    """Turn eth/packet layer dictionaries (the PacketMeta schema) into layer records
+
+       Args:
+           eth (dict): the eth layer
+           packet (dict): the packet layer
+       Returns:
+           tuple: (EthLayer, IPLayer/IP6Layer) or the packet dictionary as is for other packet types
+    """
+    eth = EthLayer(eth['src'], eth['dst'], eth['type'], eth['len'])
+    if packet['type'] == 'IP':
+        packet = IPLayer(packet['data'], packet['src'], packet['dst'], packet['p'], packet['len'], packet['ttl'],
+                         packet['df'], packet['mf'], packet['offset'], packet['checksum'])
+    elif packet['type'] == 'IP6':
+        packet = IP6Layer(packet['data'], packet['src'], packet['dst'], packet['p'], packet['len'], packet['ttl'])
+    return eth, packet
+
+
+def test():
+    """Test for the PacketRecord class"""
+    import sys
+    import pickle
+
+    # Dictionary interface
+    eth = {'src': b'\x00\x01\x02\x03\x04\x05', 'dst': b'\x00\x01\x02\x03\x04\x06', 'type': 2048, 'len': 60}
+    packet = {'type': 'IP', 'data': b'', 'src': b'\x0a\x00\x00\x01', 'dst': b'\x08\x08\x08\x08', 'p': 17,
+              'len': 46, 'ttl': 64, 'df': True, 'mf': False, 'offset': 0, 'checksum': 1234}
+    record = PacketRecord(1437687540.5, *layers(eth, packet))
+    assert record['packet']['src'] == b'\x0a\x00\x00\x01' and record['eth']['len'] == 60
+    assert record.ts == 1437687540.5 and record._datetime is None
+    assert record['timestamp'] == datetime.datetime(2015, 7, 23, 21, 39, 0, 500000)
+    assert record['transport'] is None and record.get('tags') is None and 'tags' not in record
+    record['packet']['src_domain'] = 'internal'
+    record['tags'] = set(['dns'])
+    assert 'src_domain' in record['packet'] and 'tags' in record
+    assert record == {'timestamp': datetime.datetime(2015, 7, 23, 21, 39, 0, 500000), 'eth': eth,
+                      'packet': dict(packet, src_domain='internal'), 'transport': None, 'application': None,
+                      'tags': set(['dns'])}
+    del record['tags']
+    assert list(record.keys()) == ['timestamp', 'eth', 'packet', 'transport', 'application']
+    try:
+        record['nope']
+        assert False
+    except KeyError:
+        pass
+    record['timestamp'] = 12.0
+    assert record['timestamp'] == 12.0
+
+    # Pickles (for the worker processes) and repr
+    assert pickle.loads(pickle.dumps(record, 2)) == record
+    assert repr(record['eth']) == repr(eth)
+
+    # Smaller than the dictionaries
+    record_size = sum(sys.getsizeof(layer) for layer in [record, record['eth'], record['packet']])
+    dict_size = sum(sys.getsizeof(layer) for layer in [record.to_dict(), eth, packet])
+    print('Record {:d} bytes, dictionaries {:d} bytes'.format(record_size, dict_size))
+    assert record_size < dict_size
+
+    # Lazy records only decode what's read
+    calls = []
+
+    def _decode_layers(raw_buf):
+        calls.append(raw_buf)
+        return layers(eth, packet)
+
+    def _transport(record):
+        calls.append('transport')
+        return {'type': 'UDP', 'sport': 1234, 'dport': 53, 'data': b''}
+    record = LazyPacketRecord(1437687540.5, b'raw', _decode_layers)
+    record.defer('transport', _transport)
+    record.defer('dns', lambda record: MISSING)
+    assert 'transport' in record and 'eth' in record and calls == []
+    assert record['packet']['dst'] == b'\x08\x08\x08\x08' and calls == [b'raw']
+    assert record['eth']['len'] == 60 and calls == [b'raw']
+    assert record['transport']['dport'] == 53 and record['transport']['dport'] == 53
+    assert calls == [b'raw', 'transport']
+    assert 'dns' not in record and record.get('dns') is None
+    record['packet']['src_domain'] = 'internal'
+    assert record['packet']['src_domain'] == 'internal'
+
+    # Pickles as a plain record
+    record = LazyPacketRecord(1437687540.5, memoryview(b'raw'), _decode_layers)
+    record.defer('transport', _transport)
+    copy = pickle.loads(pickle.dumps(record, 2))
+    assert type(copy) is PacketRecord and copy == record and copy['transport']['sport'] == 1234
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,290 @@
+"""PcapReader: Pure Python memory mapped reader for pcap and pcapng capture files"""
+from __future__ import print_function
+import os
+import mmap
+import struct
+
+# Local imports
+from chains.utils import file_utils, log_utils
+
+# Classic pcap magic numbers (microsecond and nanosecond timestamps)
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+
+# Pcapng block types
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_IDB = 0x00000001
+PCAPNG_OPB = 0x00000002
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+# Pcapng interface description options
+IF_TSRESOL = 9
+IF_TSOFFSET = 14
+
+
+class PcapReader(object):
+    """Memory map a pcap/pcapng file and walk the record headers with struct.unpack_from
+
+       Args:
+            file_path (str): The capture file to read (classic pcap or pcapng)
+       Usage:
+            reader = PcapReader('test.pcap')
+            for timestamp, raw_buf in reader.packets():
+                print(timestamp, len(raw_buf))
+            reader.close()
+       Note: The raw_buf values are zero-copy memoryview slices into the mapped file.
+    """
+
+    def __init__(self, file_path):
+        """Initialization for PcapReader"""
+        self.file_path = file_path
+        self._mmap = None
+        self._view = memoryview(b'')
+
+        # Map the whole file read-only (mmap can't map an empty file)
+        with open(file_path, 'rb') as capture_file:
+            if os.fstat(capture_file.fileno()).st_size:
+                self._mmap = mmap.mmap(capture_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._view = memoryview(self._mmap)
+
+        # Figure out the file format, byte order and link type
+        self.format, self._endian, self._ts_scale, self.linktype, self.snaplen = self._read_file_header()
+
+    def packets(self):
+        """Generator for the packets in the capture file
+
+           Returns:
+               generator (tuple): (timestamp, raw_buf) for each packet record
+        """
+        view = self._view
+        for timestamp, start, end in self.records():
+            yield timestamp, view[start:end]
+
+    def records(self):
+        """Generator for the packet records in the capture file
+
+           Returns:
+               generator (tuple): (timestamp, start, end) byte offsets of each packet's data
+        """
+        if self.format == 'pcapng':
+            return self._pcapng_records()
+        return self._pcap_records()
+
+    def buffer(self, start, end):
+        """A zero-copy memoryview of the file bytes from start to end (e.g. offsets from records())"""
+        return self._view[start:end]
+
+    def close(self):
+        """Release the memory map (slices still held downstream keep it alive)"""
+        try:
+            self._view.release()
+            if self._mmap:
+                self._mmap.close()
+        except BufferError:
+            pass
+        self._mmap = None
+
+    def _read_file_header(self):
+        """Internal method: sniff the magic number and pull out the file level info
+
+           Returns:
+               tuple: (format, endian, timestamp scale, linktype, snaplen)
+        """
+        if len(self._view) < 24:
+            log_utils.panic('File too small to be a capture file: %s' % self.file_path)
+
+        # Pcapng starts with a Section Header Block (the block type is a palindrome)
+        magic, = struct.unpack_from('<I', self._view, 0)
+        if magic == PCAPNG_SHB:
+            linktype, snaplen = self._pcapng_first_interface()
+            return 'pcapng', None, None, linktype, snaplen
+
+        # Classic pcap in either byte order
+        for endian in ['<', '>']:
+            magic, = struct.unpack_from(endian+'I', self._view, 0)
+            if magic in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+                ts_scale = 1e-6 if magic == PCAP_MAGIC_USEC else 1e-9
+                snaplen, linktype = struct.unpack_from(endian+'II', self._view, 16)
+                return 'pcap', endian, ts_scale, linktype, snaplen
+
+        log_utils.panic('Unknown capture file format: %s' % self.file_path)
+
+    def _pcap_records(self):
+        """Internal method: walk the records of a classic pcap file"""
+        view = self._view
+        size = len(view)
+        ts_scale = self._ts_scale
+        record_header = struct.Struct(self._endian+'IIII')
+        offset = 24
+        while offset + 16 <= size:
+            ts_sec, ts_frac, caplen, _orig_len = record_header.unpack_from(view, offset)
+            start = offset + 16
+            end = start + caplen
+
+            # Truncated record at the end of the file
+            if end > size:
+                break
+            yield ts_sec + ts_frac * ts_scale, start, end
+            offset = end
+
+    def _pcapng_blocks(self):
+        """Internal method: walk the blocks of a pcapng file
+
+           Returns:
+               generator (tuple): (block_type, offset, block_len, endian)
+        """
+        view = self._view
+        size = len(view)
+        endian = '<'
+        offset = 0
+        while offset + 12 <= size:
+
+            # A Section Header Block sets the byte order for the blocks that follow it
+            block_type, = struct.unpack_from(endian+'I', view, offset)
+            if block_type == PCAPNG_SHB:
+                magic, = struct.unpack_from('<I', view, offset+8)
+                endian = '<' if magic == PCAPNG_BYTE_ORDER_MAGIC else '>'
+            block_len, = struct.unpack_from(endian+'I', view, offset+4)
+
+            # Corrupt or truncated block
+            if block_len < 12 or offset + block_len > size:
+                break
+            yield block_type, offset, block_len, endian
+            offset += block_len
+
+    def _pcapng_first_interface(self):
+        """Internal method: linktype and snaplen of the first interface in a pcapng file"""
+        for block_type, offset, _block_len, endian in self._pcapng_blocks():
+            if block_type == PCAPNG_IDB:
+                return struct.unpack_from(endian+'H2xI', self._view, offset+8)
+        return None, None
+
+    def _pcapng_records(self):
+        """Internal method: walk the packet blocks of a pcapng file"""
+        view = self._view
+        interfaces = []
+        timestamp = 0.0
+        for block_type, offset, block_len, endian in self._pcapng_blocks():
+
+            # Enhanced Packet Block (the common case)
+            if block_type == PCAPNG_EPB:
+                iface_id, ts_high, ts_low, caplen = struct.unpack_from(endian+'IIII', view, offset+8)
+                units, ts_offset = interfaces[iface_id][1:]
+                timestamp = ts_offset + ((ts_high << 32) | ts_low) / float(units)
+                start = offset + 28
+                yield timestamp, start, start + caplen
+
+            # Interface Description Block
+            elif block_type == PCAPNG_IDB:
+                linktype, snaplen = struct.unpack_from(endian+'H2xI', view, offset+8)
+                units, ts_offset = self._interface_options(offset+16, offset+block_len-4, endian)
+                interfaces.append((linktype, units, ts_offset))
+
+            # New section, the interface ids start over
+            elif block_type == PCAPNG_SHB:
+                interfaces = []
+
+            # Obsolete Packet Block
+            elif block_type == PCAPNG_OPB:
+                iface_id, _drops, ts_high, ts_low, caplen = struct.unpack_from(endian+'HHIII', view, offset+8)
+                units, ts_offset = interfaces[iface_id][1:]
+                timestamp = ts_offset + ((ts_high << 32) | ts_low) / float(units)
+                start = offset + 28
+                yield timestamp, start, start + caplen
+
+            # Simple Packet Block (no timestamp, so reuse the last one we saw)
+            elif block_type == PCAPNG_SPB:
+                orig_len, = struct.unpack_from(endian+'I', view, offset+8)
+                start = offset + 12
+                yield timestamp, start, start + min(orig_len, block_len - 16)
+
+    def _interface_options(self, offset, end, endian):
+        """Internal method: pull the timestamp resolution and offset out of the IDB options
+
+           Returns:
+               tuple: (timestamp units per second, timestamp offset in seconds)
+        """
+        units = 10**6
+        ts_offset = 0
+        while offset + 4 <= end:
+            code, length = struct.unpack_from(endian+'HH', self._view, offset)
+            if code == 0:
+                break
+            if code == IF_TSRESOL and length >= 1:
+                resol, = struct.unpack_from('B', self._view, offset+4)
+                units = 2 ** (resol & 0x7f) if resol & 0x80 else 10 ** resol
+            elif code == IF_TSOFFSET and length == 8:
+                ts_offset, = struct.unpack_from(endian+'q', self._view, offset+4)
+
+            # Option values are padded to 32 bits
+            offset += 4 + ((length + 3) & ~3)
+        return units, ts_offset
+
+
+def test():
+    """Test for PcapReader class"""
+    import pcapy
+
+    # Classic pcap: compare against pcapy
+    data_path = file_utils.relative_dir(__file__, '../../data/http.pcap')
+    reader = PcapReader(data_path)
+    assert reader.format == 'pcap'
+    pcap = pcapy.open_offline(data_path)
+    for timestamp, raw_buf in reader.packets():
+        header, pcapy_buf = pcap.next()
+        seconds, micro_sec = header.getts()
+        assert isinstance(raw_buf, memoryview)
+        assert raw_buf.tobytes() == pcapy_buf
+        assert abs(timestamp - (seconds + micro_sec * 10**-6)) < 1e-6
+    assert pcap.next()[0] is None
+    reader.close()
+
+    # Pcapng: compare against pcapy
+    data_path = file_utils.relative_dir(__file__, '../../data/https.pcap')
+    reader = PcapReader(data_path)
+    assert reader.format == 'pcapng'
+    pcap = pcapy.open_offline(data_path)
+    assert reader.linktype == pcap.datalink()
+    num_packets = 0
+    for timestamp, raw_buf in reader.packets():
+        header, pcapy_buf = pcap.next()
+        seconds, micro_sec = header.getts()
+        assert raw_buf.tobytes() == pcapy_buf
+        assert abs(timestamp - (seconds + micro_sec * 10**-6)) < 1e-6
+        num_packets += 1
+    print('Read %d pcapng packets' % num_packets)
+    assert [reader.buffer(start, end).tobytes() for _ts, start, end in reader.records()] == \
+           [raw_buf.tobytes() for _ts, raw_buf in reader.packets()]
+    reader.close()
+
+    # Build a small big-endian pcapng with two interfaces (us and ns resolution)
+    import tempfile
+
+    def _block(block_type, body):
+        block_len = 12 + len(body)
+        return struct.pack('>II', block_type, block_len) + body + struct.pack('>I', block_len)
+    shb = _block(PCAPNG_SHB, struct.pack('>IHHq', PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1))
+    idb_usec = _block(PCAPNG_IDB, struct.pack('>HHI', 1, 0, 65535) + struct.pack('>HH', 0, 0))
+    idb_nsec = _block(PCAPNG_IDB, struct.pack('>HHI', 1, 0, 65535) + struct.pack('>HHB3x', IF_TSRESOL, 1, 9) +
+                      struct.pack('>HH', 0, 0))
+    epb_usec = _block(PCAPNG_EPB, struct.pack('>IIIII', 0, 0, 1500000, 4, 4) + b'abcd')
+    epb_nsec = _block(PCAPNG_EPB, struct.pack('>IIIII', 1, 0, 2500000000, 3, 3) + b'xyz\x00')
+    with tempfile.NamedTemporaryFile(suffix='.pcapng', delete=False) as temp_file:
+        temp_file.write(shb + idb_usec + idb_nsec + epb_usec + epb_nsec)
+    reader = PcapReader(temp_file.name)
+    packets = [(timestamp, raw_buf.tobytes()) for timestamp, raw_buf in reader.packets()]
+    assert packets == [(1.5, b'abcd'), (2.5, b'xyz')]
+    reader.close()
+    os.remove(temp_file.name)
+
+    # Bad files
+    try:
+        PcapReader(file_utils.relative_dir(__file__, 'pcap_reader.py'))
+        assert False
+    except RuntimeError:
+        pass
+
+if __name__ == '__main__':
+    test()
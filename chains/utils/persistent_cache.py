@@ -0,0 +1,246 @@
+"""PersistentCache class for key/value pairs kept in an SQLite file that several processes can share"""
+from __future__ import print_function
+import os
+import time
+import atexit
+import weakref
+import sqlite3
+import threading
+
+# Local imports
+from chains.utils import cache
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+# Queued to have the writer thread read in the other processes' writes right away
+_REFRESH = 'refresh'
+
+
+class PersistentCache(object):
+    """SQLite backed cache with an in process copy, so restarts (and other processes) start warm.
+       Gets only ever read the in process copy (a miss never touches the file), sets go to the
+       file in batches from a writer thread, and the same thread reads in what other processes
+       wrote every refresh_interval seconds, so the caller never waits on disk I/O.
+       Usage:
+            cache = PersistentCache('~/.chains/rdns.db', positive_ttl=86400, negative_ttl=3600)
+            cache.set('8.8.8.8', 'dns.google')
+            cache.close()
+            cache = PersistentCache('~/.chains/rdns.db')
+            cache.get('8.8.8.8')
+            >>> dns.google
+
+       Args:
+            path (str): the SQLite file (the directory is created if needed)
+            positive_ttl (int): seconds a value lives (defaults to 86400)
+            negative_ttl (int): seconds a negative value lives (defaults to 3600)
+            negative_values (tuple): the values that count as negative (defaults to ('nxdomain',))
+            flush_size (int): the writer commits once this many sets are waiting (defaults to 256)
+            flush_interval (float): the most seconds a set waits before the writer commits it (defaults to 1.0)
+            max_size (int): the maximum number of items in the in process copy (defaults to 100000)
+            refresh_interval (float): seconds between reads of the other processes' writes (defaults to 1.0)
+       Note: Anything still waiting to be written goes out on close(), which also runs at exit.
+    """
+    def __init__(self, path, positive_ttl=86400, negative_ttl=3600, negative_values=('nxdomain',),
+                 flush_size=256, flush_interval=1.0, max_size=100000, refresh_interval=1.0):
+        """PersistentCache Initialization"""
+        self.path = os.path.expanduser(path)
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.negative_values = set(negative_values)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Create the table and warm up from what's in the file
+        db = self._connect()
+        db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expire REAL)')
+        db.commit()
+        now = time.time()
+        self._store = cache.ThreadSafeCache(max_size=max_size)
+        for key, value, expire in db.execute('SELECT key, value, expire FROM cache WHERE expire > ? '
+                                             'ORDER BY expire DESC LIMIT ?', (now, max_size)):
+            self._store.set(key, value, ttl=expire - now)
+        last_rowid = db.execute('SELECT MAX(rowid) FROM cache').fetchone()[0] or 0
+        db.close()
+
+        # The writer thread has its own connection
+        self._writes = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, args=(last_rowid,))
+        self._writer.daemon = True
+        self._writer.start()
+        self._closed = False
+        atexit.register(_close_at_exit, weakref.ref(self))
+
+    def set(self, key, value):
+        """Add an item to the cache (the write to the file happens in the background)
+        Args:
+               key: item key
+               value: the value associated with this key
+        """
+        ttl = self.negative_ttl if value in self.negative_values else self.positive_ttl
+        self._store.set(key, value, ttl=ttl)
+        self._writes.put((key, value, time.time() + ttl))
+
+    def get(self, key):
+        """Get an item from the cache (never waits on the file)
+           Args:
+               key: item key
+           Returns:
+               the value of the item or None if the item isn't in the cache
+        """
+        return self._store.get(key)
+
+    def flush(self):
+        """Wait until everything that was set is in the file"""
+        self._writes.join()
+
+    def refresh(self):
+        """Wait until the other processes' writes (so far) are read in"""
+        self._writes.put(_REFRESH)
+        self._writes.join()
+
+    def close(self):
+        """Write out what's waiting and close the file (only the first call does anything)"""
+        if self._closed:
+            return
+        self._closed = True
+        self._writes.put(None)
+        self._writer.join()
+
+    def __len__(self):
+        """Number of items in the in process copy"""
+        return len(self._store)
+
+    def _connect(self):
+        """Internal method: open the SQLite file (WAL mode so readers don't block the writers)"""
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def _write_loop(self, last_rowid):
+        """Internal method: commit the sets in batches and read in the other processes' writes until close()
+
+           Args:
+               last_rowid: the newest row already in the in process copy
+        """
+        db = self._connect()
+        batch = []
+        deadline = None
+        next_refresh = time.time() + self.refresh_interval
+        while True:
+            wait_until = min(deadline, next_refresh) if batch else next_refresh
+            try:
+                item = self._writes.get(timeout=max(wait_until - time.time(), 0))
+            except queue.Empty:
+                item = False
+            refresh = item == _REFRESH or (item is not None and time.time() >= next_refresh)
+            if item and item != _REFRESH:
+                if not batch:
+                    deadline = time.time() + self.flush_interval
+                batch.append(item)
+
+            # Commit when the batch is full, old enough, or we're refreshing or closing
+            if batch and (not item or refresh or len(batch) >= self.flush_size):
+                db.executemany('INSERT OR REPLACE INTO cache (key, value, expire) VALUES (?, ?, ?)', batch)
+                db.commit()
+                for _ in batch:
+                    self._writes.task_done()
+                batch = []
+
+            # Read in the rows written since the last refresh (replaced rows get a new rowid)
+            if refresh:
+                last_rowid = self._refresh(db, last_rowid)
+                next_refresh = time.time() + self.refresh_interval
+            if item == _REFRESH:
+                self._writes.task_done()
+            if item is None:
+                self._writes.task_done()
+                break
+        db.execute('DELETE FROM cache WHERE expire < ?', (time.time(),))
+        db.commit()
+        db.close()
+
+    def _refresh(self, db, last_rowid):
+        """Internal method: put the rows newer than last_rowid in the in process copy
+
+           Returns:
+               the newest rowid read
+        """
+        now = time.time()
+        for rowid, key, value, expire in db.execute('SELECT rowid, key, value, expire FROM cache WHERE rowid > ? '
+                                                    'ORDER BY rowid', (last_rowid,)).fetchall():
+            if expire > now:
+                self._store.set(key, value, ttl=expire - now)
+            last_rowid = rowid
+        return last_rowid
+
+
+def _close_at_exit(cache_ref):
+    """Internal method: close a cache that's still around at exit (so the waiting sets aren't lost)"""
+    persistent = cache_ref()
+    if persistent is not None:
+        persistent.close()
+
+
+def test():
+    """Test for the PersistentCache class"""
+    import tempfile
+    import shutil
+
+    temp_dir = tempfile.mkdtemp()
+    path = os.path.join(temp_dir, 'cache', 'rdns.db')
+
+    # Set, close and come back warm
+    my_cache = PersistentCache(path, positive_ttl=60, negative_ttl=1)
+    my_cache.set('8.8.8.8', 'dns.google')
+    my_cache.set('10.9.8.7', 'nxdomain')
+    assert my_cache.get('8.8.8.8') == 'dns.google'
+    assert my_cache.get('1.1.1.1') is None
+    my_cache.close()
+    my_cache = PersistentCache(path, positive_ttl=60, negative_ttl=1)
+    assert len(my_cache) == 2
+    assert my_cache.get('8.8.8.8') == 'dns.google'
+
+    # Negative values expire sooner
+    time.sleep(1.1)
+    assert my_cache.get('10.9.8.7') is None
+    assert my_cache.get('8.8.8.8') == 'dns.google'
+
+    # Shared, another cache on the same file reads in the writes once they're flushed
+    other_cache = PersistentCache(path, refresh_interval=0.05)
+    my_cache.set('1.1.1.1', 'one.one.one.one')
+    my_cache.set('9.9.9.9', 'dns9.quad9.net')
+    assert other_cache.get('1.1.1.1') is None
+    my_cache.flush()
+    other_cache.refresh()
+    assert other_cache.get('1.1.1.1') == 'one.one.one.one'
+    my_cache.set('1.1.1.1', 'one.one')
+    my_cache.set('8.8.4.4', 'dns.google')
+    my_cache.flush()
+    time.sleep(0.3)
+    assert other_cache.get('1.1.1.1') == 'one.one' and other_cache.get('8.8.4.4') == 'dns.google'
+    other_cache.close()
+    my_cache.close()
+    my_cache.close()
+
+    # A cache that never got closed still writes out at exit
+    import subprocess
+    import sys
+    script = ('from chains.utils import persistent_cache\n'
+              'persistent_cache.PersistentCache(%r, flush_interval=60).set("4.4.4.4", "four")\n' % path)
+    subprocess.check_call([sys.executable, '-c', script])
+    my_cache = PersistentCache(path)
+    assert my_cache.get('4.4.4.4') == 'four'
+    my_cache.close()
+    shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,221 @@
+"""PTRResolver: Non-blocking reverse DNS (PTR) lookups over UDP against a configurable resolver"""
+from __future__ import print_function
+import time
+import socket
+import select
+import random
+import threading
+import dpkt
+
+# Local imports
+from chains.utils import log_utils
+
+
+def reverse_name(ip_address):
+    """The PTR query name for an IP address
+
+       Args:
+           ip_address: the ip_address (as a str)
+       Returns:
+           str: e.g. '1.0.0.127.in-addr.arpa' or the nibble reversed ip6.arpa name
+    """
+    if ':' in ip_address:
+        nibbles = ''.join('%02x' % byte for byte in bytearray(socket.inet_pton(socket.AF_INET6, ip_address)))
+        return '.'.join(reversed(nibbles)) + '.ip6.arpa'
+    return '.'.join(reversed(ip_address.split('.'))) + '.in-addr.arpa'
+
+def default_nameserver(resolv_conf='/etc/resolv.conf'):
+    """The first nameserver in resolv.conf (defaults to 127.0.0.1 if there isn't one)"""
+    try:
+        with open(resolv_conf) as conf_file:
+            for line in conf_file:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    return fields[1]
+    except IOError:
+        pass
+    return '127.0.0.1'
+
+
+class PTRResolver(object):
+    """Send PTR queries without waiting on the answers, then collect whatever answers have come in.
+       Usage:
+            resolver = PTRResolver(server='8.8.8.8')
+            resolver.query('8.8.4.4')
+            for ip_address, domain in resolver.answers(timeout=1.0):
+                print(ip_address, domain)
+            >>> 8.8.4.4 dns.google
+            resolver.close()
+
+       Args:
+            server (str): the resolver address (defaults to the first nameserver in /etc/resolv.conf)
+            port (int): the resolver port (defaults to 53)
+       Note: An answer without a PTR record (NXDOMAIN, SERVFAIL...) comes back as 'nxdomain'.
+    """
+    def __init__(self, server=None, port=53):
+        """PTRResolver Initialization"""
+        self.server = server or default_nameserver()
+        self.port = port
+        family = socket.AF_INET6 if ':' in self.server else socket.AF_INET
+        self._sock = socket.socket(family, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self._next_id = random.randint(0, 0xffff)
+
+        # Query id -> (ip_address, query name, send time) for the queries in flight
+        self._queries = {}
+
+    def query(self, ip_address):
+        """Send a PTR query for an ip address (never blocks)
+
+           Args:
+               ip_address: the ip_address (as a str)
+        """
+        query_id = self._next_id = (self._next_id + 1) & 0xffff
+        name = reverse_name(ip_address)
+        request = dpkt.dns.DNS(id=query_id, qd=[dpkt.dns.DNS.Q(name=name, type=dpkt.dns.DNS_PTR)])
+        try:
+            self._sock.sendto(bytes(request), (self.server, self.port))
+        except socket.error as error:
+            log_utils.get_logger().warning('PTR query for {:s} failed: {:s}'.format(ip_address, str(error)))
+            return
+        self._queries[query_id] = (ip_address, name, time.time())
+
+    def answers(self, timeout=0):
+        """Collect the answers that have arrived
+
+           Args:
+               timeout: seconds to wait for the first answer (defaults to 0, don't wait)
+           Returns:
+               generator (tuple): (ip_address, domain) for each answer
+        """
+        while self._queries:
+            readable, _, _ = select.select([self._sock], [], [], timeout)
+            if not readable:
+                return
+            timeout = 0
+            try:
+                response, address = self._sock.recvfrom(4096)
+            except socket.error:
+                return
+
+            # Only answers from the resolver to the queries we sent
+            if address[0] != self.server:
+                continue
+            try:
+                answer = dpkt.dns.DNS(response)
+            except (dpkt.dpkt.UnpackError, IndexError):
+                continue
+            query = self._queries.get(answer.id)
+            if not query or answer.qr != dpkt.dns.DNS_R or not answer.qd or answer.qd[0].name != query[1]:
+                continue
+            del self._queries[answer.id]
+            ptr_names = [rr.ptrname for rr in answer.an if rr.type == dpkt.dns.DNS_PTR]
+            yield query[0], ptr_names[0] if ptr_names else 'nxdomain'
+
+    def in_flight(self):
+        """Number of queries waiting on an answer"""
+        return len(self._queries)
+
+    def expire(self, max_age=0):
+        """Stop waiting on queries older than max_age seconds (late answers get ignored)
+
+           Args:
+               max_age: seconds a query can stay in flight (defaults to 0, expire them all)
+           Returns:
+               list: the ip addresses of the expired queries
+        """
+        cutoff = time.time() - max_age
+        expired = [query_id for query_id, query in self._queries.items() if query[2] <= cutoff]
+        return [self._queries.pop(query_id)[0] for query_id in expired]
+
+    def close(self):
+        """Close the resolver socket"""
+        self._sock.close()
+
+
+class _TestResolver(object):
+    """Test helper: a tiny PTR responder on localhost, a stand-in for a real resolver in the
+       ptr_resolver and reverse_dns tests (not part of the public API)
+       Usage:
+            local = _TestResolver({'8.8.8.8': 'dns.google'}, silent=['1.2.3.4'])
+            resolver = PTRResolver(server='127.0.0.1', port=local.port)
+            ...
+            local.close()
+
+       Args:
+            records (dict): ip_address -> domain, anything else gets an NXDOMAIN answer
+            silent (list): ip addresses that never get an answer (defaults to None)
+            delay (float): seconds to wait before each answer (defaults to 0)
+    """
+    def __init__(self, records, silent=None, delay=0):
+        """_TestResolver Initialization"""
+        self.records = dict((reverse_name(ip_address), domain) for ip_address, domain in records.items())
+        self.silent = set(reverse_name(ip_address) for ip_address in silent or [])
+        self.delay = delay
+        self.queries = 0
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(('127.0.0.1', 0))
+        self.port = self._sock.getsockname()[1]
+        self._running = True
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        """Internal method: answer queries until closed"""
+        while self._running:
+            readable, _, _ = select.select([self._sock], [], [], 0.05)
+            if not readable:
+                continue
+            request, address = self._sock.recvfrom(4096)
+            query = dpkt.dns.DNS(request)
+            self.queries += 1
+            name = query.qd[0].name
+            if name in self.silent:
+                continue
+            if self.delay:
+                time.sleep(self.delay)
+            response = dpkt.dns.DNS(id=query.id, op=dpkt.dns.DNS_RA, qd=query.qd)
+            response.qr = dpkt.dns.DNS_R
+            if name in self.records:
+                response.an = [dpkt.dns.DNS.RR(name=name, type=dpkt.dns.DNS_PTR, ttl=60, ptrname=self.records[name])]
+            else:
+                response.rcode = dpkt.dns.DNS_RCODE_NXDOMAIN
+            self._sock.sendto(bytes(response), address)
+
+    def close(self):
+        """Stop answering"""
+        self._running = False
+        self._thread.join()
+        self._sock.close()
+
+
+def test():
+    """Test for the PTRResolver class"""
+
+    # Query names
+    assert reverse_name('192.168.1.20') == '20.1.168.192.in-addr.arpa'
+    assert reverse_name('2001:db8::1').endswith('.8.b.d.0.1.0.0.2.ip6.arpa')
+    assert reverse_name('2001:db8::1').startswith('1.0.0.0.')
+    assert default_nameserver('/nonexistent/resolv.conf') == '127.0.0.1'
+
+    # Answers, NXDOMAIN and silence from a local stand-in resolver
+    local = _TestResolver({'8.8.8.8': 'dns.google', '2001:4860:4860::8888': 'dns.google'}, silent=['1.2.3.4'])
+    resolver = PTRResolver(server='127.0.0.1', port=local.port)
+    for ip_address in ['8.8.8.8', '2001:4860:4860::8888', '10.9.8.7', '1.2.3.4']:
+        resolver.query(ip_address)
+    assert resolver.in_flight() == 4
+    answers = {}
+    deadline = time.time() + 2.0
+    while resolver.in_flight() > 1 and time.time() < deadline:
+        answers.update(resolver.answers(timeout=0.1))
+    assert answers == {'8.8.8.8': 'dns.google', '2001:4860:4860::8888': 'dns.google', '10.9.8.7': 'nxdomain'}
+    assert list(resolver.answers(timeout=0.1)) == []
+    assert resolver.expire(max_age=60) == []
+    assert resolver.expire() == ['1.2.3.4']
+    assert resolver.in_flight() == 0
+    resolver.close()
+    local.close()
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,115 @@
+"""ReorderBuffer: Hold items from several streams briefly so they come out roughly in timestamp order"""
+from __future__ import print_function
+import time
+import heapq
+
+
+class ReorderBuffer(object):
+    """Heap of timestamped items. An item is released once a timestamp more than max_skew_ms
+       newer has been seen, or once it has waited max_skew_ms (so a quiet stream can't hold
+       the others back), or when the buffer is over max_items.
+       Usage:
+            reorder = ReorderBuffer(max_skew_ms=50)
+            reorder.push(10.2, 'b'); reorder.push(10.1, 'a'); reorder.push(10.3, 'c')
+            reorder.pop_ready()
+            >>> [(10.1, 'a'), (10.2, 'b')]
+            reorder.flush()
+            >>> [(10.3, 'c')]
+
+       Args:
+            max_skew_ms (float): How far out of order (in timestamp and wall clock time) the streams can be (defaults to 50)
+            max_items (int): The most items to hold (defaults to 65536)
+    """
+    def __init__(self, max_skew_ms=50, max_items=65536):
+        """ReorderBuffer Initialization"""
+        self.max_skew = max_skew_ms / 1000.0
+        self.max_items = max_items
+        self._heap = []
+        self._seq = 0
+        self._newest = None
+        self._released = None
+
+        # Counters
+        self.late = 0
+
+    def push(self, timestamp, item, now=None):
+        """Add an item
+
+           Args:
+               timestamp: the item's timestamp
+               item: the item
+               now: the wall clock time it arrived (defaults to None, time.time())
+        """
+        if self._released is not None and timestamp < self._released:
+            self.late += 1
+        if self._newest is None or timestamp > self._newest:
+            self._newest = timestamp
+        heapq.heappush(self._heap, (timestamp, self._seq, now or time.time(), item))
+        self._seq += 1
+
+    def pop_ready(self, now=None):
+        """Take the items that are ready to go
+
+           Args:
+               now: the wall clock time (defaults to None, time.time())
+           Returns:
+               list: (timestamp, item) in timestamp order
+        """
+        heap = self._heap
+        released = []
+        if not heap:
+            return released
+        watermark = self._newest - self.max_skew
+        held_since = (now or time.time()) - self.max_skew
+        while heap and (heap[0][0] <= watermark or heap[0][2] <= held_since or len(heap) > self.max_items):
+            timestamp, _seq, _arrival, item = heapq.heappop(heap)
+            released.append((timestamp, item))
+        if released:
+            self._released = released[-1][0]
+        return released
+
+    def flush(self):
+        """Take all the items (at the end of the streams)
+
+           Returns:
+               list: (timestamp, item) in timestamp order
+        """
+        released = [(timestamp, item) for timestamp, _seq, _arrival, item in sorted(self._heap)]
+        self._heap = []
+        if released:
+            self._released = released[-1][0]
+        return released
+
+    def __len__(self):
+        """Number of items currently held"""
+        return len(self._heap)
+
+
+def test():
+    """Test for the ReorderBuffer class"""
+
+    # Released by timestamp once something newer than the skew shows up
+    reorder = ReorderBuffer(max_skew_ms=100)
+    now = 1000.0
+    for timestamp, item in [(10.05, 'b'), (10.0, 'a'), (10.12, 'c'), (10.11, 'd')]:
+        reorder.push(timestamp, item, now=now)
+    assert reorder.pop_ready(now=now) == [(10.0, 'a')]
+    reorder.push(10.3, 'e', now=now)
+    assert reorder.pop_ready(now=now) == [(10.05, 'b'), (10.11, 'd'), (10.12, 'c')]
+
+    # Released by waiting time (a quiet stream), then a late item gets counted
+    assert reorder.pop_ready(now=now + 0.05) == []
+    assert reorder.pop_ready(now=now + 0.2) == [(10.3, 'e')]
+    reorder.push(10.2, 'f', now=now)
+    assert reorder.late == 1 and len(reorder) == 1
+
+    # Held items come out on a flush (or when there's too many)
+    reorder.push(10.25, 'g', now=now)
+    assert reorder.flush() == [(10.2, 'f'), (10.25, 'g')]
+    reorder = ReorderBuffer(max_skew_ms=10000, max_items=2)
+    for timestamp in [3, 1, 2]:
+        reorder.push(timestamp, timestamp, now=now)
+    assert reorder.pop_ready(now=now) == [(1, 1)]
+
+if __name__ == '__main__':
+    test()
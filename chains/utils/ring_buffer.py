@@ -0,0 +1,168 @@
+"""RingBuffer: Bounded, thread safe buffer between a capture thread and the pipeline"""
+from __future__ import print_function
+import threading
+from collections import deque
+
+# Local imports
+from chains.utils import log_utils
+
+# What to do when the buffer is full
+DROP_POLICIES = ['drop_newest', 'drop_oldest']
+
+
+class RingBuffer(object):
+    """Bounded buffer with one producer thread and one consumer.
+       Usage:
+            ring = RingBuffer(capacity=2, drop_policy='drop_oldest')
+            ring.put('a'); ring.put('b'); ring.put('c')
+            ring.get_many()
+            >>> ['b', 'c']
+            ring.dropped
+            >>> 1
+            ring.close()
+
+       Args:
+            capacity (int): The maximum number of items held in the buffer (defaults to 65536)
+            drop_policy (str): When full, 'drop_newest' discards the incoming item and 'drop_oldest'
+                               discards the oldest buffered item (defaults to 'drop_newest')
+            wakeup (threading.Event): Also set this event on put() and close(), so one consumer can wait
+                                      on several buffers (defaults to None)
+    """
+    def __init__(self, capacity=65536, drop_policy='drop_newest', wakeup=None):
+        """RingBuffer Initialization"""
+        if drop_policy not in DROP_POLICIES:
+            log_utils.panic('Unknown drop policy: {:s}'.format(drop_policy))
+        self.capacity = capacity
+        self.drop_policy = drop_policy
+        self.wakeup = wakeup
+        self._items = deque()
+        self._not_empty = threading.Condition(threading.Lock())
+        self.closed = False
+
+        # Counters
+        self.pushed = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def put(self, item):
+        """Add an item to the buffer (never blocks)
+
+           Args:
+               item: the item to add
+           Returns:
+               True if the item was stored, False if it was dropped
+        """
+        with self._not_empty:
+            if len(self._items) >= self.capacity:
+                self.dropped += 1
+                if self.drop_policy == 'drop_newest':
+                    return False
+                self._items.popleft()
+            self._items.append(item)
+            self.pushed += 1
+            if len(self._items) > self.high_water:
+                self.high_water = len(self._items)
+            self._not_empty.notify()
+        if self.wakeup:
+            self.wakeup.set()
+        return True
+
+    def get_many(self, max_items=1024, timeout=None):
+        """Take up to max_items from the buffer, waiting for at least one
+
+           Args:
+               max_items: the maximum number of items to return
+               timeout: seconds to wait for an item (defaults to None, wait until an item arrives or close())
+           Returns:
+               list: the items (an empty list means timeout, or closed and fully drained)
+        """
+        with self._not_empty:
+            if not self._items and not self.closed:
+                self._not_empty.wait(timeout)
+            items = self._items
+            if len(items) <= max_items:
+                self._items = deque()
+                return list(items)
+            return [items.popleft() for _ in range(max_items)]
+
+    def close(self):
+        """No more items are coming, wake up the consumer"""
+        with self._not_empty:
+            self.closed = True
+            self._not_empty.notify_all()
+        if self.wakeup:
+            self.wakeup.set()
+
+    def stats(self):
+        """Get the buffer counters
+
+           Returns:
+               dict: pushed, dropped, buffered and high_water counts
+        """
+        return {'pushed': self.pushed, 'dropped': self.dropped, 'buffered': len(self._items),
+                'high_water': self.high_water}
+
+    def __len__(self):
+        """Number of items currently buffered"""
+        return len(self._items)
+
+
+def test():
+    """Test for the RingBuffer class"""
+
+    # Drop newest
+    ring = RingBuffer(capacity=3)
+    stored = [ring.put(i) for i in range(5)]
+    assert stored == [True, True, True, False, False]
+    assert ring.get_many() == [0, 1, 2]
+    assert ring.stats() == {'pushed': 3, 'dropped': 2, 'buffered': 0, 'high_water': 3}
+
+    # Drop oldest
+    ring = RingBuffer(capacity=3, drop_policy='drop_oldest')
+    for i in range(5):
+        ring.put(i)
+    assert ring.get_many(max_items=2) == [2, 3]
+    assert ring.get_many() == [4]
+    assert ring.dropped == 2
+
+    # Timeout and close
+    assert ring.get_many(timeout=0.01) == []
+    ring.close()
+    assert ring.get_many() == []
+
+    # Wakeup event
+    wakeup = threading.Event()
+    ring = RingBuffer(capacity=1, wakeup=wakeup)
+    ring.put(1)
+    assert wakeup.is_set()
+    wakeup.clear()
+    ring.close()
+    assert wakeup.is_set()
+
+    # Producer thread
+    ring = RingBuffer(capacity=100000)
+
+    def _producer():
+        for i in range(10000):
+            ring.put(i)
+        ring.close()
+    thread = threading.Thread(target=_producer)
+    thread.start()
+    items = []
+    while True:
+        batch = ring.get_many()
+        if not batch:
+            break
+        items.extend(batch)
+    thread.join()
+    assert items == list(range(10000))
+
+    # Bad drop policy
+    try:
+        RingBuffer(drop_policy='drop_everything')
+        assert False
+    except RuntimeError:
+        pass
+
+if __name__ == '__main__':
+    test()
@@ -13,13 +13,13 @@ from chains.links import packet_meta, reverse_dns, transport_meta
 from chains.sinks import packet_printer, packet_summary
 
 
-def run(iface_name=None, bpf=None, summary=None, max_packets=100):
+def run(iface_name=None, bpf=None, summary=None, max_packets=100, rdns_cache=None):
     """Run the Simple Packet Printer Example"""
 
     # Create the classes
     streamer = packet_streamer.PacketStreamer(iface_name=iface_name, bpf=bpf, max_packets=max_packets)
     meta = packet_meta.PacketMeta()
-    rdns = reverse_dns.ReverseDNS()
+    rdns = reverse_dns.ReverseDNS(cache_path=rdns_cache)
     tmeta = transport_meta.TransportMeta()
     if summary:
         printer = packet_summary.PacketSummary()
@@ -60,6 +60,7 @@ if __name__ == '__main__':
     parser.add_argument('-s', '--summary', action="store_true", help='Summary instead of full packet print')
     parser.add_argument('-m', '--max-packets', type=int, default=100, help='How many packets to process (0 for infinity)')
     parser.add_argument('-p', '--pcap', type=str, help='Specify a pcap file instead of reading from live network interface')
+    parser.add_argument('--rdns-cache', type=str, help='Keep reverse DNS lookups in this file across runs (e.g. ~/.chains/rdns.db)')
     args, commands = parser.parse_known_args()
     if commands:
         print('Unrecognized args: %s' % commands)
@@ -69,6 +70,7 @@ if __name__ == '__main__':
             args.pcap = os.path.expanduser(args.pcap)
 
         with signal_utils.signal_catcher(my_exit):
-            run(iface_name=args.pcap, bpf=args.bpf, summary=args.summary, max_packets=args.max_packets)
+            run(iface_name=args.pcap, bpf=args.bpf, summary=args.summary, max_packets=args.max_packets,
+                rdns_cache=args.rdns_cache)
     except KeyboardInterrupt:
         print('Goodbye...')